@@ -1,16 +1,27 @@
-from flask import Flask, render_template, request, redirect, session, send_file, make_response, flash, jsonify
-from datetime import timedelta
+from flask import Flask, render_template, request, redirect, session, send_file, make_response, flash, jsonify, Response
+from datetime import timedelta, datetime, timezone
 import os
 import json
 import io
+import time
 from datetime import timedelta
 import os
 import json
 
-from db import init_user_db, get_user_conn
-from auth import login
+from db import init_user_db, get_user_conn, init_db
+from auth import login, WORKSPACE_MODES
 from security import hash_password
-from user_files import load_user_data, save_user_data
+from user_files import (
+    list_documents,
+    load_document,
+    load_document_with_version,
+    add_document,
+    update_document,
+    add_save_hook,
+    get_document_etag,
+    get_documents_etag,
+    VersionConflictError
+)
 from ui_labels import UI_LABELS
 from intent_templates import COMMON_INTENTS, DOC_TYPE_INTENTS
 
@@ -19,7 +30,6 @@ from intent_templates import COMMON_INTENTS, DOC_TYPE_INTENTS
 
 from services.services import (
     create_document,
-    find_document,
     update_units_content,
     DEFAULT_COMPOSITION_META # Add this line
 )
@@ -30,15 +40,98 @@ from services.domain_bridge import (
 )
 
 from services.services import update_intent, normalize_composition_elements, update_composition_elements
-from services.services import attach_unit_scores
+from services.services import normalize_document, is_normalized, mark_normalized, forget_normalized
 from services.services import extract_red_units, build_llm_prompt, build_composition_ideas_prompt
 from intent_service import normalize_intent as normalize_intent_service # Rename to avoid conflict with services.py version
+from services import repository
+from services import optimize_jobs
+from services.unit_index import related_units, RELATED_TOP_K, METHOD_BM25, SCOPE_ALL
+from services import unit_index as unit_index_hooks
+from services import search_index
+from services.score_cache import score_unit
+from services.bulk_import import import_documents, ImportFormatError, MAX_UPLOAD_BYTES
+from services.bulk_export import document_to_json, iter_ndjson, iter_zip
+from connection_scoring import connection_matrix
+import request_timing
+from request_timing import span
+import metrics
 
 app = Flask(__name__)
 app.secret_key = "storyforge-secret"
 app.permanent_session_lifetime = timedelta(hours=2)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+app.config["WORKSPACE_MODE"] = os.environ.get("STORYFORGE_WORKSPACE_MODE", "persistent")
+if app.config["WORKSPACE_MODE"] not in WORKSPACE_MODES:
+    raise ValueError(f"STORYFORGE_WORKSPACE_MODE must be one of {WORKSPACE_MODES}")
+
+MAX_IMPORT_ERRORS_SHOWN = 5
+# 接続ヒートマップを表示できる Unit 数の上限（これを超えると表として読めない）
+HEATMAP_MAX_UNITS = 200
+# 最適化ジョブの進捗を SSE で送る間隔（秒）
+OPTIMIZE_PROGRESS_INTERVAL = 0.5
 
 init_user_db()
+init_db()
+
+VERSION_CONFLICT_MESSAGE = "このドキュメントは別の画面で更新されています。最新の内容を確認してから保存し直してください。"
+
+# JSON ストアへの保存を writing.db（Unit 単位で引けるミラー）に反映する
+add_save_hook(
+    on_save=lambda user_id, document: repository.sync_document(
+        repository.story_id_for(user_id, document["id"]), document,
+        get_document_etag(user_id, document["id"])[0]
+    ),
+    on_delete=lambda user_id, doc_id: repository.delete_document(
+        repository.story_id_for(user_id, doc_id)
+    )
+)
+# 関連 Unit 検索の転置インデックスを保存のたびに差分で更新する
+add_save_hook(on_save=unit_index_hooks.on_save, on_delete=unit_index_hooks.on_delete)
+# 全文検索の索引（search_entry / search_fts）も変わった行だけ書き換える
+add_save_hook(on_save=search_index.sync_document, on_delete=search_index.delete_document)
+# 削除した id で作り直されたドキュメントを正規化済みと取り違えない
+add_save_hook(on_delete=forget_normalized)
+
+# ---------- 計測 ----------
+
+_http_requests = metrics.counter(
+    "storyforge_http_requests_total", "HTTP requests by route and status", ["method", "route", "status"]
+)
+_http_request_seconds = metrics.histogram(
+    "storyforge_http_request_duration_seconds", "Time until the response headers are ready", ["method", "route"]
+)
+
+@app.before_request
+def start_request_timing():
+    request_timing.start_request()
+
+
+@app.after_request
+def finish_request_timing(response):
+    """段階ごとの時間を Server-Timing ヘッダに載せ、ルートごとに集計する"""
+    timer = request_timing.end_request()
+    if timer is not None:
+        response.headers["Server-Timing"] = timer.server_timing()
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        request_timing.record(f"{request.method} {rule}", timer, response.status_code)
+        _http_requests.inc(method=request.method, route=rule, status=response.status_code)
+        _http_request_seconds.observe(timer.elapsed(), method=request.method, route=rule)
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus のテキスト形式のメトリクス（このプロセスの分）"""
+    return Response(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/timings")
+def request_timings():
+    """ルートごとの処理時間の集計（このプロセスの起動以降）"""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify(request_timing.route_summary())
+
 
 # ---------- 認証 ----------
 
@@ -87,9 +180,8 @@ def dashboard():
     if "user_id" not in session: # Removed data_loaded check
         return redirect("/dashboard")
 
-    data = load_user_data(session["user_id"])
-    documents = data.get("documents", [])
-    
+    documents = list_documents(session["user_id"])
+
     user_config = {
         "llm": {
             "api_key": session.get("llm_api_key", ""),
@@ -101,12 +193,30 @@ def dashboard():
         }
     }
 
-    return render_template(
-        "dashboard.html",
-        documents=documents,
-        doc_types=DOC_TYPE_INTENTS.keys(),
-        user_config=user_config
-    )
+    with span("render"):
+        return render_template(
+            "dashboard.html",
+            documents=documents,
+            doc_types=DOC_TYPE_INTENTS.keys(),
+            user_config=user_config
+        )
+
+@app.route("/search")
+def search_documents():
+    """
+    ユーザーの全ドキュメント（タイトル・Unit・Intent・構成要素）の全文検索。
+    ?q=語 語&page=1&per_page=20
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return jsonify(search_index.search(
+        session["user_id"],
+        request.args.get("q", ""),
+        page=request.args.get("page", 1, type=int),
+        per_page=request.args.get("per_page", search_index.SEARCH_PER_PAGE, type=int)
+    ))
+
 
 @app.route("/upload", methods=["POST"])
 def upload():
@@ -123,43 +233,26 @@ def upload():
         flash("ファイルが選択されていません")
         return redirect("/dashboard")
 
-    # Assuming 'file' is not empty at this point, if it passes previous checks.
-    # The 'if not file:' check is now less critical given the above.
-
-    # Load the uploaded JSON data
+    # file.stream は大きなアップロードでは一時ファイルに退避済み（全体を read() しない）。
+    # 単一 JSON / NDJSON / zip をドキュメント単位で検証し、既存ドキュメントには触れずに追加する
     try:
-        file_content_bytes = file.read()
-        try:
-            uploaded_json_content = json.loads(file_content_bytes.decode('utf-8'))
-        except UnicodeDecodeError:
-            # Fallback for common non-UTF-8 encodings, e.g., Shift-JIS for Japanese
-            uploaded_json_content = json.loads(file_content_bytes.decode('shift_jis'))
-    except json.JSONDecodeError:
-        flash("無効なJSONファイルです")
-        return redirect("/dashboard")
-    except UnicodeDecodeError:
-        flash("ファイルのエンコーディングを認識できませんでした。UTF-8またはShift-JISで保存されていることを確認してください。")
+        result = import_documents(
+            file.stream,
+            file.filename,
+            lambda document: add_document(session["user_id"], document)
+        )
+    except ImportFormatError as e:
+        flash(str(e))
         return redirect("/dashboard")
 
-    # Validate that the uploaded content is a dictionary and looks like a document
-    # (e.g., has a 'title' key)
-    if not isinstance(uploaded_json_content, dict) or "title" not in uploaded_json_content:
-        flash("アップロードされたファイルは有効なドキュメント形式ではありません。'title'キーが見つかりません。")
-        return redirect("/dashboard")
-
-    # Load existing user data
-    existing_data = load_user_data(session["user_id"])
-    
-    # Ensure 'documents' key exists and is a list
-    if "documents" not in existing_data or not isinstance(existing_data["documents"], list):
-        existing_data["documents"] = []
-
-    # Append the new document to the existing list
-    existing_data["documents"].append(uploaded_json_content)
-
-    # Save the updated user data
-    save_user_data(session["user_id"], existing_data)
-    flash("ファイルをアップロードしました。")
+    if result.imported_ids:
+        flash(f"{len(result.imported_ids)}件のドキュメントをアップロードしました。")
+    for label, reason in result.errors[:MAX_IMPORT_ERRORS_SHOWN]:
+        flash(f"{label}: {reason}")
+    if len(result.errors) > MAX_IMPORT_ERRORS_SHOWN:
+        flash(f"ほか{len(result.errors) - MAX_IMPORT_ERRORS_SHOWN}件のエラーがあります。")
+    if not result.imported_ids and not result.errors:
+        flash("アップロードされたファイルにドキュメントが含まれていません。")
     return redirect("/dashboard")
 
 @app.route("/save_config", methods=["POST"])
@@ -184,15 +277,13 @@ def document_create():
     if "user_id" not in session: # Removed data_loaded check
         return redirect("/dashboard")
 
-    data = load_user_data(session["user_id"])
-
     document = create_document(
-        data=data,
+        data={},
         title=request.form["title"],
         doc_type=request.form["doc_type"]
     )
 
-    save_user_data(session["user_id"], data)
+    add_document(session["user_id"], document)
     return redirect(f"/document/{document['id']}")
 
 @app.route("/document/<doc_id>", methods=["GET", "POST"])
@@ -200,25 +291,42 @@ def view_document(doc_id):
     if "user_id" not in session: # Removed data_loaded check
         return redirect("/dashboard")
 
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
+    if request.method == "POST":
+        def apply_form(document):
+            normalize_document(document)
+            # composition_elements の更新を処理
+            if request.form.get("update_composition_elements"):
+                update_composition_elements(document, request.form)
+            else: # 既存の unit content 更新も残しておく
+                update_units_content(document, request.form)
+            # 保存する内容も正規化済みにしておき、次の表示で正規化し直さなくて済むようにする
+            normalize_document(document)
+
+        try:
+            document, version = update_document(
+                session["user_id"], doc_id, apply_form,
+                expected_version=request.form.get("version", type=int)
+            )
+        except VersionConflictError:
+            flash(VERSION_CONFLICT_MESSAGE, "error")
+            return redirect(f"/document/{doc_id}#composition")
+
+        if document is None:
+            return redirect("/dashboard")
+        mark_normalized(session["user_id"], doc_id, version)
+        return redirect(f"/document/{doc_id}#composition") # 常に構成要素タブにリダイレクト
+
+    document, version = load_document_with_version(session["user_id"], doc_id)
 
     if document is None:
         return redirect("/dashboard")
 
-    # Normalize document for both GET and POST requests
-    normalize_intent_service(document)
-    normalize_composition_elements(document)
-
-    if request.method == "POST":
-        # composition_elements の更新を処理
-        if request.form.get("update_composition_elements"):
-            update_composition_elements(document, request.form)
-        else: # 既存の unit content 更新も残しておく
-            update_units_content(document, request.form)
-        
-        save_user_data(session["user_id"], data)
-        return redirect(f"/document/{doc_id}#composition") # 常に構成要素タブにリダイレクト
+    if not is_normalized(session["user_id"], doc_id, version):
+        # 正規化による変更は一度だけ保存する（変わらなければ書き込みは発生しない）
+        document, version = update_document(session["user_id"], doc_id, normalize_document)
+        if document is None:
+            return redirect("/dashboard")
+        mark_normalized(session["user_id"], doc_id, version)
 
     labels = UI_LABELS[document["doc_type"]]
 
@@ -226,12 +334,14 @@ def view_document(doc_id):
     doc_type_mapping = {meta["label"]: doc_id for doc_id, meta in DEFAULT_COMPOSITION_META["doc_types"].items()}
     mapped_doc_type_id = doc_type_mapping.get(document["doc_type"])
 
-    return render_template(
-        "document.html",
-        document=document,
-        labels=labels,
-        mapped_doc_type_id=mapped_doc_type_id # 追加
-    )
+    with span("render"):
+        return render_template(
+            "document.html",
+            document=document,
+            labels=labels,
+            mapped_doc_type_id=mapped_doc_type_id, # 追加
+            version=version
+        )
 
 
 @app.route("/document/<doc_id>/intent", methods=["POST"])
@@ -239,19 +349,24 @@ def edit_intent(doc_id):
     if "user_id" not in session: # Removed data_loaded check
         return redirect("/dashboard")
 
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
+    def apply_form(document):
+        # ★ ここで正規化（重要）
+        normalize_intent_service(document) # services.py の normalize_intent との衝突を避けるためリネーム
 
-    if document is None:
-        return redirect("/dashboard")
-
-    # ★ ここで正規化（重要）
-    normalize_intent_service(document) # services.py の normalize_intent との衝突を避けるためリネーム
+        # ★ Intent更新（削除・追加・保存すべて）
+        update_intent(document, request.form)
 
-    # ★ Intent更新（削除・追加・保存すべて）
-    update_intent(document, request.form)
+    try:
+        document, _ = update_document(
+            session["user_id"], doc_id, apply_form,
+            expected_version=request.form.get("version", type=int)
+        )
+    except VersionConflictError:
+        flash(VERSION_CONFLICT_MESSAGE, "error")
+        return redirect(f"/document/{doc_id}#intent")
 
-    save_user_data(session["user_id"], data)
+    if document is None:
+        return redirect("/dashboard")
     return redirect(f"/document/{doc_id}")
 
 @app.route("/document/<doc_id>/improve/<int:unit_index>", methods=["POST"])
@@ -259,8 +374,7 @@ def improve_unit(doc_id, unit_index):
     if "user_id" not in session: # Removed data_loaded check
         return redirect("/dashboard")
 
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
+    document = load_document(session["user_id"], doc_id)
     if document is None:
         return redirect(f"/document/{doc_id}")
 
@@ -275,6 +389,228 @@ def improve_unit(doc_id, unit_index):
     # 🔽 今は LLM を呼ばず、そのまま表示
     return f"<pre>{prompt}</pre>"
 
+@app.route("/document/<doc_id>/units/<int:unit_index>", methods=["GET", "POST"])
+def document_unit(doc_id, unit_index):
+    """
+    Unit を1件だけ取得・更新する（writing.db のインデックスで引く）
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    story_id = repository.story_id_for(session["user_id"], doc_id)
+
+    if request.method == "POST":
+        request_data = request.get_json() or {}
+
+        # フォームの version（type=int）と同じく整数に揃える。"3" も受け付け、数でなければ 400
+        version = request_data.get("version")
+        if version is not None:
+            if isinstance(version, bool) or not isinstance(version, (int, str)):
+                return jsonify({"error": "version must be an integer"}), 400
+            try:
+                version = int(version)
+            except ValueError:
+                return jsonify({"error": "version must be an integer"}), 400
+
+        def apply_unit(document):
+            units = document.get("units", [])
+            if 0 <= unit_index < len(units):
+                for key in ("title", "content"):
+                    if key in request_data:
+                        units[unit_index][key] = str(request_data[key])
+
+        try:
+            document, _ = update_document(
+                session["user_id"], doc_id, apply_unit,
+                expected_version=version
+            )
+        except VersionConflictError as e:
+            return jsonify({"error": VERSION_CONFLICT_MESSAGE, "version": e.current_version}), 409
+
+        if document is None:
+            return jsonify({"error": "Document not found"}), 404
+
+    # ミラーが JSON ストアと同じ版か stat だけで確かめ、違えば（ミラー導入前のドキュメント・
+    # 保存フックの失敗・他のプロセスでの保存）読み直して同期してから引く
+    etag = get_document_etag(session["user_id"], doc_id)[0]
+    if etag is None:
+        return jsonify({"error": "Document not found"}), 404
+    if repository.get_source_etag(story_id) != etag:
+        document = load_document(session["user_id"], doc_id)
+        if document is None:
+            return jsonify({"error": "Document not found"}), 404
+        repository.sync_document(story_id, document, etag)
+
+    unit = repository.get_unit(story_id, unit_index)
+
+    if unit is None:
+        return jsonify({"error": "Unit not found"}), 404
+
+    return jsonify({
+        "index": unit.order_no,
+        "title": unit.title,
+        "content": unit.summary
+    })
+
+
+@app.route("/document/<doc_id>/units/<int:unit_index>/score", methods=["POST"])
+def document_unit_score(doc_id, unit_index):
+    """
+    編集中の Unit のスコア（Intent・前後との接続）をその場で返す。
+    JSON の content を渡すと、保存前の下書きの本文として計算する
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    document = load_document(session["user_id"], doc_id)
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    units = document.get("units", [])
+    if not 0 <= unit_index < len(units):
+        return jsonify({"error": "Unit not found"}), 404
+
+    content = (request.get_json(silent=True) or {}).get("content")
+    return jsonify(score_unit(document.get("intent"), units, unit_index, None if content is None else str(content)))
+
+
+@app.route("/document/<doc_id>/units/<int:unit_index>/related")
+def document_unit_related(doc_id, unit_index):
+    """
+    この Unit と同じことを扱っている Unit（このドキュメント・ユーザーの他のドキュメント）の上位 k 件。
+    ?k=10&method=bm25|jaccard&scope=all|document
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    document = load_document(session["user_id"], doc_id)
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    units = document.get("units", [])
+    if not 0 <= unit_index < len(units):
+        return jsonify({"error": "Unit not found"}), 404
+
+    try:
+        related = related_units(
+            session["user_id"], doc_id, unit_index, units[unit_index].get("content", ""),
+            k=request.args.get("k", RELATED_TOP_K, type=int),
+            method=request.args.get("method", METHOD_BM25),
+            scope=request.args.get("scope", SCOPE_ALL)
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"related": related})
+
+
+@app.route("/document/<doc_id>/connections")
+def document_connections(doc_id):
+    """
+    Unit 間の接続スコア行列（ヒートマップ表示用）。
+    各 Unit に表示する接続スコアと同じ値になるよう、MinHash の見積もりは使わない
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    document = load_document(session["user_id"], doc_id)
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    units = document.get("units", [])
+    if len(units) > HEATMAP_MAX_UNITS:
+        return jsonify({"error": f"ヒートマップは{HEATMAP_MAX_UNITS}件以下のUnitでのみ表示できます"}), 400
+
+    return jsonify({
+        "units": [unit.get("title") or f"#{i + 1}" for i, unit in enumerate(units)],
+        "matrix": connection_matrix([unit.get("content", "") for unit in units], exact=True)
+    })
+
+
+@app.route("/document/<doc_id>/optimize", methods=["POST"])
+def start_optimize(doc_id):
+    """
+    Unit 並び順の最適化をバックグラウンドで開始する
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    document, version = load_document_with_version(session["user_id"], doc_id)
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
+    if len(document.get("units", [])) < 2:
+        return jsonify({"error": "並び替えるにはUnitが2件以上必要です"}), 400
+
+    try:
+        job = optimize_jobs.start_job(session["user_id"], doc_id, version, document)
+    except optimize_jobs.TooManyJobsError:
+        return jsonify({"error": "最適化ジョブが混み合っています。しばらくしてから再度お試しください。"}), 503
+    return jsonify(job.snapshot()), 202
+
+
+@app.route("/document/<doc_id>/optimize/<job_id>/events")
+def optimize_events(doc_id, job_id):
+    """
+    最適化の進捗を Server-Sent Events で送る（終わったら "done" イベントで閉じる）
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = optimize_jobs.get_job(session["user_id"], doc_id, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    user_id = session["user_id"]
+
+    def stream():
+        job_state = job
+        while True:
+            progress = job_state.snapshot()
+            finished = progress["state"] != optimize_jobs.JOB_RUNNING
+            event = "done" if finished else "progress"
+            yield f"event: {event}\ndata: {json.dumps(progress)}\n\n"
+            if finished:
+                return
+            time.sleep(OPTIMIZE_PROGRESS_INTERVAL)
+            # 進捗はジョブのプロセスが writing.db に書き込むので、読み直す
+            job_state = optimize_jobs.get_job(user_id, doc_id, job_id)
+            if job_state is None:
+                return
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/document/<doc_id>/optimize/<job_id>/cancel", methods=["POST"])
+def cancel_optimize(doc_id, job_id):
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = optimize_jobs.cancel_job(session["user_id"], doc_id, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.snapshot())
+
+
+@app.route("/document/<doc_id>/optimize/<job_id>/apply", methods=["POST"])
+def apply_optimize(doc_id, job_id):
+    """
+    その時点の最良の並び順をドキュメントに反映する（ジョブが走っていても適用できる）
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = optimize_jobs.get_job(session["user_id"], doc_id, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def apply_order(document):
+        document["units"] = job.reorder(document.get("units", []))
+
+    # 開始後にドキュメントが変わっていたら、添字が指す Unit がずれているので適用しない
+    try:
+        document, version = update_document(
+            session["user_id"], doc_id, apply_order, expected_version=job.version
+        )
+    except VersionConflictError as e:
+        return jsonify({"error": VERSION_CONFLICT_MESSAGE, "version": e.current_version}), 409
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
+
+    optimize_jobs.cancel_job(session["user_id"], doc_id, job_id)
+    return jsonify({"version": version, "score": job.best_score})
+
 from services.llm_client import call_llm # Import the generic LLM client
 
 
@@ -294,8 +630,7 @@ def mock_llm_call(prompt: str) -> dict:
 def generate_composition_ideas(doc_id):
     if "user_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
+    document = load_document(session["user_id"], doc_id)
     if document is None:
         return jsonify({"error": "Document not found"}), 404
 
@@ -331,66 +666,106 @@ def add_composition_element(doc_id):
     if "user_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
-    if document is None:
-        return jsonify({"error": "Document not found"}), 404
-
     request_data = request.get_json()
     new_element_label = request_data.get("label")
 
     if not new_element_label:
         return jsonify({"error": "Label is required"}), 400
 
-    # Find or create a user-editable category to add the suggestion to
-    elements_data = document["composition_elements"]
-    doc_type_specific_categories = elements_data["doc_type_specific"].setdefault("categories", [])
-    common_categories = elements_data["common"].setdefault("categories", [])
-    
-    # Try to add to an editable doc_type_specific category first
-    target_category = next((cat for cat in doc_type_specific_categories if cat.get("editable")), None)
-    
-    # If no editable doc_type_specific category, try editable common category
-    if not target_category:
-        target_category = next((cat for cat in common_categories if cat.get("editable")), None)
-
-    # If still no editable category, create a new "AI提案" category under common
-    if not target_category:
-        ai_suggestions_category_id = "ai_suggestions_cat"
-        target_category = next((cat for cat in common_categories if cat["id"] == ai_suggestions_category_id), None)
+    def add_element(document):
+        # Find or create a user-editable category to add the suggestion to
+        elements_data = document["composition_elements"]
+        doc_type_specific_categories = elements_data["doc_type_specific"].setdefault("categories", [])
+        common_categories = elements_data["common"].setdefault("categories", [])
+
+        # Try to add to an editable doc_type_specific category first
+        target_category = next((cat for cat in doc_type_specific_categories if cat.get("editable")), None)
+
+        # If no editable doc_type_specific category, try editable common category
         if not target_category:
-            target_category = {
-                "id": ai_suggestions_category_id,
-                "label": "AI提案",
-                "editable": True,
-                "elements": []
-            }
-            common_categories.append(target_category)
-    
-    target_elements = target_category.setdefault("elements", [])
-    target_elements.append({
-        "id": os.urandom(4).hex(), # Generate a unique ID for the new element
-        "label": new_element_label,
-        "value": "",
-        "editable": True
-    })
+            target_category = next((cat for cat in common_categories if cat.get("editable")), None)
+
+        # If still no editable category, create a new "AI提案" category under common
+        if not target_category:
+            ai_suggestions_category_id = "ai_suggestions_cat"
+            target_category = next((cat for cat in common_categories if cat["id"] == ai_suggestions_category_id), None)
+            if not target_category:
+                target_category = {
+                    "id": ai_suggestions_category_id,
+                    "label": "AI提案",
+                    "editable": True,
+                    "elements": []
+                }
+                common_categories.append(target_category)
+
+        target_elements = target_category.setdefault("elements", [])
+        target_elements.append({
+            "id": os.urandom(4).hex(), # Generate a unique ID for the new element
+            "label": new_element_label,
+            "value": "",
+            "editable": True
+        })
+
+    # 読み込みから保存までロックを持つので、並行する保存の変更を上書きしない
+    document, _ = update_document(session["user_id"], doc_id, add_element)
+    if document is None:
+        return jsonify({"error": "Document not found"}), 404
 
-    save_user_data(session["user_id"], data)
     return jsonify({"message": "Composition element added successfully"})
 
 
+# ---------- エクスポート ----------
+
+# 毎回再検証させるが、変わっていなければ 304 で本文を返さない
+EXPORT_CACHE_CONTROL = "private, no-cache"
+
+
+def _http_last_modified(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
+
+
+def _not_modified(etag, last_modified):
+    """条件付き GET が一致すれば 304 レスポンスを返す（ETag を優先）"""
+    if etag is None:
+        return None
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        matched = last_modified <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+
+    response = make_response("", 304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = EXPORT_CACHE_CONTROL
+    return response
+
+
 @app.route("/document/<doc_id>/download", methods=["GET"])
 def download_document(doc_id):
     if "user_id" not in session:
         return redirect("/login")
 
-    data = load_user_data(session["user_id"])
-    document = find_document(data, doc_id)
+    # stat だけで判定できるので、変わっていなければ読み込みもシリアライズもしない
+    etag, mtime = get_document_etag(session["user_id"], doc_id)
+    not_modified = _not_modified(etag, _http_last_modified(mtime))
+    if not_modified is not None:
+        return not_modified
+
+    document = load_document(session["user_id"], doc_id)
 
     if document is None:
         return redirect("/dashboard")
 
-    document_json = json.dumps(document, ensure_ascii=False, indent=2)
+    if etag is None:  # 旧形式からの移行直後
+        etag, mtime = get_document_etag(session["user_id"], doc_id)
+
+    document_json = document_to_json(document)
     
     # Use io.BytesIO to create an in-memory file
     file_data = io.BytesIO(document_json.encode('utf-8'))
@@ -400,11 +775,52 @@ def download_document(doc_id):
         file_data,
         mimetype='application/json',
         as_attachment=True,
-        download_name=f"{document['title']}.json"
+        download_name=f"{document['title']}.json",
+        etag=etag or False,
+        last_modified=_http_last_modified(mtime)
     )
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    response.headers["Cache-Control"] = EXPORT_CACHE_CONTROL
+    return response
+
+
+@app.route("/documents/export", methods=["GET"])
+def export_documents():
+    """
+    全ドキュメントを zip（既定）または NDJSON でストリーミングする。
+    1件ずつ読み込んで書き出すので、全体をメモリに載せない
+    """
+    if "user_id" not in session:
+        return redirect("/login")
+
+    user_id = session["user_id"]
+    export_format = request.args.get("format", "zip")
+    if export_format not in ("zip", "ndjson"):
+        return jsonify({"error": "format must be 'zip' or 'ndjson'"}), 400
+
+    etag, mtime = get_documents_etag(user_id)
+    etag = f"{etag}-{export_format}"
+    last_modified = _http_last_modified(mtime)
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    def documents():
+        for entry in list_documents(user_id):
+            document = load_document(user_id, entry["id"])
+            if document is not None:
+                yield document
+
+    if export_format == "ndjson":
+        response = Response(iter_ndjson(documents()), mimetype="application/x-ndjson")
+        filename = "documents.ndjson"
+    else:
+        response = Response(iter_zip(documents()), mimetype="application/zip")
+        filename = "documents.zip"
+
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    response.headers["Cache-Control"] = EXPORT_CACHE_CONTROL
+    response.set_etag(etag)
+    response.last_modified = last_modified
     return response
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
-import shutil
-import os
-from flask import request, render_template, redirect, session
+from flask import request, render_template, redirect, session, current_app
 from db import get_user_conn
 from security import verify_password
-from user_files import save_user_data, get_user_data_path
+from user_files import reset_user_data
+
+# persistent: ドキュメントはログインをまたいで残る（既定）
+# ephemeral : ログインのたびに作業データを空にする（共用端末・授業用）
+WORKSPACE_MODES = ("persistent", "ephemeral")
+
 
 def login():
     if request.method == "POST":
@@ -16,16 +19,12 @@ def login():
             ).fetchone()
 
         if user and verify_password(password, user["password_hash"]):
-            # Remove old user data
-            user_data_path = get_user_data_path(email) # Changed to email as per file content
-            if os.path.exists(user_data_path):
-                shutil.rmtree(user_data_path)
+            if current_app.config.get("WORKSPACE_MODE") == "ephemeral":
+                # Remove old user data and start from an empty working set
+                reset_user_data(email) # Changed to email as per file content
 
             session["user_id"] = email
 
-            # Create a new empty working file
-            save_user_data(email, {"documents": []}) # Changed to email as per file content
-
             return redirect("/dashboard")
 
         return render_template("login.html", error="ログイン失敗")
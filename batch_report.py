@@ -0,0 +1,130 @@
+# batch_report.py
+"""
+エクスポートしたドキュメントをまとめて採点する（必要なら並び順も最適化する）。
+
+入力はディレクトリ（.json / .ndjson / .jsonl / .zip を再帰的に探す）または
+それらのファイル。download_document・/documents/export と同じ形式を読める。
+結果は1ドキュメント1行の NDJSON で、入力の順に少しずつ書き出す。
+
+    python batch_report.py exports/ > report.ndjson
+    python batch_report.py documents.ndjson --optimize --budget-ms 500 --workers 8 -o report.ndjson
+"""
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Tuple
+
+from services.bulk_import import ImportFormatError, iter_uploaded_documents
+from services.services import attach_unit_scores, extract_red_units, optimize_document_units
+from domain_mapper import json_to_intent
+from optimizer import total_story_score
+
+INPUT_SUFFIXES = (".json", ".ndjson", ".jsonl", ".zip")
+# ワーカーあたり何件まで先に投入しておくか（入力全体をメモリに載せないため）
+_IN_FLIGHT_PER_WORKER = 4
+
+
+def iter_input_documents(paths) -> Iterator[Tuple[str, object]]:
+    """(ラベル, ドキュメント or ImportFormatError) を入力の順に返す"""
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+                if name.lower().endswith(INPUT_SUFFIXES)
+            )
+        else:
+            files = [path]
+
+        for file_path in files:
+            with open(file_path, "rb") as f:
+                try:
+                    for label, obj in iter_uploaded_documents(f, file_path):
+                        # zip のメンバー名にはどの zip かを付ける
+                        yield (label if label.startswith(file_path) else f"{file_path}!{label}"), obj
+                except ImportFormatError as e:
+                    yield file_path, e
+
+
+def report_document(label: str, document, optimize: bool = False, budget_ms: int | None = None) -> dict:
+    """1ドキュメント分の結果（ワーカープロセスで実行する）"""
+    if isinstance(document, ImportFormatError):
+        return {"source": label, "error": str(document)}
+    if not isinstance(document, dict) or not isinstance(document.get("units", []), list):
+        return {"source": label, "error": "ドキュメントとして読み込めません"}
+
+    try:
+        units = document.get("units", [])
+        scores = attach_unit_scores(document)
+        red_units = extract_red_units(document)
+
+        result = {
+            "source": label,
+            "id": document.get("id"),
+            "title": document.get("title"),
+            "unit_count": len(units),
+            "units": [
+                {"index": i, "title": unit.get("title"), **score}
+                for i, (unit, score) in enumerate(zip(units, scores))
+            ],
+            "red_units": [i for i, _ in red_units]
+        }
+
+        if optimize and len(units) >= 2:
+            intent = json_to_intent(document.get("intent"))
+            position = {id(unit): i for i, unit in enumerate(units)}
+            result["score_before"] = total_story_score(intent, units)
+            result["solver"] = optimize_document_units(document, budget_ms=budget_ms)
+            result["order"] = [position[id(unit)] for unit in document["units"]]
+            result["score_after"] = total_story_score(intent, document["units"])
+        return result
+    except Exception as e:
+        return {"source": label, "error": f"{type(e).__name__}: {e}"}
+
+
+def iter_reports(documents, workers: int, optimize: bool, budget_ms: int | None) -> Iterator[dict]:
+    """入力の順を保ったまま、プロセスプールで並列に採点した結果を返す"""
+    if workers <= 1:
+        for label, document in documents:
+            yield report_document(label, document, optimize, budget_ms)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for label, document in documents:
+            pending.append(pool.submit(report_document, label, document, optimize, budget_ms))
+            if len(pending) >= workers * _IN_FLIGHT_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="エクスポートしたドキュメントをまとめて採点する")
+    parser.add_argument("paths", nargs="+", help="ディレクトリ / .json / .ndjson / .jsonl / .zip")
+    parser.add_argument("--optimize", action="store_true", help="Unit の並び順も最適化する")
+    parser.add_argument("--budget-ms", type=int, default=None, help="最適化の1ドキュメントあたりの制限時間")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("-o", "--output", help="出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    failed = 0
+    try:
+        for report in iter_reports(iter_input_documents(args.paths), args.workers, args.optimize, args.budget_ms):
+            failed += "error" in report
+            out.write(json.dumps(report, ensure_ascii=False) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
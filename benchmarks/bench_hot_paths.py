@@ -0,0 +1,235 @@
+# bench_hot_paths.py
+"""
+採点・最適化・正規化・保存の処理時間を、合成ドキュメントの大きさ・言語ごとに測る。
+
+結果は JSON で書き出し、--baseline に渡した以前の結果と比べて遅くなったものを報告する
+（1つでもあれば終了コード 1）。基準の結果はマシンごとに取り直すこと。
+
+    python benchmarks/bench_hot_paths.py -o results.json
+    python benchmarks/bench_hot_paths.py --baseline benchmarks/baseline.json
+    python benchmarks/bench_hot_paths.py --presets blog,short_story --bench intent_alignment
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import user_files  # noqa: E402
+from corpus import PRESETS, LANGUAGES, generate_document  # noqa: E402
+from connection_scoring import score_unit_connection, np  # noqa: E402
+from domain_mapper import json_to_intent  # noqa: E402
+from optimizer import optimize_unit_order  # noqa: E402
+from services.scoring import score_intent_unit_alignment  # noqa: E402
+from services.services import normalize_composition_elements  # noqa: E402
+
+RESULTS_VERSION = 2
+# 最短時間（min_ms）がこの割合を超えて遅くなったら退行とみなす。
+# 中央値より他の処理の割り込みに左右されにくい。静かなマシンでは --threshold で厳しくしてよい
+DEFAULT_THRESHOLD = 0.5
+# 差がこれ未満（ミリ秒）なら計測の揺れとして無視する
+NOISE_FLOOR_MS = 1.0
+
+
+# =========================
+# 計測対象
+# =========================
+# 各ベンチマークは document を受け取り、(setup, run) を返す。
+# setup() の戻り値を run に渡す。setup は計測に含めない
+
+def _bench_intent_alignment(document):
+    intent = json_to_intent(document["intent"])
+    texts = [u["content"] for u in document["units"]]
+    return lambda: None, lambda _: [score_intent_unit_alignment(intent, t) for t in texts]
+
+
+def _bench_unit_connection(document):
+    texts = [u["content"] for u in document["units"]]
+    return lambda: None, lambda _: [score_unit_connection(a, b) for a, b in zip(texts, texts[1:])]
+
+
+def _bench_optimize_unit_order(document):
+    intent = json_to_intent(document["intent"])
+    units = document["units"]
+
+    def run(_):
+        random.seed(0)
+        optimize_unit_order(intent, units)
+    return lambda: None, run
+
+
+def _bench_normalize_composition_elements(document):
+    return lambda: copy.deepcopy(document), normalize_composition_elements
+
+
+def _bench_save_user_data(document):
+    counter = iter(range(10 ** 9))
+    data = {"documents": [document]}
+    # 毎回新しいユーザーに保存する（同じ内容の保存は差分が無く何も書かれないため）
+    return lambda: f"bench-save-{next(counter)}", lambda user_id: user_files.save_user_data(user_id, data)
+
+
+def _bench_load_user_data(document):
+    user_files.save_user_data("bench-load", {"documents": [document]})
+
+    def setup():
+        user_files._cache.clear()  # ファイルから読む（プロセス内キャッシュに当てない）
+        return "bench-load"
+    return setup, user_files.load_user_data
+
+
+BENCHMARKS = {
+    "intent_alignment": _bench_intent_alignment,
+    "unit_connection": _bench_unit_connection,
+    "optimize_unit_order": _bench_optimize_unit_order,
+    "normalize_composition_elements": _bench_normalize_composition_elements,
+    "save_user_data": _bench_save_user_data,
+    "load_user_data": _bench_load_user_data,
+}
+
+
+def measure(setup, run, repeat: int, min_time: float) -> list:
+    """
+    1回空回ししてから、少なくとも repeat 回、合計 min_time 秒を超えるまで計測する（上限 repeat * 10 回）
+    """
+    run(setup())
+    times = []
+    while len(times) < repeat or (sum(times) < min_time and len(times) < repeat * 10):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(presets, languages, names, repeat: int, min_time: float, seed: int) -> list:
+    results = []
+    for preset in presets:
+        for language in languages:
+            document = generate_document(preset, language, seed)
+            for name in names:
+                setup, run = BENCHMARKS[name](copy.deepcopy(document))
+                calibration_ms = calibrate()
+                times = measure(setup, run, repeat, min_time)
+                result = {
+                    "bench": name,
+                    "preset": preset,
+                    "language": language,
+                    "units": len(document["units"]),
+                    "runs": len(times),
+                    "median_ms": round(statistics.median(times) * 1000, 3),
+                    "min_ms": round(min(times) * 1000, 3),
+                    # 計測の直前と直後のマシンの速さ（compare で基準との速さの違いを打ち消す）
+                    "calibration_ms": round((calibration_ms + calibrate()) / 2, 3),
+                }
+                print(f"{name:<32} {preset:<12} {language}  {result['median_ms']:>10.2f} ms  (min {result['min_ms']:.2f}, n={result['runs']})")
+                results.append(result)
+    return results
+
+
+def calibrate(rounds: int = 3) -> float:
+    """
+    マシンの速さの目安（決まった純 Python の処理の最短時間, ms）。
+    基準を取ったときとの CPU の速さの違い（共有マシン・省電力）を比較で打ち消すために使う
+    """
+    rng = random.Random(0)
+    data = [rng.random() for _ in range(50_000)]
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        table = {}
+        for i, x in enumerate(sorted(data)):
+            table[i % 997] = table.get(i % 997, 0.0) + x
+        times.append(time.perf_counter() - start)
+    return round(min(times) * 1000, 3)
+
+
+# =========================
+# 基準との比較
+# =========================
+
+def _key(result) -> tuple:
+    return result["bench"], result["preset"], result["language"]
+
+
+def compare(results: list, baseline: list, threshold: float) -> list:
+    """
+    基準より遅くなった結果の (result, 基準の min_ms, 比率) のリスト。
+    基準の時間は、その項目を測ったときのマシンの速さの比（calibration_ms の比）で補正してから比べる
+    """
+    base = {_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = base.get(_key(result))
+        if before is None or before["min_ms"] <= 0:
+            continue
+        expected_ms = before["min_ms"] * result["calibration_ms"] / before["calibration_ms"]
+        ratio = result["min_ms"] / expected_ms
+        if ratio > 1 + threshold and result["min_ms"] - expected_ms >= NOISE_FLOOR_MS:
+            regressions.append((result, before["min_ms"], ratio))
+    return regressions
+
+
+def _csv(value: str, choices) -> list:
+    items = [v for v in value.split(",") if v]
+    unknown = [v for v in items if v not in choices]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown: {', '.join(unknown)} (choose from {', '.join(choices)})")
+    return items
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--presets", type=lambda v: _csv(v, PRESETS), default=list(PRESETS))
+    parser.add_argument("--languages", type=lambda v: _csv(v, LANGUAGES), default=list(LANGUAGES))
+    parser.add_argument("--bench", type=lambda v: _csv(v, BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="最低の計測回数")
+    parser.add_argument("--min-time", type=float, default=0.2, help="1項目あたりの最低の計測時間（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="結果の JSON の書き出し先")
+    parser.add_argument("--baseline", help="比べる基準の結果（以前の -o の出力）")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="退行とみなす遅くなりの割合")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        user_files.BASE_DIR = tmp
+        results = run_benchmarks(args.presets, args.languages, args.bench, args.repeat, args.min_time, args.seed)
+
+    report = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np is not None,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("version") != RESULTS_VERSION:
+        print(f"baseline version {baseline.get('version')} != {RESULTS_VERSION}; not compared")
+        return 0
+
+    regressions = compare(results, baseline["results"], args.threshold)
+    for result, before_ms, ratio in regressions:
+        print(f"REGRESSION {result['bench']} {result['preset']} {result['language']}: "
+              f"{before_ms:.2f} ms -> {result['min_ms']:.2f} ms (x{ratio:.2f} after scaling)")
+    print(f"{len(regressions)} regression(s) against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
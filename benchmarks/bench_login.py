@@ -0,0 +1,120 @@
+# bench_login.py
+"""
+ログイン時の users.db アクセスのスループットを比較する。
+
+  before: 毎回 sqlite3.connect（ロールバックジャーナル・接続は閉じない）
+  after : db.get_user_conn（WAL・接続プール・ステートメントキャッシュ）
+
+パスワードハッシュの検証（werkzeug の scrypt）は DB と無関係に重いので含めない。
+
+    python benchmarks/bench_login.py --threads 8 --logins 2000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import db  # noqa: E402
+
+
+def _seed(path, users):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE,
+        password_hash TEXT,
+        created_at TEXT
+    );
+    """)
+    conn.executemany(
+        "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, datetime('now'))",
+        [(f"user{i}@example.com", "x" * 100) for i in range(users)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def _login_before(path, email):
+    # 旧実装と同じく、接続を作って閉じずに捨てる
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
+
+
+def _login_after(path, email):
+    with db.get_user_conn() as conn:
+        conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
+
+
+def _register_before(path, email):
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, datetime('now'))",
+            (email, "x" * 100)
+        )
+        conn.commit()
+
+
+def _register_after(path, email):
+    with db.get_user_conn() as conn:
+        conn.execute(
+            "INSERT INTO users (email, password_hash, created_at) VALUES (?, ?, datetime('now'))",
+            (email, "x" * 100)
+        )
+
+
+def _run(label, fn, path, threads, total, email_for):
+    errors = []
+    per_thread = total // threads
+
+    def worker(t):
+        for i in range(per_thread):
+            try:
+                fn(path, email_for(t * per_thread + i))
+            except sqlite3.Error as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {per_thread * threads / elapsed:10.0f} ops/s   errors={len(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--logins", type=int, default=4000)
+    parser.add_argument("--registers", type=int, default=400)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_path = os.path.join(tmp, "before.db")
+        after_path = os.path.join(tmp, "after.db")
+        _seed(before_path, args.users)
+        _seed(after_path, args.users)
+        db.USER_DB_PATH = after_path
+
+        print(f"threads={args.threads} logins={args.logins} registers={args.registers}")
+        existing = lambda n: f"user{n % args.users}@example.com"
+        _run("login before", _login_before, before_path, args.threads, args.logins, existing)
+        _run("login after", _login_after, after_path, args.threads, args.logins, existing)
+        _run("register before", _register_before, before_path, args.threads, args.registers,
+             lambda n: f"new{n}@example.com")
+        _run("register after", _register_after, after_path, args.threads, args.registers,
+             lambda n: f"new{n}@example.com")
+        db.close_all_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# corpus.py
+"""
+ベンチマーク用の合成ドキュメントを作る（同じ seed なら同じドキュメントになる）。
+
+    from corpus import generate_document
+    document = generate_document("novel", "ja", seed=1)
+
+プリセットは Unit 数で、6 Unit のブログ記事から 2,000 Unit の連載小説まで。
+構成要素はメタ定義のカテゴリ・要素をすべて埋め、ユーザーが追加したカテゴリも含める。
+"""
+import copy
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from services.services import DEFAULT_COMPOSITION_META  # noqa: E402
+
+# プリセット名 → (doc_type, Unit 数, 1 Unit あたりの文の数)
+PRESETS = {
+    "blog": ("記事", 6, 6),
+    "short_story": ("小説", 40, 8),
+    "novel": ("小説", 300, 10),
+    "serial": ("小説", 2000, 10),
+}
+LANGUAGES = ("ja", "en")
+
+# ユーザーが追加した（メタ定義にない）構成要素カテゴリの数と、その要素数
+EXTRA_CATEGORIES = 4
+EXTRA_ELEMENTS = 12
+
+_JA = {
+    "subjects": ["彼女", "少年", "老人", "王女", "探偵", "魔法使い", "旅人", "姉", "先生", "猫"],
+    "objects": ["手紙", "剣", "地図", "鍵", "約束", "記憶", "秘密", "星", "扉", "花束"],
+    "places": ["駅", "森", "海辺", "図書館", "王国", "路地裏", "屋上", "教会", "港町", "雪原"],
+    "verbs": ["見つけた", "失った", "守った", "隠した", "思い出した", "探していた", "手放した", "待っていた"],
+    "adverbs": ["静かに", "ふいに", "ようやく", "まだ", "いつの間にか", "迷わず", "そっと"],
+    "times": ["夜明け前", "雨の日", "冬の朝", "祭りの夜", "十年後", "その夏"],
+}
+_EN = {
+    "subjects": ["she", "the boy", "an old man", "the princess", "the detective", "a wizard", "the traveler"],
+    "objects": ["a letter", "the sword", "a map", "the key", "a promise", "a memory", "the secret", "a star"],
+    "places": ["the station", "the forest", "the shore", "the library", "the kingdom", "the harbor"],
+    "verbs": ["found", "lost", "protected", "hid", "remembered", "searched for", "let go of", "waited for"],
+    "adverbs": ["quietly", "suddenly", "finally", "still", "without hesitation", "gently"],
+    "times": ["before dawn", "on a rainy day", "one winter morning", "on the festival night", "ten years later"],
+}
+
+_JA_GENRES = ["ファンタジー", "ミステリー", "恋愛", "SF", "歴史"]
+_EN_GENRES = ["fantasy", "mystery", "romance", "science fiction", "history"]
+
+
+def _sentence(rng: random.Random, language: str) -> str:
+    w = _JA if language == "ja" else _EN
+    subject, obj, place = rng.choice(w["subjects"]), rng.choice(w["objects"]), rng.choice(w["places"])
+    verb, adverb, time = rng.choice(w["verbs"]), rng.choice(w["adverbs"]), rng.choice(w["times"])
+    if language == "ja":
+        return f"{time}、{subject}は{place}で{obj}を{adverb}{verb}。"
+    return f"{time.capitalize()}, {subject} {adverb} {verb} {obj} at {place}."
+
+
+def _paragraph(rng: random.Random, language: str, sentences: int) -> str:
+    count = max(1, int(rng.gauss(sentences, sentences / 4)))
+    return ("" if language == "ja" else " ").join(_sentence(rng, language) for _ in range(count))
+
+
+def _intent(rng: random.Random, language: str) -> dict:
+    w = _JA if language == "ja" else _EN
+    genre = rng.choice(_JA_GENRES if language == "ja" else _EN_GENRES)
+    theme = " ".join(rng.sample(w["objects"], 2))
+    values = " ".join(rng.sample(w["objects"], 2))
+    return {
+        "genre": genre,
+        "theme_or_claim": theme,
+        "core_values": values,
+        "constraints": [rng.choice(w["places"]) for _ in range(3)],
+        "fields": {
+            "genre": {"label": "ジャンル", "value": genre},
+            "theme": {"label": "テーマ・主張", "value": theme},
+            "tone": {"label": "文体・トーン", "value": rng.choice(w["adverbs"])},
+        },
+    }
+
+
+def _fill_categories(rng: random.Random, categories: list, language: str) -> list:
+    filled = []
+    for category in categories:
+        filled.append({
+            "id": category["id"],
+            "label": category["label"],
+            "editable": category.get("editable", False),
+            "elements": [
+                {"id": element["id"], "label": element["label"], "value": _paragraph(rng, language, 2)}
+                for element in category.get("elements", [])
+            ]
+        })
+    for c in range(EXTRA_CATEGORIES):
+        filled.append({
+            "id": f"user_cat_{c}",
+            "label": f"追加カテゴリ{c}",
+            "editable": True,
+            "elements": [
+                {"id": f"user_el_{c}_{e}", "label": f"項目{e}", "value": _paragraph(rng, language, 2), "editable": True}
+                for e in range(EXTRA_ELEMENTS)
+            ]
+        })
+    return filled
+
+
+def generate_document(preset: str, language: str = "ja", seed: int = 0) -> dict:
+    """プリセットと言語から合成ドキュメントを1件作る"""
+    doc_type, unit_count, sentences = PRESETS[preset]
+    rng = random.Random(f"{preset}/{language}/{seed}")
+    meta = DEFAULT_COMPOSITION_META
+    doc_type_meta = next(
+        (m for m in meta["doc_types"].values() if m["label"] == doc_type),
+        {"categories": []}
+    )
+
+    return {
+        "id": f"{preset}-{language}-{seed}",
+        "title": f"{preset} ({language})",
+        "doc_type": doc_type,
+        "intent": _intent(rng, language),
+        "units": [
+            {"title": f"第{i + 1}節", "content": _paragraph(rng, language, sentences)}
+            for i in range(unit_count)
+        ],
+        "composition_elements": {
+            "common": {"categories": _fill_categories(rng, meta["common_categories"]["categories"], language)},
+            "doc_type_specific": {"categories": _fill_categories(rng, doc_type_meta["categories"], language)},
+        },
+        "composition_meta": copy.deepcopy(meta),
+    }
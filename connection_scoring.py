@@ -1,46 +1,133 @@
 # connection_scoring.py
-from typing import List
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Sequence, Tuple
+
+from minhash import signature, estimate_jaccard
+from text_tokenizers import get_tokenizer, word_tokens
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ connection_matrix は純 Python で計算する
+    np = None
+
+# 接続スコアに使うトークナイザ（text_tokenizers.TOKENIZERS のキー）
+TOKENIZER = "char_ngram"
+# connection_matrix での語彙の重なり（lexical）の測り方。1ペアずつのスコアは常に厳密に計算する。
+#   "auto"   : 厳密な計算より MinHash のほうが速い大きさ（MINHASH_MIN_UNITS・MINHASH_MIN_VOCAB 以上）
+#              のときだけ、MinHash 署名から見積もる
+#   "exact"  : 常にトークン集合の Jaccard 係数をそのまま計算する
+#   "minhash": 常に MinHash 署名から見積もる（見積もりの誤差の検証用）
+LEXICAL_SIMILARITY = "auto"
+# "auto" で MinHash を使う Unit 数と語彙（全 Unit のトークンの種類）の下限。
+# これより小さいと、署名の比較（ペアあたり K 回）より共通部分を数える行列積のほうが速い
+MINHASH_MIN_UNITS = 100
+MINHASH_MIN_VOCAB = 50_000
+
+# connection_matrix で語彙を何列ずつ密行列にするか（メモリ使用量の上限を決める）
+_MATRIX_VOCAB_BLOCK = 4096
+# connection_matrix で MinHash 署名を何行ずつ比較するか
+_MATRIX_SIGNATURE_BLOCK = 64
+# connection_matrix の1ペアあたりの時間の見積もり（ナノ秒、トークン化を含む。遅めのマシン・長めの Unit に合わせて多めに）。
+# 制限時間付きの最適化で、行列を作る時間があるかどうかの判断に使う
+_MATRIX_NS_PER_PAIR_NUMPY = 2_000
+_MATRIX_NS_PER_PAIR_PYTHON = 50_000
+# MinHash 署名を保持しておく本文の数（超えたら古いものから捨てる）
+SIGNATURE_CACHE_MAX_ENTRIES = 100_000
 
 
 def _tokenize(text: str) -> List[str]:
     """
-    非依存・軽量トークナイザ
+    非依存・軽量トークナイザ（語分割）
     """
-    if not text:
-        return []
-
-    separators = ["、", "。", ",", ".", "・", "\n"]
-    for sep in separators:
-        text = text.replace(sep, " ")
-
-    return [t.strip().lower() for t in text.split(" ") if t.strip()]
+    return word_tokens(text)
 
 
 def _jaccard_similarity(a: List[str], b: List[str]) -> float:
     """
     Jaccard 類似度（0.0〜1.0）
     """
-    set_a = set(a)
-    set_b = set(b)
+    return _jaccard_sets(frozenset(a), frozenset(b))
+
 
+def _jaccard_sets(set_a: FrozenSet[str], set_b: FrozenSet[str]) -> float:
     if not set_a or not set_b:
         return 0.0
 
     return len(set_a & set_b) / len(set_a | set_b)
 
 
-def score_unit_connection(unit_a_text: str, unit_b_text: str) -> float:
+@dataclass(frozen=True)
+class UnitTokens:
     """
-    Unit A → Unit B の接続スコア
+    接続スコアの計算に必要な Unit 側の情報（1 Unit につき1回だけ作る）
+    """
+    tokens: FrozenSet[str]
+    head: FrozenSet[str]   # 先頭のトークン（Tokenizer.edge_tokens 個）
+    tail: FrozenSet[str]   # 末尾のトークン（Tokenizer.edge_tokens 個）
+    length: int
+
+
+def tokenize_unit(text: str, tokenizer: str | None = None) -> UnitTokens:
+    """
+    tokenizer を省略すると TOKENIZER に従う
+    """
+    splitter = get_tokenizer(tokenizer or TOKENIZER)
+    tokens = splitter.split(text)
+    edge = splitter.edge_tokens
+    return UnitTokens(
+        tokens=frozenset(tokens),
+        head=frozenset(tokens[:edge]),
+        tail=frozenset(tokens[-edge:]),
+        length=len(tokens)
+    )
+
+
+# =========================
+# MinHash 署名（本文のハッシュごとに1回だけ作る）
+# =========================
+
+_signatures: "OrderedDict[tuple, Tuple[int, ...] | None]" = OrderedDict()
+_signatures_lock = threading.Lock()
+
+
+def unit_signature(text: str, unit: UnitTokens) -> Tuple[int, ...] | None:
     """
-    tokens_a = _tokenize(unit_a_text)
-    tokens_b = _tokenize(unit_b_text)
+    unit（text をトークン化したもの）の MinHash 署名。
+    (トークナイザ, 本文のハッシュ) ごとにキャッシュするので、同じ本文の署名は作り直さない
+    """
+    key = (TOKENIZER, hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).digest())
+    with _signatures_lock:
+        if key in _signatures:
+            _signatures.move_to_end(key)
+            return _signatures[key]
+
+    sig = signature(unit.tokens)
+    with _signatures_lock:
+        _signatures[key] = sig
+        while len(_signatures) > SIGNATURE_CACHE_MAX_ENTRIES:
+            _signatures.popitem(last=False)
+    return sig
+
+
+def clear_signature_cache() -> None:
+    with _signatures_lock:
+        _signatures.clear()
+
 
-    lexical_score = _jaccard_similarity(tokens_a, tokens_b)
-    topic_score = _jaccard_similarity(tokens_a[-10:], tokens_b[:10])
+def exact_jaccard(a: UnitTokens, b: UnitTokens) -> float:
+    """トークン集合の Jaccard 係数"""
+    return _jaccard_sets(a.tokens, b.tokens)
 
-    len_a = len(tokens_a)
-    len_b = len(tokens_b)
+
+def _combine(lexical_score: float, a: UnitTokens, b: UnitTokens) -> float:
+    topic_score = _jaccard_sets(a.tail, b.head)
+
+    len_a = a.length
+    len_b = b.length
 
     if max(len_a, len_b) == 0:
         length_score = 0.0
@@ -56,6 +143,20 @@ def score_unit_connection(unit_a_text: str, unit_b_text: str) -> float:
     return round(final_score, 3)
 
 
+def score_tokens_connection(a: UnitTokens, b: UnitTokens) -> float:
+    """
+    トークン化済みの Unit A → Unit B の接続スコア（score_unit_connection と同じ値）
+    """
+    return _combine(_jaccard_sets(a.tokens, b.tokens), a, b)
+
+
+def score_unit_connection(unit_a_text: str, unit_b_text: str) -> float:
+    """
+    Unit A → Unit B の接続スコア
+    """
+    return score_tokens_connection(tokenize_unit(unit_a_text), tokenize_unit(unit_b_text))
+
+
 def total_connection_score(units: List[dict]) -> float:
     """
     Unit 配列全体の接続スコア（隣接ペア合計）
@@ -63,11 +164,167 @@ def total_connection_score(units: List[dict]) -> float:
     if len(units) < 2:
         return 0.0
 
+    tokenized = [tokenize_unit(u.get("content", "")) for u in units]
+
     score = 0.0
     for i in range(len(units) - 1):
-        score += score_unit_connection(
-            units[i].get("content", ""),
-            units[i + 1].get("content", "")
-        )
+        score += score_tokens_connection(tokenized[i], tokenized[i + 1])
 
     return round(score, 3)
+
+
+# =========================
+# 全ペアの接続スコア行列
+# =========================
+
+def connection_matrix_estimated_ms(n: int) -> float:
+    """n 件の connection_matrix を作るのにかかる時間の見積もり（ミリ秒）"""
+    ns_per_pair = _MATRIX_NS_PER_PAIR_NUMPY if np is not None else _MATRIX_NS_PER_PAIR_PYTHON
+    return n * n * ns_per_pair / 1e6
+
+
+def _check_deadline(deadline: float | None) -> None:
+    if deadline is not None and time.perf_counter() >= deadline:
+        raise TimeoutError("connection_matrix did not finish before the deadline")
+
+
+def connection_matrix(texts: Sequence[str], exact: bool = False, deadline: float | None = None) -> List[List[float]]:
+    """
+    全 Unit ペアの接続スコア行列（matrix[i][j] = score_unit_connection(texts[i], texts[j])）。
+    各 Unit のトークン化は1回だけ。NumPy があれば集合の共通部分の大きさや
+    MinHash 署名の一致数を行列演算でまとめて数える。
+    語彙の重なりを MinHash で見積もるかは LEXICAL_SIMILARITY に従う（exact=True なら常に厳密に計算する）。
+    deadline（time.perf_counter() の値）を渡すと、それまでに作り終わらなければ TimeoutError
+    """
+    tokenized = []
+    for text in texts:
+        _check_deadline(deadline)
+        tokenized.append(tokenize_unit(text))
+    signatures = None
+    if not exact and _use_minhash(tokenized):
+        signatures = []
+        for text, unit in zip(texts, tokenized):
+            _check_deadline(deadline)
+            signatures.append(unit_signature(text, unit))
+
+    if np is not None and tokenized:
+        return _connection_matrix_numpy(tokenized, signatures, deadline).tolist()
+
+    matrix = []
+    for i, a in enumerate(tokenized):
+        _check_deadline(deadline)
+        if signatures is None:
+            matrix.append([score_tokens_connection(a, b) for b in tokenized])
+        else:
+            matrix.append([
+                _combine(estimate_jaccard(signatures[i], sig_b), a, b) for b, sig_b in zip(tokenized, signatures)
+            ])
+    return matrix
+
+
+def _use_minhash(tokenized: List[UnitTokens]) -> bool:
+    if LEXICAL_SIMILARITY == "minhash":
+        return True
+    if LEXICAL_SIMILARITY != "auto" or len(tokenized) < MINHASH_MIN_UNITS:
+        return False
+    return len(frozenset().union(*(unit.tokens for unit in tokenized))) >= MINHASH_MIN_VOCAB
+
+
+def _incidence(sets: List[FrozenSet[str]], vocab: Dict[str, int]):
+    """Unit × 語彙 の疎な出現表を (行, 列) の座標配列で返す"""
+    rows, cols = [], []
+    for i, tokens in enumerate(sets):
+        for token in tokens:
+            rows.append(i)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+
+def _intersection_counts(a, b, n: int, vocab_size: int, deadline: float | None):
+    """counts[i][j] = |A_i ∩ B_j|。語彙をブロックに分けて密行列の積で数える"""
+    rows_a, cols_a = a
+    rows_b, cols_b = b
+    counts = np.zeros((n, n), dtype=np.float64)
+
+    for start in range(0, vocab_size, _MATRIX_VOCAB_BLOCK):
+        _check_deadline(deadline)
+        stop = min(start + _MATRIX_VOCAB_BLOCK, vocab_size)
+        block_a = np.zeros((n, stop - start), dtype=np.float32)
+        block_b = np.zeros((n, stop - start), dtype=np.float32)
+        mask = (cols_a >= start) & (cols_a < stop)
+        block_a[rows_a[mask], cols_a[mask] - start] = 1.0
+        mask = (cols_b >= start) & (cols_b < stop)
+        block_b[rows_b[mask], cols_b[mask] - start] = 1.0
+        counts += block_a @ block_b.T  # 0/1 の和なので float32 でも誤差は出ない
+
+    return counts
+
+
+def _jaccard_matrix(inter, sizes_a, sizes_b):
+    size_a = sizes_a[:, None]
+    size_b = sizes_b[None, :]
+    union = size_a + size_b - inter
+    # _jaccard_sets と同じく、どちらかが空集合なら 0.0
+    return np.where((size_a > 0) & (size_b > 0), inter / np.maximum(union, 1), 0.0)
+
+
+def _signature_matrix(signatures, deadline: float | None):
+    """estimate_jaccard の全ペア版（署名が None の行・列は 0.0）"""
+    n = len(signatures)
+    present = np.array([sig is not None for sig in signatures])
+    width = len(next(sig for sig in signatures if sig is not None)) if present.any() else 1
+    sigs = np.array([sig if sig is not None else (0,) * width for sig in signatures], dtype=np.uint32)
+
+    matches = np.zeros((n, n), dtype=np.float64)
+    for start in range(0, n, _MATRIX_SIGNATURE_BLOCK):
+        _check_deadline(deadline)
+        stop = min(start + _MATRIX_SIGNATURE_BLOCK, n)
+        matches[start:stop] = (sigs[start:stop, None, :] == sigs[None, :, :]).sum(axis=2)
+
+    return np.where(present[:, None] & present[None, :], matches / width, 0.0)
+
+
+def _connection_matrix_numpy(tokenized: List[UnitTokens], signatures=None, deadline: float | None = None):
+    n = len(tokenized)
+
+    if signatures is not None:
+        lexical_score = _signature_matrix(signatures, deadline)
+    else:
+        vocab: Dict[str, int] = {}
+        tokens = _incidence([t.tokens for t in tokenized], vocab)
+        token_sizes = np.array([len(t.tokens) for t in tokenized], dtype=np.float64)
+        lexical_score = _jaccard_matrix(_intersection_counts(tokens, tokens, n, len(vocab), deadline), token_sizes, token_sizes)
+
+    # 先頭・末尾のトークンは全体の語彙より桁違いに少ないので、別の語彙で数える
+    edge_vocab: Dict[str, int] = {}
+    heads = _incidence([t.head for t in tokenized], edge_vocab)
+    tails = _incidence([t.tail for t in tokenized], edge_vocab)
+    head_sizes = np.array([len(t.head) for t in tokenized], dtype=np.float64)
+    tail_sizes = np.array([len(t.tail) for t in tokenized], dtype=np.float64)
+    topic_score = _jaccard_matrix(_intersection_counts(tails, heads, n, len(edge_vocab), deadline), tail_sizes, head_sizes)
+
+    lengths = np.array([t.length for t in tokenized], dtype=np.float64)
+    len_a = lengths[:, None]
+    len_b = lengths[None, :]
+    longest = np.maximum(len_a, len_b)
+    length_score = np.where(longest == 0, 0.0, 1.0 - np.abs(len_a - len_b) / np.maximum(longest, 1))
+
+    final_score = (
+        0.4 * lexical_score +
+        0.4 * topic_score +
+        0.2 * length_score
+    )
+    return _round3(final_score)
+
+
+def _round3(values):
+    """
+    round(x, 3) と同じ値に丸める。
+    np.round は 1000 倍してから丸めるため、ちょうど端数 0.5 付近だけ組み込みの round とずれることがある
+    """
+    rounded = np.round(values, 3)
+    scaled = values * 1000
+    near_tie = np.abs(np.abs(scaled - np.floor(scaled)) - 0.5) < 1e-6
+    for index in zip(*np.nonzero(near_tie)):
+        rounded[index] = round(float(values[index]), 3)
+    return rounded
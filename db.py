@@ -1,5 +1,154 @@
 # db.py
+import os
+import queue
 import sqlite3
+import threading
+import time
+
+import metrics
+
+# =========================
+# Connection Pool
+# =========================
+
+# ロック待ちの上限（秒）。書き込みが重なっても即 "database is locked" にしない
+BUSY_TIMEOUT_SECONDS = 5.0
+# 接続ごとにキャッシュするプリペアドステートメント数
+CACHED_STATEMENTS = 256
+# DB ファイルごとにプールしておく接続数の上限（超えた分は使い終わったら閉じる）
+POOL_SIZE = 8
+
+# クエリの時間（秒）のバケット。0.1ms 〜 5s
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+_query_seconds = metrics.histogram(
+    "storyforge_sqlite_query_duration_seconds",
+    "SQLite statement execution time (op is the leading SQL keyword; COMMIT is the transaction commit)",
+    ["db", "op"],
+    buckets=QUERY_BUCKETS
+)
+_connections_opened = metrics.counter(
+    "storyforge_sqlite_connections_opened_total", "SQLite connections opened", ["db"]
+)
+
+
+def _sql_op(sql) -> str:
+    words = str(sql).split(None, 1)
+    return words[0].upper() if words else ""
+
+
+class _TimedConnection(sqlite3.Connection):
+    """conn.execute / executemany / executescript の時間を計る（SELECT の fetch は含まない）"""
+
+    db_name = ""
+
+    def _timed(self, op, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            _query_seconds.observe(time.perf_counter() - start, db=self.db_name, op=op)
+
+    def execute(self, sql, *args):
+        return self._timed(_sql_op(sql), super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(_sql_op(sql), super().executemany, sql, *args)
+
+    def executescript(self, script):
+        return self._timed("SCRIPT", super().executescript, script)
+
+    def commit(self):
+        return self._timed("COMMIT", super().commit)
+
+
+def _connect(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,  # プールでスレッド間を移動する（同時に使うのは1スレッドだけ）
+        factory=_TimedConnection
+    )
+    conn.db_name = os.path.splitext(os.path.basename(path))[0]
+    _connections_opened.inc(db=conn.db_name)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # WAL ではコミットごとの fsync を省いても壊れない
+    return conn
+
+
+class _ConnectionPool:
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=POOL_SIZE)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _connect(self.path)
+
+    def release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(path):
+    with _pools_lock:
+        pool = _pools.get(path)
+        # fork 後の子プロセスは親の接続を使わない
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[path] = _ConnectionPool(path)
+        return pool
+
+
+class _PooledConnection:
+    """
+    with get_conn() as conn: の形で使う。
+    抜けるときに commit（例外なら rollback）して接続をプールに返す
+    """
+
+    def __init__(self, path):
+        self._pool = _get_pool(path)
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = self._pool.acquire()
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        conn, self._conn = self._conn, None
+        try:
+            if exc_type is None:
+                conn.commit()
+            else:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        self._pool.release(conn)
+        return False
+
+
+def close_all_connections():
+    """プール中の接続をすべて閉じる（テスト・シャットダウン用）"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                pool._idle.get_nowait().close()
+            except queue.Empty:
+                break
 
 # =========================
 # User DB (認証・アカウント)
@@ -9,9 +158,7 @@ USER_DB_PATH = "users.db"
 
 
 def get_user_conn():
-    conn = sqlite3.connect(USER_DB_PATH)
-    conn.row_factory = sqlite3.Row  # ★ ここが重要
-    return conn
+    return _PooledConnection(USER_DB_PATH)
 
 
 def init_user_db():
@@ -35,7 +182,7 @@ WRITING_DB_PATH = "writing.db"
 
 
 def get_conn():
-    return sqlite3.connect(WRITING_DB_PATH)
+    return _PooledConnection(WRITING_DB_PATH)
 
 
 def init_db():
@@ -45,7 +192,8 @@ def init_db():
             id TEXT PRIMARY KEY,
             title TEXT,
             synopsis TEXT,
-            doc_type TEXT DEFAULT 'novel'
+            doc_type TEXT DEFAULT 'novel',
+            source_etag TEXT
         );
 
         CREATE TABLE IF NOT EXISTS scene (
@@ -71,8 +219,100 @@ def init_db():
             story_id TEXT PRIMARY KEY,
             genre TEXT,
             theme_or_claim TEXT,
-            values TEXT,
+            "values" TEXT,
             constraints TEXT
         );
+
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_scene_story_order
+            ON scene (story_id, order_no);
+
+        CREATE INDEX IF NOT EXISTS idx_character_story
+            ON character (story_id);
+
+        -- 全文検索。1行 = タイトル・Unit・Intent の項目・構成要素の値の1つ
+        CREATE TABLE IF NOT EXISTS search_entry (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            story_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            ref TEXT NOT NULL,
+            label TEXT,
+            body TEXT
+        );
+
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_search_entry_story
+            ON search_entry (story_id, kind, ref);
+
+        CREATE INDEX IF NOT EXISTS idx_search_entry_user
+            ON search_entry (user_id);
+
+        -- 検索インデックスに取り込み済みのドキュメント（本文が空でも記録する）
+        CREATE TABLE IF NOT EXISTS search_document (
+            story_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_search_document_user
+            ON search_document (user_id);
+
+        -- trigram なら形態素解析なしで日本語の部分一致を引ける（3文字以上の語）
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+            label, body,
+            content='search_entry', content_rowid='id',
+            tokenize='trigram'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS search_entry_ai AFTER INSERT ON search_entry BEGIN
+            INSERT INTO search_fts (rowid, label, body) VALUES (new.id, new.label, new.body);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_entry_ad AFTER DELETE ON search_entry BEGIN
+            INSERT INTO search_fts (search_fts, rowid, label, body) VALUES ('delete', old.id, old.label, old.body);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS search_entry_au AFTER UPDATE ON search_entry BEGIN
+            INSERT INTO search_fts (search_fts, rowid, label, body) VALUES ('delete', old.id, old.label, old.body);
+            INSERT INTO search_fts (rowid, label, body) VALUES (new.id, new.label, new.body);
+        END;
+
+        -- 関連 Unit 検索のインデックス（プロセスごとのメモリ上）に取り込むべき変更。
+        -- 保存フックがドキュメントごとにユーザー内の通し番号を振り、検索時にはまだ見ていない番号の
+        -- ドキュメントだけを読み直す（他のプロセスでの保存・削除にもファイルを stat せずに追いつく）
+        CREATE TABLE IF NOT EXISTS unit_index_change (
+            user_id TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (user_id, doc_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_unit_index_change_seq
+            ON unit_index_change (user_id, seq);
+
+        -- 並び順の最適化ジョブ（どのワーカープロセスからも進捗の確認・キャンセル・適用ができるよう共有する）
+        CREATE TABLE IF NOT EXISTS optimize_job (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            version INTEGER,
+            unit_count INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            solver TEXT,
+            error TEXT,
+            initial_score REAL,
+            best_score REAL,
+            best_order TEXT NOT NULL,
+            steps INTEGER NOT NULL DEFAULT 0,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            started_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_optimize_job_state
+            ON optimize_job (state);
         """)
+        # source_etag より前に作られた writing.db には列を足す（NULL のままなら初回の参照で同期し直す）
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(story)")}
+        if "source_etag" not in columns:
+            conn.execute("ALTER TABLE story ADD COLUMN source_etag TEXT")
         conn.commit()
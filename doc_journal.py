@@ -0,0 +1,107 @@
+# doc_journal.py
+import json
+import os
+from typing import Any, List
+
+# 操作レコード（1行1レコードの NDJSON）:
+#   {"seq": 12, "ops": [["set", ["units", 3, "content"], "..."], ["del", ["intent", "fields", "x"]]]}
+# path は dict のキー（str）と list の添字（int）の並び。
+# list 末尾への追加は「len(list) の位置への set」で表す。
+
+
+def diff_document(old: Any, new: Any) -> List[list]:
+    """
+    old → new に変換する操作列を返す（変更がなければ空リスト）
+    """
+    # 大半の保存は「何も変わっていない」ので、まず C 実装の比較で済ませる
+    if type(old) is type(new) and old == new:
+        return []
+
+    ops: List[list] = []
+    _diff(old, new, [], ops)
+    return ops
+
+
+def _diff(old: Any, new: Any, path: list, ops: List[list]) -> None:
+    if type(old) is dict and type(new) is dict:
+        for key in old:
+            if key not in new:
+                ops.append(["del", path + [key]])
+        for key, value in new.items():
+            if key not in old:
+                ops.append(["set", path + [key], value])
+            else:
+                _diff(old[key], value, path + [key], ops)
+        return
+
+    if type(old) is list and type(new) is list and len(new) >= len(old):
+        for i in range(len(old)):
+            _diff(old[i], new[i], path + [i], ops)
+        for i in range(len(old), len(new)):
+            ops.append(["set", path + [i], new[i]])
+        return
+
+    # 1 == True のような型違いの一致は変更として扱う
+    if type(old) is not type(new) or old != new:
+        ops.append(["set", path, new])
+
+
+def apply_ops(document: Any, ops: List[list]) -> Any:
+    """
+    操作列を document に適用する（破壊的）。ルートの set があり得るので戻り値を使うこと
+    """
+    for op in ops:
+        kind, path = op[0], op[1]
+        if not path:
+            document = op[2] if kind == "set" else {}
+            continue
+
+        parent = document
+        for key in path[:-1]:
+            parent = parent[key]
+        last = path[-1]
+
+        if kind == "set":
+            if isinstance(parent, list) and last == len(parent):
+                parent.append(op[2])
+            else:
+                parent[last] = op[2]
+        elif kind == "del":
+            del parent[last]
+        else:
+            raise ValueError(f"unknown journal op: {kind!r}")
+    return document
+
+
+def append_record(path: str, record: dict) -> int:
+    """
+    レコードを1行追記して fsync する。追記後のファイルサイズを返す。
+    各レコードの前に改行を置くので、途中で落ちた書きかけの行があっても次のレコードは壊れない
+    """
+    line = "\n" + json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def read_records(path: str) -> List[dict]:
+    """
+    ジャーナルの全レコードを返す。ファイルが無ければ空。
+    壊れた行（クラッシュで書きかけになった行）は読み飛ばす
+    """
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
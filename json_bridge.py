@@ -2,7 +2,8 @@
 from typing import Dict
 
 from models import Document, Unit, Entity, Intent
-from services.services import (
+from domain_mapper import json_to_intent
+from services.repository import (
     get_document,
     list_units,
     list_entities,
@@ -83,13 +84,6 @@ def import_document_from_json(json_doc: Dict) -> str:
     # ---- Intent ----
     intent_json = json_doc.get("intent", {})
     if intent_json:
-        intent = Intent(
-            document_id=document_id,
-            genre=intent_json.get("genre", ""),
-            theme_or_claim=intent_json.get("theme_or_claim", ""),
-            values=intent_json.get("values", ""),
-            constraints=intent_json.get("constraints", [])
-        )
-        save_intent(intent)
+        save_intent(document_id, json_to_intent(intent_json))
 
     return document_id
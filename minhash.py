@@ -0,0 +1,58 @@
+# minhash.py
+import random
+import zlib
+from typing import Iterable, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ署名は純 Python で計算する（結果は同じ）
+    np = None
+
+# MinHash 署名: トークン集合ごとに K 個の「ハッシュの最小値」を持つ固定長の要約。
+# 2つの集合の Jaccard 係数は「署名の同じ位置の値が一致する割合」で見積もれる（O(K)）。
+# 誤差の標準偏差はおよそ sqrt(J(1-J)/K)（K=64 で最大 0.0625）。
+
+MINHASH_PERMUTATIONS = 64
+
+# h_i(x) = (a_i * x + b_i) mod 2^32（a_i は奇数なので 32 ビット値の置換になる）。
+# NumPy では uint32 の桁あふれがそのまま mod 2^32 になるので、剰余の計算が要らない
+_MASK = 0xFFFFFFFF
+# プロセスや実行をまたいで同じ署名になるよう、係数は固定の種から作る
+_SEED = 20240601
+
+
+def _coefficients(count: int) -> Tuple[List[int], List[int]]:
+    rng = random.Random(_SEED)
+    a = [rng.getrandbits(32) | 1 for _ in range(count)]
+    b = [rng.getrandbits(32) for _ in range(count)]
+    return a, b
+
+
+_A, _B = _coefficients(MINHASH_PERMUTATIONS)
+if np is not None:
+    _A_ARRAY = np.array(_A, dtype=np.uint32)[:, None]
+    _B_ARRAY = np.array(_B, dtype=np.uint32)[:, None]
+
+
+def _token_hash(token: str) -> int:
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def signature(tokens: Iterable[str]) -> Tuple[int, ...] | None:
+    """トークン集合の MinHash 署名（空集合なら None）"""
+    hashes = {_token_hash(token) for token in tokens}
+    if not hashes:
+        return None
+
+    if np is not None:
+        values = np.fromiter(hashes, dtype=np.uint32, count=len(hashes))[None, :]
+        return tuple((_A_ARRAY * values + _B_ARRAY).min(axis=1).tolist())
+
+    return tuple(min((a * x + b) & _MASK for x in hashes) for a, b in zip(_A, _B))
+
+
+def estimate_jaccard(sig_a: Sequence[int] | None, sig_b: Sequence[int] | None) -> float:
+    """署名から Jaccard 係数を見積もる（どちらかが空集合なら 0.0）"""
+    if sig_a is None or sig_b is None:
+        return 0.0
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
@@ -1,19 +1,47 @@
 # optimizer.py
 import math
+import os
 import random
-from typing import List
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
+from typing import Callable, List, Tuple
 
 from models import Intent
-from services.scoring import score_intent_unit_alignment
-from connection_scoring import total_connection_score
+from services.scoring import IntentMatcher
+from connection_scoring import (
+    total_connection_score, tokenize_unit, score_tokens_connection, connection_matrix, connection_matrix_estimated_ms
+)
+from order_solvers import HELD_KARP_MAX_UNITS, held_karp, held_karp_estimated_ms, local_search_from_greedy, greedy_order
+
+# 総合スコアの重み（調整可能）
+INTENT_WEIGHT = 0.6
+CONNECTION_WEIGHT = 0.4
+
+# これ以下の Unit 数なら接続スコア行列を最初にまとめて作る（超えたらペアごとに遅延計算）
+MATRIX_MAX_UNITS = 1000
+
+# 並び順の解法
+SOLVER_AUTO = "auto"
+SOLVER_HELD_KARP = "held_karp"        # 厳密解（HELD_KARP_MAX_UNITS 件まで）
+SOLVER_LOCAL_SEARCH = "local_search"  # 貪欲法 + 2-opt / Or-opt（MATRIX_MAX_UNITS 件まで）
+SOLVER_ANNEALING = "annealing"        # 擬似アニーリング
+SOLVER_ANYTIME = "anytime"            # 制限時間付きアニーリング（時間切れまでの最良解を返す）
+SOLVERS = (SOLVER_AUTO, SOLVER_HELD_KARP, SOLVER_LOCAL_SEARCH, SOLVER_ANNEALING, SOLVER_ANYTIME)
+
+# SOLVER_ANYTIME で budget_ms を省略したときの制限時間
+DEFAULT_BUDGET_MS = 200
 
 
 def total_intent_alignment_score(intent: Intent, units: List[dict]) -> float:
     """
     Intent × Unit 整合性スコア（合計）
     """
+    matcher = IntentMatcher(intent)
     return sum(
-        score_intent_unit_alignment(intent, u.get("content", ""))
+        matcher.score(u.get("content", ""))
         for u in units
     )
 
@@ -25,13 +53,127 @@ def total_story_score(intent: Intent, units: List[dict]) -> float:
     intent_score = total_intent_alignment_score(intent, units)
     connection_score = total_connection_score(units)
 
-    # 重み（調整可能）
     return (
-        0.6 * intent_score +
-        0.4 * connection_score
+        INTENT_WEIGHT * intent_score +
+        CONNECTION_WEIGHT * connection_score
     )
 
 
+class OrderEvaluator:
+    """
+    並び替えで変わらない量を一度だけ計算し、並び順のスコアを差分で求める。
+
+    - Unit ごとの Intent スコア: 並び順に依存しないので合計は定数
+    - Unit 間の接続スコア: connection_matrix で全ペアを一度に計算する
+      （Unit・語彙が多いと語彙の重なりは MinHash の見積もりになる。connection_scoring.LEXICAL_SIMILARITY）。
+      Unit が多すぎる場合と、deadline（time.perf_counter() の値）までに行列を作り終わらない場合は、
+      各 Unit を使うときに1回だけトークン化し、ペアごとに初回だけ計算してメモする
+
+    並び順は units の添字のリスト（order[k] = k 番目に置く Unit の添字）で表す。
+    """
+
+    def __init__(self, intent: Intent, units: List[dict], matrix: List[List[float]] = None, deadline: float = None):
+        matcher = IntentMatcher(intent)
+        contents = [u.get("content", "") for u in units]
+        self.n = len(units)
+        self.intent_scores = [matcher.score(content) for content in contents]
+        self.intent_total = sum(self.intent_scores)
+
+        if matrix is None and self.n <= MATRIX_MAX_UNITS:
+            matrix = _build_matrix(contents, deadline)
+        self.matrix = matrix
+        self._contents = None if matrix is not None else contents
+        self._tokens = None if matrix is not None else [None] * self.n
+        self._connections = {}
+
+    def _unit_tokens(self, k: int):
+        tokens = self._tokens[k]
+        if tokens is None:
+            tokens = self._tokens[k] = tokenize_unit(self._contents[k])
+        return tokens
+
+    def connection(self, a: int, b: int) -> float:
+        """Unit a → Unit b の接続スコア"""
+        if self.matrix is not None:
+            return self.matrix[a][b]
+        key = a * self.n + b
+        score = self._connections.get(key)
+        if score is None:
+            score = self._connections[key] = score_tokens_connection(self._unit_tokens(a), self._unit_tokens(b))
+        return score
+
+    def connection_total(self, order: List[int]) -> float:
+        return sum(self.connection(order[k], order[k + 1]) for k in range(len(order) - 1))
+
+    def score(self, order: List[int]) -> float:
+        """total_story_score と同じ重みの総合スコア（接続合計は丸めない）"""
+        return (
+            INTENT_WEIGHT * self.intent_total +
+            CONNECTION_WEIGHT * self.connection_total(order)
+        )
+
+    def _edges_sum(self, order: List[int], edges) -> float:
+        return sum(self.connection(order[k], order[k + 1]) for k in edges)
+
+    def swap_delta(self, order: List[int], i: int, j: int) -> float:
+        """
+        位置 i と j を入れ替えたときの総合スコアの増分（O(1)）。
+        変わるのは i, j に接する高々4本の隣接ペアだけ
+        """
+        if i == j:
+            return 0.0
+        last_edge = len(order) - 2
+        edges = {e for e in (i - 1, i, j - 1, j) if 0 <= e <= last_edge}
+
+        before = self._edges_sum(order, edges)
+        order[i], order[j] = order[j], order[i]
+        after = self._edges_sum(order, edges)
+        order[i], order[j] = order[j], order[i]
+
+        return CONNECTION_WEIGHT * (after - before)
+
+    def move_delta(self, order: List[int], i: int, j: int) -> float:
+        """
+        位置 i の Unit を抜いて、抜いた後の並びの位置 j に差し込んだときの総合スコアの増分（O(1)）
+        """
+        if i == j:
+            return 0.0
+        n = len(order)
+        unit = order[i]
+
+        # 抜く: 前後の辺を外し、前後を直接つなぐ
+        delta = 0.0
+        if i > 0:
+            delta -= self.connection(order[i - 1], unit)
+        if i < n - 1:
+            delta -= self.connection(unit, order[i + 1])
+        if 0 < i < n - 1:
+            delta += self.connection(order[i - 1], order[i + 1])
+
+        # 差し込む: 抜いた後の並び rest の rest[j-1] と rest[j] の間
+        def rest(k):
+            return order[k] if k < i else order[k + 1]
+
+        if j > 0:
+            delta += self.connection(rest(j - 1), unit)
+        if j < n - 1:
+            delta += self.connection(unit, rest(j))
+        if 0 < j < n - 1:
+            delta -= self.connection(rest(j - 1), rest(j))
+
+        return CONNECTION_WEIGHT * delta
+
+
+def _build_matrix(contents: List[str], deadline: float = None) -> List[List[float]] | None:
+    """deadline までに作り終わる見込みが無ければ作らず、作っている途中で過ぎたらやめて None"""
+    if deadline is not None and time.perf_counter() + connection_matrix_estimated_ms(len(contents)) / 1000 > deadline:
+        return None
+    try:
+        return connection_matrix(contents, deadline=deadline)
+    except TimeoutError:
+        return None
+
+
 def optimize_unit_order(
     intent: Intent,
     units: List[dict],
@@ -46,28 +188,323 @@ def optimize_unit_order(
     if len(units) < 2:
         return units
 
-    current = units[:]
-    best = units[:]
+    evaluator = OrderEvaluator(intent, units)
+    best = _anneal(evaluator, iterations, start_temp, end_temp)
+    return [units[k] for k in best]
 
-    current_score = total_story_score(intent, current)
+
+def _anneal(
+    evaluator: OrderEvaluator,
+    iterations: int,
+    start_temp: float,
+    end_temp: float,
+    rng=random,
+    initial: List[int] = None
+) -> List[int]:
+    """rng には random モジュールか random.Random を渡す"""
+    current = list(initial) if initial is not None else list(range(evaluator.n))
+    best = current[:]
+
+    current_score = evaluator.score(current)
     best_score = current_score
 
     for step in range(iterations):
         temp = start_temp + (end_temp - start_temp) * (step / iterations)
 
-        i, j = random.sample(range(len(units)), 2)
-        neighbor = current[:]
-        neighbor[i], neighbor[j] = neighbor[j], neighbor[i]
+        i, j = rng.sample(range(evaluator.n), 2)
+        delta = evaluator.swap_delta(current, i, j)
+
+        if delta > 0 or rng.random() < math.exp(delta / temp):
+            current[i], current[j] = current[j], current[i]
+            current_score += delta
+
+            if current_score > best_score:
+                best = current[:]
+                best_score = current_score
+
+    return best
+
+
+# =========================
+# 複数チェーンの並列アニーリング
+# =========================
+
+# ワーカープロセスごとに1つだけ持つ OrderEvaluator（initializer で受け取る）
+_worker_evaluator: OrderEvaluator = None
+
+
+def _init_worker(evaluator: OrderEvaluator) -> None:
+    global _worker_evaluator
+    _worker_evaluator = evaluator
+
+
+def _run_chain(
+    evaluator: OrderEvaluator,
+    chain_seed: int,
+    restart: int,
+    iterations: int,
+    start_temp: float,
+    end_temp: float
+) -> Tuple[List[int], float]:
+    """1本のチェーン。0本目は元の並び順から、それ以外はシャッフルした並び順から始める"""
+    rng = random.Random(chain_seed)
+    initial = list(range(evaluator.n))
+    if restart > 0:
+        rng.shuffle(initial)
+    best = _anneal(evaluator, iterations, start_temp, end_temp, rng=rng, initial=initial)
+    return best, evaluator.score(best)
+
 
-        neighbor_score = total_story_score(intent, neighbor)
-        delta = neighbor_score - current_score
+def _run_chain_in_worker(chain_seed, restart, iterations, start_temp, end_temp):
+    return _run_chain(_worker_evaluator, chain_seed, restart, iterations, start_temp, end_temp)
 
-        if delta > 0 or random.random() < math.exp(delta / temp):
-            current = neighbor
-            current_score = neighbor_score
 
+def anneal_restarts(
+    evaluator: OrderEvaluator,
+    restarts: int,
+    seed: int = None,
+    iterations: int = 500,
+    start_temp: float = 1.0,
+    end_temp: float = 0.01,
+    max_workers: int = None
+) -> List[int]:
+    """
+    独立に乱数を与えた restarts 本のチェーンをプロセスプールで並列に回し、最良の並び順を返す。
+
+    - 各チェーンの乱数の種は seed から順に引くので、seed が同じならワーカー数や
+      実行順によらず結果は同じ（同点なら先のチェーンを採る）
+    - スコア表（接続スコア行列・Intent スコア）は親で一度だけ計算し、
+      ワーカーの起動時に1回だけ渡す（チェーンごとには送らない）
+    """
+    master = random.Random(seed)
+    chain_seeds = [master.getrandbits(64) for _ in range(restarts)]
+    workers = min(restarts, max_workers or os.cpu_count() or 1)
+
+    if workers <= 1:
+        results = [
+            _run_chain(evaluator, chain_seed, restart, iterations, start_temp, end_temp)
+            for restart, chain_seed in enumerate(chain_seeds)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(evaluator,)) as pool:
+            results = list(pool.map(
+                _run_chain_in_worker,
+                chain_seeds, range(restarts),
+                repeat(iterations), repeat(start_temp), repeat(end_temp)
+            ))
+
+    best_order, _ = max(results, key=lambda result: result[1])
+    return best_order
+
+
+# =========================
+# 制限時間付きアニーリング
+# =========================
+
+# 時計を見る間隔（ステップ数）
+_CLOCK_CHECK_STEPS = 128
+# 受理率を測って温度を調整する間隔（ステップ数）
+_COOLING_WINDOW = 256
+# 悪化する交換の目標受理率。開始時から仕上げまでに幾何的に下げていく
+_INITIAL_ACCEPTANCE = 0.5
+_FINAL_ACCEPTANCE = 1e-4
+# 受理率が目標より高ければ温度にこれを掛け、低ければ割る
+_COOLING_FACTOR = 0.9
+# 制限時間のこの割合を過ぎたら最良解に戻り、改善する変更だけを受理する（仕上げ）
+_QUENCH_PROGRESS = 0.9
+# 受理率がこれ以下で、この回数（と Unit 数の定数倍の大きい方）だけ最良解が更新されなければ打ち切る
+_FROZEN_ACCEPTANCE = 1e-3
+_STAGNATION_STEPS = 5000
+_STAGNATION_STEPS_PER_UNIT = 100
+
+
+def _initial_temperature(evaluator: OrderEvaluator, order: List[int], rng, samples: int = 100) -> float:
+    """悪化する交換がおよそ _INITIAL_ACCEPTANCE の確率で受理される温度"""
+    worsening = []
+    for _ in range(samples):
+        i, j = rng.sample(range(evaluator.n), 2)
+        delta = evaluator.swap_delta(order, i, j)
+        if delta < 0:
+            worsening.append(-delta)
+    if not worsening:
+        return 1e-3
+    return (sum(worsening) / len(worsening)) / math.log(1 / _INITIAL_ACCEPTANCE)
+
+
+def anneal_within(
+    evaluator: OrderEvaluator,
+    deadline: float,
+    rng=random,
+    initial: List[int] = None,
+    on_progress: Callable[[List[int], float, int], None] = None,
+    cancel: threading.Event = None
+) -> List[int]:
+    """
+    time.perf_counter() が deadline に達するまでアニーリングし、それまでの最良の並び順を返す。
+    on_progress(最良の並び順, そのスコア, ステップ数) は温度の調整ごとに呼ばれ、
+    cancel がセットされたらその時点の最良解を返す。
+
+    - 温度は固定のスケジュールではなく、悪化する変更の受理率が目標値
+      （経過時間に応じて _INITIAL_ACCEPTANCE → _FINAL_ACCEPTANCE）に近づくように調整する
+    - 近傍は2つの Unit の交換と、1つの Unit の移動（抜いて別の位置に差し込む）を半々で使う
+    - 最後の (1 - _QUENCH_PROGRESS) は最良解から改善だけを受理して仕上げる
+    - 冷え切って（ほとんど悪化を受理しなくなって）から最良解がしばらく更新されなければ、
+      時間が残っていても打ち切る
+    """
+    start = time.perf_counter()
+    span = max(deadline - start, 1e-9)
+    current = list(initial) if initial is not None else list(range(evaluator.n))
+    best = current[:]
+    current_score = evaluator.score(current)
+    best_score = current_score
+
+    temp = _initial_temperature(evaluator, current, rng)
+    acceptance = _INITIAL_ACCEPTANCE
+    quenched = False
+    stagnation_limit = max(_STAGNATION_STEPS, _STAGNATION_STEPS_PER_UNIT * evaluator.n)
+    last_improvement = 0
+    worse_proposed = worse_accepted = 0
+
+    step = 0
+    while True:
+        if step % _CLOCK_CHECK_STEPS == 0:
+            progress = (time.perf_counter() - start) / span
+            if progress >= 1.0 or (cancel is not None and cancel.is_set()):
+                break
+            if progress >= _QUENCH_PROGRESS and not quenched:
+                current, current_score = best[:], best_score
+                quenched = True
+                acceptance = 0.0
+        if acceptance <= _FROZEN_ACCEPTANCE and step - last_improvement >= stagnation_limit:
+            break
+
+        i, j = rng.sample(range(evaluator.n), 2)
+        move = rng.random() < 0.5
+        delta = evaluator.move_delta(current, i, j) if move else evaluator.swap_delta(current, i, j)
+
+        accept = delta >= 0
+        if not accept and not quenched:
+            worse_proposed += 1
+            if rng.random() < math.exp(delta / temp):
+                accept = True
+                worse_accepted += 1
+
+        if accept:
+            if move:
+                current.insert(j, current.pop(i))
+            else:
+                current[i], current[j] = current[j], current[i]
+            current_score += delta
             if current_score > best_score:
-                best = neighbor
-                best_score = neighbor_score
+                best = current[:]
+                best_score = current_score
+                last_improvement = step
+
+        step += 1
+        if step % _COOLING_WINDOW == 0 and worse_proposed:
+            acceptance = worse_accepted / worse_proposed
+            target = _INITIAL_ACCEPTANCE * (_FINAL_ACCEPTANCE / _INITIAL_ACCEPTANCE) ** (progress / _QUENCH_PROGRESS)
+            if acceptance > target:
+                temp *= _COOLING_FACTOR
+            else:
+                temp /= _COOLING_FACTOR
+            temp = max(temp, 1e-9)
+            worse_proposed = worse_accepted = 0
+        if step % _COOLING_WINDOW == 0 and on_progress is not None:
+            on_progress(best, best_score, step)
 
+    if on_progress is not None:
+        on_progress(best, best_score, step)
     return best
+
+
+# =========================
+# 解法の自動選択
+# =========================
+
+@dataclass
+class OrderingResult:
+    units: List[dict]
+    solver: str    # 実際に使った解法（SOLVER_AUTO にはならない）
+    score: float   # 並び替え後の総合スコア（total_story_score と同じ重み・丸めなし）
+
+
+def choose_solver(unit_count: int, budget_ms: int = None) -> str:
+    """
+    Unit 数から解法を選ぶ。
+    短いドキュメントは厳密解、長いものは局所探索、行列を持てないほど長ければアニーリング。
+    制限時間があれば、厳密解がその半分（残りはスコア表の準備に充てる）で終わる見込みのとき以外は
+    制限時間付きアニーリング（NumPy が無い環境では厳密解に回す長さが短くなる）
+    """
+    if budget_ms is not None:
+        if unit_count <= HELD_KARP_MAX_UNITS and held_karp_estimated_ms(unit_count) <= budget_ms / 2:
+            return SOLVER_HELD_KARP
+        return SOLVER_ANYTIME
+    if unit_count <= HELD_KARP_MAX_UNITS:
+        return SOLVER_HELD_KARP
+    if unit_count <= MATRIX_MAX_UNITS:
+        return SOLVER_LOCAL_SEARCH
+    return SOLVER_ANNEALING
+
+
+def solve_unit_order(
+    intent: Intent,
+    units: List[dict],
+    solver: str = SOLVER_AUTO,
+    restarts: int = 1,
+    seed: int = None,
+    budget_ms: int = None,
+    on_progress: Callable[[List[int], float, int], None] = None,
+    cancel: threading.Event = None
+) -> OrderingResult:
+    """
+    Unit の並び順を最適化する（units は書き換えない）。
+    どの解法で解いたかを OrderingResult.solver で返す。
+    アニーリングは restarts 本のチェーンを並列に回し、seed を渡せば結果が再現できる。
+    制限時間付きアニーリング（solver が auto で budget_ms を渡した場合を含む）は、スコア表の準備も含めて
+    budget_ms 以内に返す。接続スコア行列はその半分までに作り終わるときだけ使い、間に合わなければ
+    ペアごとの遅延計算でアニーリングする。
+    on_progress / cancel は制限時間付きアニーリングのときだけ使う（anneal_within を参照）
+    """
+    started = time.perf_counter()
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver: {solver!r}")
+    if solver == SOLVER_AUTO:
+        solver = choose_solver(len(units), budget_ms)
+    if solver == SOLVER_HELD_KARP and len(units) > HELD_KARP_MAX_UNITS:
+        raise ValueError(f"held_karp supports up to {HELD_KARP_MAX_UNITS} units")
+    if solver == SOLVER_LOCAL_SEARCH and len(units) > MATRIX_MAX_UNITS:
+        raise ValueError(f"local_search supports up to {MATRIX_MAX_UNITS} units")
+
+    deadline = matrix_deadline = None
+    if solver == SOLVER_ANYTIME:
+        budget = budget_ms if budget_ms is not None else DEFAULT_BUDGET_MS
+        deadline = started + budget / 1000
+        matrix_deadline = started + budget / 2000
+
+    evaluator = OrderEvaluator(intent, units, deadline=matrix_deadline)
+    if len(units) < 2:
+        order = list(range(len(units)))
+    elif solver == SOLVER_HELD_KARP:
+        order = held_karp(evaluator.matrix)
+    elif solver == SOLVER_LOCAL_SEARCH:
+        order = local_search_from_greedy(evaluator.matrix, list(range(len(units))))
+    elif solver == SOLVER_ANYTIME:
+        initial = list(range(len(units)))
+        if evaluator.matrix is not None:
+            # 貪欲解の方が良ければそこから始める（O(n^2)、行列があるときだけ）
+            greedy = greedy_order(evaluator.matrix, 0)
+            if evaluator.score(greedy) > evaluator.score(initial):
+                initial = greedy
+        order = anneal_within(
+            evaluator, deadline, rng=random.Random(seed), initial=initial,
+            on_progress=on_progress, cancel=cancel
+        )
+    else:
+        order = anneal_restarts(evaluator, restarts=restarts, seed=seed)
+
+    return OrderingResult(
+        units=[units[k] for k in order],
+        solver=solver,
+        score=evaluator.score(order)
+    )
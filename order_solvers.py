@@ -0,0 +1,252 @@
+# order_solvers.py
+from typing import List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ Held-Karp は純 Python で解く
+    np = None
+
+# 接続スコア行列 matrix[a][b]（Unit a の直後に Unit b を置いたときのスコア）の上で、
+# 隣接スコアの合計が最大になる並び順（有向・始点終点自由のパス）を探す。
+# 並び順は Unit の添字のリスト。
+
+# Held-Karp（厳密解）で解く Unit 数の上限。計算量は O(2^n · n^2)
+# 15 件で NumPy 約 0.1 秒・純 Python 約 0.3 秒（STRUCTURE_TEMPLATES はすべてこの範囲）
+HELD_KARP_MAX_UNITS = 15
+# 1ステップ（2^n · n^2 のうちの1つ）あたりの時間の見積もり（ナノ秒、遅めのマシンに合わせて多めに）。
+# 制限時間付きの最適化で、厳密解が間に合うかどうかの判断に使う
+_HELD_KARP_NS_PER_STEP_NUMPY = 15
+_HELD_KARP_NS_PER_STEP_PYTHON = 60
+
+# 局所探索で「改善した」とみなす最小の増分（浮動小数点の誤差で往復しないように）
+_EPSILON = 1e-9
+# 局所探索の初期解を作る貪欲法の始点数
+_GREEDY_STARTS = 8
+# Or-opt で動かす区間の最大長
+_OR_OPT_MAX_SEGMENT = 3
+
+
+def path_score(matrix: Sequence[Sequence[float]], order: List[int]) -> float:
+    """並び順の隣接スコア合計"""
+    return sum(matrix[order[k]][order[k + 1]] for k in range(len(order) - 1))
+
+
+# =========================
+# Held-Karp（動的計画法）
+# =========================
+
+def held_karp_estimated_ms(n: int) -> float:
+    """n 件を Held-Karp で解くのにかかる時間の見積もり（ミリ秒）"""
+    ns_per_step = _HELD_KARP_NS_PER_STEP_NUMPY if np is not None else _HELD_KARP_NS_PER_STEP_PYTHON
+    return (1 << n) * n * n * ns_per_step / 1e6
+
+
+def held_karp(matrix: Sequence[Sequence[float]]) -> List[int]:
+    """
+    隣接スコア合計が最大の並び順（厳密解）
+    dp[S][j] = 集合 S を通り j で終わるパスの最大スコア
+    """
+    n = len(matrix)
+    if n < 2:
+        return list(range(n))
+    if np is not None:
+        return _held_karp_numpy(matrix, n)
+    return _held_karp_python(matrix, n)
+
+
+def _held_karp_python(matrix, n: int) -> List[int]:
+    full = (1 << n) - 1
+    neg_inf = float("-inf")
+    dp = [[neg_inf] * n for _ in range(full + 1)]
+    parent = [[-1] * n for _ in range(full + 1)]
+    for j in range(n):
+        dp[1 << j][j] = 0.0
+
+    members = [[i for i in range(n) if mask >> i & 1] for mask in range(full + 1)]
+    columns = [[matrix[i][j] for i in range(n)] for j in range(n)]
+
+    for mask in range(1, full + 1):
+        ends = members[mask]
+        if len(ends) < 2:
+            continue
+        row = dp[mask]
+        for j in ends:
+            prev_mask = mask ^ (1 << j)
+            prev_row = dp[prev_mask]
+            into_j = columns[j]
+            best, best_i = neg_inf, -1
+            for i in members[prev_mask]:
+                score = prev_row[i] + into_j[i]
+                if score > best:
+                    best, best_i = score, i
+            row[j] = best
+            parent[mask][j] = best_i
+
+    last = max(range(n), key=lambda j: dp[full][j])
+    return _backtrack(parent, full, last)
+
+
+def _held_karp_numpy(matrix, n: int) -> List[int]:
+    # 同じ要素数の集合をまとめて、終点 j ごとに直前 i の最大を一括で求める
+    full = (1 << n) - 1
+    scores = np.asarray(matrix, dtype=np.float64)
+    dp = np.full((full + 1, n), -np.inf)
+    parent = np.full((full + 1, n), -1, dtype=np.int8)
+    for j in range(n):
+        dp[1 << j, j] = 0.0
+
+    masks = np.arange(full + 1)
+    sizes = np.zeros(full + 1, dtype=np.int64)
+    for j in range(n):
+        sizes += (masks >> j) & 1
+
+    for size in range(2, n + 1):
+        layer = masks[sizes == size]
+        for j in range(n):
+            ending = layer[(layer >> j) & 1 == 1]
+            # 直前の集合には j が含まれないので dp[prev, j] は -inf のまま（i == j は選ばれない）
+            candidates = dp[ending ^ (1 << j)] + scores[:, j]
+            best_i = np.argmax(candidates, axis=1)
+            dp[ending, j] = candidates[np.arange(len(ending)), best_i]
+            parent[ending, j] = best_i
+
+    last = int(np.argmax(dp[full]))
+    return _backtrack(parent.tolist(), full, last)
+
+
+def _backtrack(parent, mask: int, last: int) -> List[int]:
+    order = []
+    while last >= 0:
+        order.append(last)
+        prev = parent[mask][last]
+        mask ^= 1 << last
+        last = prev
+    order.reverse()
+    return order
+
+
+# =========================
+# 貪欲法 + 局所探索（2-opt / Or-opt）
+# =========================
+
+def greedy_order(matrix: Sequence[Sequence[float]], start: int) -> List[int]:
+    """start から「次に繋げて最もスコアが高い Unit」を順に選ぶ"""
+    n = len(matrix)
+    order = [start]
+    remaining = set(range(n))
+    remaining.discard(start)
+    while remaining:
+        row = matrix[order[-1]]
+        nxt = max(remaining, key=lambda b: (row[b], -b))
+        order.append(nxt)
+        remaining.discard(nxt)
+    return order
+
+
+def local_search(matrix: Sequence[Sequence[float]], order: List[int], max_passes: int = 50) -> List[int]:
+    """
+    2-opt（区間の反転）と Or-opt（短い区間の移動）で改善が無くなるまで並び順を改善する。
+    order は書き換えずに新しいリストを返す
+    """
+    order = list(order)
+    if len(order) < 3:
+        if len(order) == 2 and matrix[order[1]][order[0]] > matrix[order[0]][order[1]] + _EPSILON:
+            order.reverse()
+        return order
+
+    for _ in range(max_passes):
+        reversed_any = _two_opt_pass(matrix, order)
+        moved_any = _or_opt_pass(matrix, order)
+        if not (reversed_any or moved_any):
+            break
+    return order
+
+
+def local_search_from_greedy(matrix: Sequence[Sequence[float]], initial: List[int], max_passes: int = 50) -> List[int]:
+    """
+    元の並び順と、いくつかの始点からの貪欲解のうち最良のものを初期解にして局所探索する
+    """
+    n = len(matrix)
+    candidates = [list(initial)]
+    step = max(1, n // _GREEDY_STARTS)
+    candidates += [greedy_order(matrix, start) for start in range(0, n, step)][:_GREEDY_STARTS]
+    start = max(candidates, key=lambda order: path_score(matrix, order))
+    return local_search(matrix, start, max_passes=max_passes)
+
+
+def _two_opt_pass(matrix, order: List[int]) -> bool:
+    """
+    区間 order[i..j] を反転する改善を探して適用する。
+    有向なので区間内の辺は逆向きになる。区間内の合計は前向き/後ろ向きの累積和で O(1) で求める
+    """
+    n = len(order)
+    improved = False
+    forward, backward = _edge_prefix_sums(matrix, order)
+
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            delta = (backward[j] - backward[i]) - (forward[j] - forward[i])
+            first, last = order[i], order[j]
+            if i > 0:
+                before = order[i - 1]
+                delta += matrix[before][last] - matrix[before][first]
+            if j < n - 1:
+                after = order[j + 1]
+                delta += matrix[first][after] - matrix[last][after]
+
+            if delta > _EPSILON:
+                order[i:j + 1] = order[i:j + 1][::-1]
+                forward, backward = _edge_prefix_sums(matrix, order)
+                improved = True
+    return improved
+
+
+def _edge_prefix_sums(matrix, order: List[int]):
+    """forward[k] = 先頭 k 本の辺の合計、backward[k] = 同じ辺を逆向きにたどった合計"""
+    forward = [0.0]
+    backward = [0.0]
+    for k in range(len(order) - 1):
+        a, b = order[k], order[k + 1]
+        forward.append(forward[-1] + matrix[a][b])
+        backward.append(backward[-1] + matrix[b][a])
+    return forward, backward
+
+
+def _or_opt_pass(matrix, order: List[int]) -> bool:
+    """長さ 1〜3 の区間を向きを変えずに別の位置へ移す改善を探して適用する"""
+    n = len(order)
+    improved = False
+
+    for length in range(1, min(_OR_OPT_MAX_SEGMENT, n - 1) + 1):
+        for i in range(n - length + 1):
+            segment = order[i:i + length]
+            head, tail = segment[0], segment[-1]
+            rest = order[:i] + order[i + length:]
+
+            # 区間を抜いたときの増分
+            removal = 0.0
+            if i > 0:
+                removal -= matrix[rest[i - 1]][head]
+            if i < len(rest):
+                removal -= matrix[tail][rest[i]]
+            if 0 < i < len(rest):
+                removal += matrix[rest[i - 1]][rest[i]]
+
+            best_delta, best_pos = _EPSILON, -1
+            for pos in range(len(rest) + 1):
+                if pos == i:
+                    continue
+                delta = removal
+                if pos > 0:
+                    delta += matrix[rest[pos - 1]][head]
+                if pos < len(rest):
+                    delta += matrix[tail][rest[pos]]
+                if 0 < pos < len(rest):
+                    delta -= matrix[rest[pos - 1]][rest[pos]]
+                if delta > best_delta:
+                    best_delta, best_pos = delta, pos
+
+            if best_pos >= 0:
+                order[:] = rest[:best_pos] + segment + rest[best_pos:]
+                improved = True
+    return improved
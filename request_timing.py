@@ -0,0 +1,160 @@
+# request_timing.py
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict
+
+# リクエストの中で「どの段階に何ミリ秒かかったか」を記録する。
+#   with span("load_document"): ...      （または @timed("load_document")）
+# 計測中のリクエストが無いとき（バッチ・ワーカープロセス・テスト）の span は何もしない。
+# 同じ名前の span は合計され、入れ子の span は外側にも含まれる（重ねて数える）。
+# 結果は Server-Timing ヘッダ・ルートごとの集計・遅いリクエストのログに出す。
+
+# この時間（ミリ秒）を超えたリクエストを段階の内訳付きでログに出す（0 なら出さない）
+SLOW_REQUEST_MS = float(os.environ.get("STORYFORGE_SLOW_REQUEST_MS", "1000"))
+# Server-Timing ヘッダに載せる段階の数の上限（時間の長い順）
+SERVER_TIMING_MAX_SPANS = 16
+
+
+class RequestTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, list] = {}   # 名前 → [合計秒, 回数]
+
+    def add(self, name: str, seconds: float) -> None:
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Server-Timing ヘッダの値（段階ごとの合計と total、単位はミリ秒）"""
+        spans = sorted(self.spans.items(), key=lambda item: -item[1][0])[:SERVER_TIMING_MAX_SPANS]
+        parts = [
+            f'{name};dur={seconds * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else "")
+            for name, (seconds, count) in spans
+        ]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar = ContextVar("request_timer", default=None)
+
+
+def start_request() -> RequestTimer:
+    timer = RequestTimer()
+    _current.set(timer)
+    return timer
+
+
+def current_timer() -> RequestTimer | None:
+    return _current.get()
+
+
+def end_request() -> RequestTimer | None:
+    timer = _current.get()
+    _current.set(None)
+    return timer
+
+
+@contextmanager
+def span(name: str):
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """関数全体を span(name) で囲むデコレータ"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timer = _current.get()
+            if timer is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timer.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+# =========================
+# ルートごとの集計
+# =========================
+
+class _RouteStats:
+    __slots__ = ("count", "total", "max", "spans")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.spans: Dict[str, list] = {}   # 名前 → [合計秒, 回数]
+
+
+_route_stats: Dict[str, _RouteStats] = {}
+_route_stats_lock = threading.Lock()
+
+
+def record(route: str, timer: RequestTimer, status: int | None = None) -> None:
+    """リクエストの計測結果をルートごとの集計に加え、遅ければログに出す"""
+    elapsed = timer.elapsed()
+    with _route_stats_lock:
+        stats = _route_stats.get(route)
+        if stats is None:
+            stats = _route_stats[route] = _RouteStats()
+        stats.count += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        for name, (seconds, count) in timer.spans.items():
+            entry = stats.spans.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += count
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        print("slow request " + json.dumps({
+            "route": route,
+            "status": status,
+            "ms": round(elapsed * 1000, 1),
+            "spans": {name: round(seconds * 1000, 1) for name, (seconds, _) in timer.spans.items()}
+        }, ensure_ascii=False))
+
+
+def route_summary() -> Dict[str, dict]:
+    """ルートごとの回数・平均・最大と、段階ごとの1リクエストあたりの平均（ミリ秒）"""
+    with _route_stats_lock:
+        return {
+            route: {
+                "count": stats.count,
+                "mean_ms": round(stats.total / stats.count * 1000, 2),
+                "max_ms": round(stats.max * 1000, 2),
+                "spans": {
+                    name: {"mean_ms": round(seconds / stats.count * 1000, 2), "calls": count}
+                    for name, (seconds, count) in stats.spans.items()
+                }
+            }
+            for route, stats in _route_stats.items()
+        }
+
+
+def reset_route_stats() -> None:
+    with _route_stats_lock:
+        _route_stats.clear()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# bulk_export.py
+import io
+import json
+import re
+import zipfile
+from typing import Iterable, Iterator
+
+# ファイル名に使えない文字
+_UNSAFE_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+def document_to_json(document: dict) -> str:
+    """1ドキュメント分のエクスポート（download_document と同じ形式）"""
+    return json.dumps(document, ensure_ascii=False, indent=2)
+
+
+def export_filename(document: dict) -> str:
+    title = _UNSAFE_FILENAME_CHARS.sub("_", document.get("title") or "untitled").strip() or "untitled"
+    return f"{title[:80]}-{document['id']}.json"
+
+
+def iter_ndjson(documents: Iterable[dict]) -> Iterator[bytes]:
+    """1ドキュメント1行の NDJSON を1件ずつ返す"""
+    for document in documents:
+        yield json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """zipfile の書き込み先。書かれたバイト列を溜めておき、まとめて取り出す"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(documents: Iterable[dict]) -> Iterator[bytes]:
+    """
+    1ドキュメント1ファイルの zip をメンバー単位で少しずつ返す。
+    書き込み先がシークできないので zipfile はデータディスクリプタ形式で書く
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for document in documents:
+            archive.writestr(export_filename(document), document_to_json(document))
+            chunk = buffer.pop()
+            if chunk:
+                yield chunk
+    yield buffer.pop()  # セントラルディレクトリ
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# bulk_import.py
+import codecs
+import json
+import re
+import zipfile
+from dataclasses import dataclass, field
+from typing import IO, Iterator, List, Tuple
+
+# アップロード全体の上限（app.config["MAX_CONTENT_LENGTH"] に設定する）
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+# 1ドキュメント（zip の1メンバー / NDJSON の1行）の上限
+MAX_DOCUMENT_BYTES = 32 * 1024 * 1024
+# 1回のアップロードで取り込むドキュメント数の上限
+MAX_IMPORT_DOCUMENTS = 10000
+# zip の1メンバーを展開した大きさの上限と、全メンバーの合計の上限（zip bomb 対策）。
+# ヘッダの展開後サイズは信用せず、展開しながら数える
+MAX_MEMBER_BYTES = MAX_UPLOAD_BYTES
+MAX_ARCHIVE_BYTES = 4 * MAX_UPLOAD_BYTES
+
+# UTF-8 で読めなければ Shift-JIS として読む（日本語環境でよくある保存形式）
+_ENCODINGS = ("utf-8-sig", "shift_jis")
+# 単一 JSON を読み進める単位（バイト）
+_CHUNK_BYTES = 64 * 1024
+# エンコーディングを決めるために先読みする上限（最初の非 ASCII バイトが現れるまで読む）
+_SNIFF_BYTES = 1024 * 1024
+_SNIFF_TAIL_BYTES = 64
+
+_ENCODING_ERROR = "ファイルのエンコーディングを認識できませんでした。UTF-8またはShift-JISで保存されていることを確認してください。"
+_TOO_LARGE_ERROR = "ドキュメントが大きすぎます"
+_EXPANDED_TOO_LARGE_ERROR = "zipの展開後のサイズが大きすぎます"
+_INVALID_JSON_ERROR = "無効なJSONファイルです"
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NON_ASCII = re.compile(rb"[\x80-\xff]")
+_NUMBER_CHARS = re.compile(r"[0-9.eE+\-]*")
+_DECODER = json.JSONDecoder()
+
+
+@dataclass
+class ImportResult:
+    imported_ids: List[str] = field(default_factory=list)
+    errors: List[Tuple[str, str]] = field(default_factory=list)  # (どのデータか, 理由)
+
+
+class ImportFormatError(ValueError):
+    """取り込めないデータ（エンコーディング・JSON 構文・サイズなど）"""
+
+
+def _decode(data: bytes) -> str:
+    for encoding in _ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ImportFormatError(_ENCODING_ERROR)
+
+
+def _validate(obj) -> str | None:
+    """ドキュメントとして取り込めない理由を返す（問題なければ None）"""
+    if not isinstance(obj, dict):
+        return "JSONオブジェクトではありません"
+    if "title" not in obj:
+        return "'title'キーが見つかりません"
+    if "units" in obj and not isinstance(obj["units"], list):
+        return "'units'が配列ではありません"
+    return None
+
+
+def _expand(label: str, obj) -> Iterator[Tuple[str, object]]:
+    # 旧 working.json 形式（アカウント全体のエクスポート）はドキュメントごとに展開する
+    if isinstance(obj, dict) and "title" not in obj and isinstance(obj.get("documents"), list):
+        for i, doc in enumerate(obj["documents"]):
+            yield f"{label}[{i}]", doc
+    else:
+        yield label, obj
+
+
+def _decoded_chunks(stream: IO[bytes]) -> Iterator[str]:
+    """
+    ストリームを少しずつデコードしたテキストを返す。エンコーディングは最初の非 ASCII バイトを
+    含む先頭部分で一度だけ決める（UTF-8 として読めなければ Shift-JIS）。全体を二度デコードしない
+    """
+    head = []
+    size = 0
+    non_ascii_at = None
+    # 最初の非 ASCII バイトの後ろも少し読む（Shift-JIS の1バイト目だけだと UTF-8 の途中とも読める）
+    while size < _SNIFF_BYTES and (non_ascii_at is None or size < non_ascii_at + _SNIFF_TAIL_BYTES):
+        chunk = stream.read(_CHUNK_BYTES)
+        if not chunk:
+            break
+        if non_ascii_at is None and not chunk.isascii():
+            non_ascii_at = size + _NON_ASCII.search(chunk).start()
+        head.append(chunk)
+        size += len(chunk)
+    head = b"".join(head)
+
+    for encoding in _ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            text = decoder.decode(head)
+        except UnicodeDecodeError:
+            continue
+        break
+    else:
+        raise ImportFormatError(_ENCODING_ERROR)
+
+    while True:
+        if text:
+            yield text
+        chunk = stream.read(_CHUNK_BYTES)
+        try:
+            text = decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError:
+            raise ImportFormatError(_ENCODING_ERROR)
+        if not chunk:
+            if text:
+                yield text
+            return
+
+
+class _JsonReader:
+    """デコード済みのテキストを読み足しながら、JSON の値を1つずつ取り出す"""
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buf = ""
+        self._pos = 0
+        self._base = 0   # _buf の先頭がテキスト全体の何文字目か
+        self._eof = False
+
+    @property
+    def offset(self) -> int:
+        return self._base + self._pos
+
+    def _read_more(self, at_least: int) -> bool:
+        """読み終えた部分を捨て、未読部分が at_least 文字以上増えるまで読み足す。増えなければ False"""
+        pending = self._buf[self._pos:]
+        self._base += self._pos
+        self._pos = 0
+        parts = [pending]
+        size = len(pending)
+        while size < len(pending) + at_least:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                break
+            parts.append(chunk)
+            size += len(chunk)
+        self._buf = "".join(parts)
+        return size > len(pending)
+
+    def peek(self) -> str:
+        """空白を読み飛ばした次の1文字。入力の終わりなら空文字列"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read_more(1):
+                return ""
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ImportFormatError(_INVALID_JSON_ERROR)
+        self._pos += 1
+
+    def value(self, limit: int):
+        """
+        次の値を1つパースする。パースに失敗したら未読部分を倍に増やして読み直す
+        （パースし直しの合計は値の長さに比例する）。値が limit 文字を超えたら ImportFormatError
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self._buf, self._pos)
+                # 数値は読み込んだ範囲の末尾で切れていても（"1500." → 1500）パースできてしまうので、
+                # 数値に使わない文字が続くのを確かめてから返す
+                if self._eof or _NUMBER_CHARS.match(self._buf, end).end() < len(self._buf):
+                    if end - self._pos > limit:
+                        raise ImportFormatError(_TOO_LARGE_ERROR)
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise ImportFormatError(_INVALID_JSON_ERROR)
+            pending = len(self._buf) - self._pos
+            if pending > limit:
+                raise ImportFormatError(_TOO_LARGE_ERROR)
+            self._read_more(max(pending, _CHUNK_BYTES))
+
+
+def _iter_array(reader: _JsonReader, label: str) -> Iterator[Tuple[str, object]]:
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.expect("]")
+        return
+    i = 0
+    while True:
+        yield f"{label}[{i}]", reader.value(MAX_DOCUMENT_BYTES)
+        i += 1
+        if reader.peek() != ",":
+            reader.expect("]")
+            return
+        reader.expect(",")
+
+
+def _iter_object(reader: _JsonReader, label: str) -> Iterator[Tuple[str, object]]:
+    """
+    トップレベルのオブジェクト。"title" より前に現れた "documents" 配列（旧 working.json 形式）は
+    要素を1つずつ返す。それ以外はドキュメント1件として、合わせて MAX_DOCUMENT_BYTES までを組み立てる
+    """
+    reader.expect("{")
+    obj = {}
+    size = 0
+    streamed = False
+    if reader.peek() == "}":
+        reader.expect("}")
+    else:
+        while True:
+            if reader.peek() != '"':
+                raise ImportFormatError(_INVALID_JSON_ERROR)
+            key = reader.value(MAX_DOCUMENT_BYTES)
+            reader.expect(":")
+            if key == "documents" and "title" not in obj and reader.peek() == "[":
+                yield from _iter_array(reader, label)
+                streamed = True
+            else:
+                start = reader.offset
+                obj[key] = reader.value(MAX_DOCUMENT_BYTES - size)
+                size += reader.offset - start
+                if size > MAX_DOCUMENT_BYTES:
+                    raise ImportFormatError(_TOO_LARGE_ERROR)
+            if reader.peek() != ",":
+                reader.expect("}")
+                break
+            reader.expect(",")
+    if not streamed:
+        yield from _expand(label, obj)
+
+
+def _iter_json(stream: IO[bytes], label: str) -> Iterator[Tuple[str, object]]:
+    """
+    単一 JSON。少しずつデコード・パースし、ファイル全体を文字列にもオブジェクトにもしない。
+    トップレベルの配列と旧 working.json 形式の "documents" は1件ずつ、それ以外は1件を
+    MAX_DOCUMENT_BYTES まで。ドキュメントを返し始めた後の構文エラーなどはその位置の
+    エラーとして返して読むのをやめる（それまでのドキュメントは取り込まれる）
+    """
+    reader = _JsonReader(_decoded_chunks(stream))
+    count = 0
+    try:
+        first = reader.peek()
+        if first == "[":
+            values = _iter_array(reader, label)
+        elif first == "{":
+            values = _iter_object(reader, label)
+        else:
+            values = iter([(label, reader.value(MAX_DOCUMENT_BYTES))])
+        for item in values:
+            count += 1
+            yield item
+        if reader.peek() != "":
+            raise ImportFormatError(_INVALID_JSON_ERROR)
+    except ImportFormatError as e:
+        if count == 0:
+            raise
+        yield f"{label}[{count}]", e
+
+
+def _iter_ndjson(stream: IO[bytes], label: str) -> Iterator[Tuple[str, object]]:
+    """NDJSON。1行ずつ読み、行ごとに検証する。MAX_DOCUMENT_BYTES を超える行は保持せずに読み飛ばす"""
+    line_no = 0
+    while True:
+        raw = stream.readline(MAX_DOCUMENT_BYTES + 1)
+        if not raw:
+            return
+        line_no += 1
+        line_label = f"{label}:{line_no}"
+        if len(raw) > MAX_DOCUMENT_BYTES:
+            while not raw.endswith(b"\n"):
+                raw = stream.readline(_CHUNK_BYTES)
+                if not raw:
+                    break
+            yield line_label, ImportFormatError(_TOO_LARGE_ERROR)
+            continue
+        if not raw.strip():
+            continue
+        try:
+            yield from _expand(line_label, json.loads(_decode(raw)))
+        except (ImportFormatError, json.JSONDecodeError) as e:
+            yield line_label, ImportFormatError(str(e))
+
+
+class _CountedReader:
+    """展開したバイト数を数えながら読む。limit を超えたら ImportFormatError"""
+
+    def __init__(self, raw: IO[bytes], limit: int):
+        self._raw = raw
+        self._limit = limit
+        self.read_bytes = 0
+
+    def _count(self, data: bytes) -> bytes:
+        self.read_bytes += len(data)
+        if self.read_bytes > self._limit:
+            raise ImportFormatError(_EXPANDED_TOO_LARGE_ERROR)
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        return self._count(self._raw.read(size))
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._count(self._raw.readline(size))
+
+
+def _iter_zip(stream: IO[bytes]) -> Iterator[Tuple[str, object]]:
+    """
+    zip。メンバーを1つずつ展開しながらパースする（全体は展開しない）。
+    展開したバイト数がメンバーで MAX_MEMBER_BYTES、合計で MAX_ARCHIVE_BYTES を超えたら読むのをやめる
+    """
+    expanded = 0
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith("__MACOSX/") or name.rsplit("/", 1)[-1].startswith("."):
+                continue
+            lower = name.lower()
+            if not lower.endswith((".json", ".ndjson", ".jsonl")):
+                continue
+            if expanded > MAX_ARCHIVE_BYTES:
+                yield name, ImportFormatError(_EXPANDED_TOO_LARGE_ERROR)
+                return
+            # ヘッダで大きすぎると分かるものは展開しない（小さいと書いてあっても数えながら読む）
+            if info.file_size > MAX_MEMBER_BYTES:
+                yield name, ImportFormatError(_EXPANDED_TOO_LARGE_ERROR)
+                continue
+
+            with archive.open(info) as raw:
+                member = _CountedReader(raw, min(MAX_MEMBER_BYTES, MAX_ARCHIVE_BYTES - expanded))
+                try:
+                    if lower.endswith(".json"):
+                        yield from _iter_json(member, name)
+                    else:
+                        yield from _iter_ndjson(member, name)
+                except ImportFormatError as e:
+                    yield name, e
+                finally:
+                    expanded += member.read_bytes
+
+
+def iter_uploaded_documents(stream: IO[bytes], filename: str) -> Iterator[Tuple[str, object]]:
+    """
+    アップロードされたファイルから (ラベル, ドキュメント or ImportFormatError) を順に返す。
+    形式は zip / NDJSON / 単一 JSON をファイル名と先頭バイトから判定する
+    """
+    lower = (filename or "").lower()
+    head = stream.read(4)
+    stream.seek(0)
+
+    if head.startswith(b"PK\x03\x04") or lower.endswith(".zip"):
+        try:
+            yield from _iter_zip(stream)
+        except zipfile.BadZipFile:
+            raise ImportFormatError("zipファイルを読み込めませんでした")
+    elif lower.endswith((".ndjson", ".jsonl")):
+        yield from _iter_ndjson(stream, filename)
+    else:
+        yield from _iter_json(stream, filename)
+
+
+def import_documents(stream: IO[bytes], filename: str, add_document) -> ImportResult:
+    """
+    ファイル内のドキュメントを検証しながら1件ずつ add_document(document) に渡す。
+    既存ドキュメントには触れない。ファイル全体が読めない場合は ImportFormatError
+    """
+    result = ImportResult()
+    for label, obj in iter_uploaded_documents(stream, filename):
+        if isinstance(obj, ImportFormatError):
+            result.errors.append((label, str(obj)))
+            continue
+
+        reason = _validate(obj)
+        if reason:
+            result.errors.append((label, reason))
+            continue
+
+        if len(result.imported_ids) >= MAX_IMPORT_DOCUMENTS:
+            result.errors.append((label, f"1回に取り込めるのは{MAX_IMPORT_DOCUMENTS}件までです"))
+            break
+
+        result.imported_ids.append(add_document(obj)["id"])
+    return result
@@ -1,8 +1,22 @@
 import google.genai as genai
 import openai
 import json
+import time
 from typing import Optional
 
+import metrics
+from request_timing import timed
+
+# LLM 呼び出しの時間は秒〜数十秒になるので、既定より上に広げたバケットを使う
+LLM_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+_llm_seconds = metrics.histogram(
+    "storyforge_llm_call_duration_seconds",
+    "LLM API call duration (outcome: ok / error)",
+    ["vendor", "outcome"],
+    buckets=LLM_BUCKETS
+)
+
 def _call_gemini_llm(api_key: str, model_name: str, prompt: str) -> dict:
     """
     Calls the Google Gemini LLM with the given API key, model name, and prompt.
@@ -60,16 +74,46 @@ def _call_openai_llm(api_key: str, model_name: str, prompt: str, base_url: Optio
         print(f"Error calling OpenAI LLM: {e}")
         raise RuntimeError(f"Failed to get response from OpenAI LLM: {e}")
 
+@timed("llm")
 def call_llm(api_key: str, model_name: str, prompt: str, base_url: Optional[str] = None) -> dict:
     """
-    Dispatches to the appropriate LLM client based on the model name and optional base_url.
+    Calls the LLM via _dispatch_llm and records the call duration per vendor and outcome.
+    """
+    vendor = _llm_vendor(model_name, base_url)
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = _dispatch_llm(vendor, api_key, model_name, prompt, base_url)
+        outcome = "ok"
+        return result
+    finally:
+        _llm_seconds.observe(time.perf_counter() - start, vendor=vendor, outcome=outcome)
+
+
+def _llm_vendor(model_name: str, base_url: Optional[str] = None) -> str:
+    """
+    Picks the vendor from the model name and optional base_url ("unknown" if none matches).
     """
     if base_url: # If base_url is provided, assume OpenAI-compatible API
         # Even if it's a Gemini model name, if base_url is given, prioritize OpenAI-compatible client
-        return _call_openai_llm(api_key, model_name, prompt, base_url)
+        return "openai_compatible"
     elif model_name.startswith("gpt") or model_name.startswith("text-davinci"):
-        return _call_openai_llm(api_key, model_name, prompt)
+        return "openai"
     elif model_name.startswith("gemini"):
+        return "gemini"
+    else:
+        return "unknown"
+
+
+def _dispatch_llm(vendor: str, api_key: str, model_name: str, prompt: str, base_url: Optional[str] = None) -> dict:
+    """
+    Dispatches to the client for the vendor chosen by _llm_vendor.
+    """
+    if vendor == "openai_compatible":
+        return _call_openai_llm(api_key, model_name, prompt, base_url)
+    elif vendor == "openai":
+        return _call_openai_llm(api_key, model_name, prompt)
+    elif vendor == "gemini":
         return _call_gemini_llm(api_key, model_name, prompt)
     else:
         raise ValueError(f"Unsupported LLM model vendor for model: {model_name}. Please specify a valid model name (e.g., 'gemini-pro' or 'gpt-3.5-turbo'), or provide a 'base_url' for OpenAI-compatible APIs.")
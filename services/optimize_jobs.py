@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# optimize_jobs.py
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import List
+
+from db import get_conn
+from domain_mapper import json_to_intent
+from optimizer import solve_unit_order, total_story_score
+
+# Unit 並び順の最適化をバックグラウンドで走らせるジョブ。
+# アニーリングは CPU を使い切るので、Web のワーカーとは別のプロセス（ProcessPoolExecutor）で動かす。
+# ジョブの状態（最良の並び順・スコア・キャンセルの要求）は writing.db の optimize_job に置き、
+# 複数のワーカープロセスで動かしても、どのプロセスに届いたリクエストからも
+# 進捗の確認・キャンセル・適用ができるようにする。
+
+# 1ジョブの制限時間（これより早く収束すれば打ち切られる）
+JOB_BUDGET_MS = 30_000
+# 同時に走らせるジョブ数の上限（全ワーカープロセスの合計。ワーカープロセスごとのプロセスプールの大きさも同じ）
+MAX_RUNNING_JOBS = 4
+# 終わったジョブを保持しておく時間（この間は結果を適用できる）
+FINISHED_JOB_TTL = 10 * 60
+# ジョブのプロセスが進捗を書き込み、キャンセルの要求を確かめる間隔（秒）
+PROGRESS_WRITE_INTERVAL = 0.5
+# 実行中なのにこの時間（秒）進捗が書き込まれないジョブは、プロセスごと落ちたものとみなす
+JOB_STALE_SECONDS = JOB_BUDGET_MS / 1000 + 30
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+
+STALE_JOB_ERROR = "最適化ジョブのプロセスが応答しません"
+SUPERSEDED_JOB_ERROR = "ドキュメントが更新されたため、新しいジョブに置き換えました"
+
+
+class TooManyJobsError(RuntimeError):
+    """同時に走らせられるジョブ数を超えた"""
+
+
+@dataclass
+class OptimizeJob:
+    """optimize_job の1行（読み出した時点の状態）"""
+    id: str
+    user_id: str
+    doc_id: str
+    version: int            # 開始時のドキュメントのバージョン（適用時に照合する）
+    unit_count: int
+    state: str
+    solver: str | None
+    error: str | None
+    initial_score: float | None
+    best_score: float | None
+    best_order: List[int]
+    steps: int
+    started_at: float
+    finished_at: float | None
+
+    def snapshot(self) -> dict:
+        """進捗（SSE・JSON 応答用）"""
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "solver": self.solver,
+            "error": self.error,
+            "units": self.unit_count,
+            "initial_score": self.initial_score,
+            "best_score": self.best_score,
+            "steps": self.steps,
+            "steps_per_second": round(self.steps / elapsed) if elapsed > 0 else 0,
+            "elapsed": round(elapsed, 2)
+        }
+
+    def reorder(self, units: List[dict]) -> List[dict]:
+        """読み出した時点の最良の並び順に units を並べ替えたリスト"""
+        return [units[k] for k in self.best_order]
+
+
+def _row_to_job(row, now: float) -> OptimizeJob:
+    job = OptimizeJob(
+        id=row["id"],
+        user_id=row["user_id"],
+        doc_id=row["doc_id"],
+        version=row["version"],
+        unit_count=row["unit_count"],
+        state=row["state"],
+        solver=row["solver"],
+        error=row["error"],
+        initial_score=row["initial_score"],
+        best_score=row["best_score"],
+        best_order=json.loads(row["best_order"]),
+        steps=row["steps"],
+        started_at=row["started_at"],
+        finished_at=row["finished_at"]
+    )
+    if job.state == JOB_RUNNING and now - row["updated_at"] > JOB_STALE_SECONDS:
+        # 行の書き換えは次の start_job の _expire に任せる
+        job.state, job.error, job.finished_at = JOB_FAILED, STALE_JOB_ERROR, row["updated_at"]
+    return job
+
+
+# =========================
+# ジョブのプロセスの中
+# =========================
+
+def _finish(job_id: str, state: str, **fields) -> None:
+    """走っているジョブだけを閉じる（置き換え・期限切れで先に閉じられた行は書き換えない）"""
+    now = time.time()
+    if "best_order" in fields:
+        fields["best_order"] = json.dumps(fields["best_order"])
+    columns = "".join(f"{name}=?, " for name in fields)
+    with get_conn() as conn:
+        conn.execute(
+            f"UPDATE optimize_job SET {columns}state=?, finished_at=?, updated_at=? WHERE id=? AND state=?",
+            (*fields.values(), state, now, now, job_id, JOB_RUNNING)
+        )
+
+
+class _JobReporter:
+    """進捗を optimize_job に書き込み、キャンセルの要求を読む（PROGRESS_WRITE_INTERVAL ごと）"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.cancel_event = threading.Event()
+        self.steps = 0
+        self._last_write = 0.0
+
+    def on_progress(self, best_order: List[int], best_score: float, steps: int) -> None:
+        self.steps = steps
+        now = time.time()
+        if now - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_write = now
+        with get_conn() as conn:
+            conn.execute(
+                "UPDATE optimize_job SET best_order=?, best_score=?, steps=?, updated_at=? WHERE id=? AND state=?",
+                (json.dumps(best_order), best_score, steps, now, self.job_id, JOB_RUNNING)
+            )
+            row = conn.execute("SELECT cancel_requested FROM optimize_job WHERE id=?", (self.job_id,)).fetchone()
+        if row is None or row["cancel_requested"]:
+            self.cancel_event.set()
+
+
+def _run_job(job_id: str, document: dict) -> None:
+    """ジョブのプロセスで動く。結果は optimize_job に書き込む"""
+    units = document.get("units", [])
+    reporter = _JobReporter(job_id)
+    try:
+        intent = json_to_intent(document.get("intent"))
+        initial_score = total_story_score(intent, units)
+        with get_conn() as conn:
+            conn.execute(
+                "UPDATE optimize_job SET initial_score=?, best_score=?, updated_at=? WHERE id=?",
+                (initial_score, initial_score, time.time(), job_id)
+            )
+        result = solve_unit_order(
+            intent, units,
+            budget_ms=JOB_BUDGET_MS,
+            on_progress=reporter.on_progress,
+            cancel=reporter.cancel_event
+        )
+        # units は同じ dict を並べ替えたものなので、添字の並びに戻す
+        position = {id(unit): k for k, unit in enumerate(units)}
+        _finish(
+            job_id,
+            JOB_CANCELLED if reporter.cancel_event.is_set() else JOB_DONE,
+            solver=result.solver,
+            best_order=[position[id(unit)] for unit in result.units],
+            best_score=result.score,
+            steps=reporter.steps
+        )
+    except Exception as e:
+        _finish(job_id, JOB_FAILED, error=str(e))
+
+
+# =========================
+# Web のワーカープロセス側
+# =========================
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _submit(job_id: str, document: dict):
+    """プロセスプールにジョブを投入する。プールのプロセスが落ちて使えなくなっていたら作り直す"""
+    global _executor
+    while True:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(max_workers=MAX_RUNNING_JOBS)
+            executor = _executor
+        try:
+            return executor.submit(_run_job, job_id, document)
+        except BrokenProcessPool:
+            with _executor_lock:
+                if _executor is executor:
+                    _executor = None
+
+
+def _on_job_exit(job_id: str, future) -> None:
+    """プロセスごと落ちた（_run_job が結果を書けなかった）ジョブを失敗にする"""
+    error = future.exception()
+    if error is not None:
+        _finish(job_id, JOB_FAILED, error=str(error) or type(error).__name__)
+
+
+def _expire(conn, now: float) -> None:
+    conn.execute(
+        "UPDATE optimize_job SET state=?, error=?, finished_at=updated_at WHERE state=? AND updated_at<?",
+        (JOB_FAILED, STALE_JOB_ERROR, JOB_RUNNING, now - JOB_STALE_SECONDS)
+    )
+    conn.execute(
+        "DELETE FROM optimize_job WHERE finished_at IS NOT NULL AND finished_at<?",
+        (now - FINISHED_JOB_TTL,)
+    )
+
+
+def start_job(user_id: str, doc_id: str, version: int, document: dict) -> OptimizeJob:
+    """
+    ジョブを開始する。同じドキュメントの同じバージョンで走っているジョブがあればそれを返す。
+    古いバージョンで走っているジョブはキャンセルして閉じ、新しいジョブを始める
+    （古い並び順は適用できないので、待たせても意味がない）
+    """
+    now = time.time()
+    unit_count = len(document.get("units", []))
+    with get_conn() as conn:
+        # 走っているジョブを数えてから登録するまでを、他のワーカープロセスと排他にする
+        conn.execute("BEGIN IMMEDIATE")
+        _expire(conn, now)
+        row = conn.execute(
+            "SELECT * FROM optimize_job WHERE user_id=? AND doc_id=? AND state=?",
+            (user_id, doc_id, JOB_RUNNING)
+        ).fetchone()
+        if row is not None:
+            if row["version"] == version:
+                return _row_to_job(row, now)
+            # ジョブのプロセスは次に進捗を書き込むときに止まる。行はここで閉じ、上限の数からも外す
+            conn.execute(
+                "UPDATE optimize_job SET cancel_requested=1, state=?, error=?, finished_at=?, updated_at=? "
+                "WHERE id=?",
+                (JOB_CANCELLED, SUPERSEDED_JOB_ERROR, now, now, row["id"])
+            )
+        running = conn.execute(
+            "SELECT COUNT(*) FROM optimize_job WHERE state=?", (JOB_RUNNING,)
+        ).fetchone()[0]
+        if running >= MAX_RUNNING_JOBS:
+            raise TooManyJobsError()
+
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO optimize_job (id, user_id, doc_id, version, unit_count, state, best_order, "
+            "started_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, user_id, doc_id, version, unit_count, JOB_RUNNING,
+             json.dumps(list(range(unit_count))), now, now)
+        )
+        row = conn.execute("SELECT * FROM optimize_job WHERE id=?", (job_id,)).fetchone()
+
+    try:
+        future = _submit(job_id, document)
+    except Exception as e:
+        _finish(job_id, JOB_FAILED, error=str(e))
+        raise
+    future.add_done_callback(lambda f: _on_job_exit(job_id, f))
+    return _row_to_job(row, now)
+
+
+def get_job(user_id: str, doc_id: str, job_id: str) -> OptimizeJob | None:
+    """他のユーザー・他のドキュメントのジョブは見えない"""
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT * FROM optimize_job WHERE id=? AND user_id=? AND doc_id=?",
+            (job_id, user_id, doc_id)
+        ).fetchone()
+    return _row_to_job(row, time.time()) if row is not None else None
+
+
+def cancel_job(user_id: str, doc_id: str, job_id: str) -> OptimizeJob | None:
+    """
+    キャンセルを要求する。ジョブのプロセスが次に進捗を書き込むときに止まる
+    （PROGRESS_WRITE_INTERVAL 以内）
+    """
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE optimize_job SET cancel_requested=1 WHERE id=? AND user_id=? AND doc_id=? AND state=?",
+            (job_id, user_id, doc_id, JOB_RUNNING)
+        )
+    return get_job(user_id, doc_id, job_id)
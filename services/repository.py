@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# repository.py
+import json
+import uuid
+from typing import List
+
+from db import get_conn
+from models import Document, Unit, Entity, Intent
+from domain_mapper import json_to_intent
+
+# writing.db は JSON ストア（user_files）のミラー。
+# story.id はユーザー間で衝突しないよう "<user_id>/<doc_id>" にする。
+# Unit の本文は scene.summary に、並び順は scene.order_no に入る。
+# story.source_etag は同期した時点の JSON ストアの ETag（user_files.get_document_etag）。
+# 保存フックの失敗や他のプロセスでの保存で遅れたミラーを、参照時に見分けるために使う。
+
+
+def story_id_for(user_id: str, doc_id: str) -> str:
+    return f"{user_id}/{doc_id}"
+
+
+def _row_to_unit(row) -> Unit:
+    return Unit(
+        id=row["id"],
+        document_id=row["story_id"],
+        title=row["title"] or "",
+        summary=row["summary"] or "",
+        order_no=row["order_no"],
+        time_start=row["time_start"],
+        time_end=row["time_end"],
+        location=row["location"] or ""
+    )
+
+
+# =========================
+# Document
+# =========================
+
+def get_document(document_id: str) -> Document | None:
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT id, title, synopsis, doc_type FROM story WHERE id=?",
+            (document_id,)
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    return Document(
+        id=row["id"],
+        title=row["title"] or "",
+        synopsis=row["synopsis"] or "",
+        doc_type=row["doc_type"] or ""
+    )
+
+
+def get_source_etag(document_id: str) -> str | None:
+    """最後に同期したときの JSON ストアの ETag。ミラーに無ければ None"""
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT source_etag FROM story WHERE id=?",
+            (document_id,)
+        ).fetchone()
+    return row["source_etag"] if row is not None else None
+
+
+def delete_document(document_id: str) -> None:
+    with get_conn() as conn:
+        conn.execute("DELETE FROM scene WHERE story_id=?", (document_id,))
+        conn.execute("DELETE FROM character WHERE story_id=?", (document_id,))
+        conn.execute("DELETE FROM author_context WHERE story_id=?", (document_id,))
+        conn.execute("DELETE FROM story WHERE id=?", (document_id,))
+
+
+# =========================
+# Unit
+# =========================
+
+def list_units(document_id: str) -> List[Unit]:
+    """order_no 順の Unit 一覧（idx_scene_story_order を使う）"""
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT * FROM scene WHERE story_id=? ORDER BY order_no",
+            (document_id,)
+        ).fetchall()
+    return [_row_to_unit(r) for r in rows]
+
+
+def get_unit(document_id: str, order_no: int) -> Unit | None:
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT * FROM scene WHERE story_id=? AND order_no=?",
+            (document_id, order_no)
+        ).fetchone()
+    return _row_to_unit(row) if row is not None else None
+
+
+def create_unit(document_id: str, title: str, summary: str, order_no: int) -> Unit:
+    unit = Unit(
+        id=uuid.uuid4().hex,
+        document_id=document_id,
+        title=title,
+        summary=summary,
+        order_no=order_no
+    )
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO scene (id, story_id, title, summary, order_no) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (unit.id, unit.document_id, unit.title, unit.summary, unit.order_no)
+        )
+    return unit
+
+
+def update_unit(
+    document_id: str,
+    order_no: int,
+    title: str | None = None,
+    summary: str | None = None
+) -> Unit | None:
+    """
+    Unit を1件だけ更新する。存在しなければ None
+    """
+    with get_conn() as conn:
+        cur = conn.execute(
+            "UPDATE scene SET title=COALESCE(?, title), summary=COALESCE(?, summary) "
+            "WHERE story_id=? AND order_no=?",
+            (title, summary, document_id, order_no)
+        )
+        if cur.rowcount == 0:
+            return None
+        row = conn.execute(
+            "SELECT * FROM scene WHERE story_id=? AND order_no=?",
+            (document_id, order_no)
+        ).fetchone()
+    return _row_to_unit(row)
+
+
+# =========================
+# Entity
+# =========================
+
+def list_entities(document_id: str) -> List[Entity]:
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT * FROM character WHERE story_id=?",
+            (document_id,)
+        ).fetchall()
+    return [
+        Entity(
+            id=r["id"],
+            document_id=r["story_id"],
+            name=r["name"] or "",
+            role=r["role"] or "",
+            description=r["description"] or ""
+        )
+        for r in rows
+    ]
+
+
+def create_entity(document_id: str, name: str, role: str, description: str) -> Entity:
+    entity = Entity(
+        id=uuid.uuid4().hex,
+        document_id=document_id,
+        name=name,
+        role=role,
+        description=description
+    )
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO character (id, story_id, name, role, description) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (entity.id, entity.document_id, entity.name, entity.role, entity.description)
+        )
+    return entity
+
+
+# =========================
+# Intent
+# =========================
+
+def get_intent(document_id: str) -> Intent | None:
+    with get_conn() as conn:
+        row = conn.execute(
+            'SELECT genre, theme_or_claim, "values", constraints '
+            "FROM author_context WHERE story_id=?",
+            (document_id,)
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    return Intent(
+        genre=row["genre"] or "",
+        theme_or_claim=row["theme_or_claim"] or "",
+        core_values=row["values"] or "",
+        constraints=json.loads(row["constraints"] or "[]")
+    )
+
+
+def _intent_params(document_id: str, intent: Intent) -> tuple:
+    return (
+        document_id,
+        intent.genre,
+        intent.theme_or_claim,
+        intent.core_values,
+        json.dumps(intent.constraints, ensure_ascii=False)
+    )
+
+
+_UPSERT_INTENT_SQL = (
+    'INSERT INTO author_context (story_id, genre, theme_or_claim, "values", constraints) '
+    "VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(story_id) DO UPDATE SET "
+    "genre=excluded.genre, theme_or_claim=excluded.theme_or_claim, "
+    '"values"=excluded."values", constraints=excluded.constraints'
+)
+
+
+def save_intent(document_id: str, intent: Intent) -> None:
+    with get_conn() as conn:
+        conn.execute(_UPSERT_INTENT_SQL, _intent_params(document_id, intent))
+
+
+# =========================
+# JSON document → ミラー同期
+# =========================
+
+def sync_document(document_id: str, document: dict, source_etag: str | None = None) -> None:
+    """
+    JSON の document を1トランザクションで writing.db に反映する。
+    内容が変わった Unit の行だけを書き換える。source_etag は反映した内容の JSON ストアでの ETag
+    """
+    units = document.get("units", [])
+
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO story (id, title, synopsis, doc_type, source_etag) VALUES (?, ?, '', ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET title=excluded.title, doc_type=excluded.doc_type, "
+            "source_etag=excluded.source_etag",
+            (document_id, document.get("title", ""), document.get("doc_type", "novel"), source_etag)
+        )
+
+        conn.executemany(
+            "INSERT INTO scene (id, story_id, title, summary, order_no) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(story_id, order_no) DO UPDATE SET "
+            "title=excluded.title, summary=excluded.summary "
+            "WHERE scene.title IS NOT excluded.title OR scene.summary IS NOT excluded.summary",
+            [
+                (uuid.uuid4().hex, document_id, u.get("title", ""), u.get("content", ""), i)
+                for i, u in enumerate(units)
+            ]
+        )
+        conn.execute(
+            "DELETE FROM scene WHERE story_id=? AND order_no>=?",
+            (document_id, len(units))
+        )
+
+        conn.execute(
+            _UPSERT_INTENT_SQL,
+            _intent_params(document_id, json_to_intent(document.get("intent")))
+        )
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# score_cache.py
+import dataclasses
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import List
+
+from connection_scoring import UnitTokens, tokenize_unit, score_tokens_connection
+from domain_mapper import json_to_intent
+from models import Intent
+from services.scoring import IntentMatcher
+
+# スコアの内容キャッシュ。ドキュメントには保存しない（プロセスのメモリ上だけ）。
+#   Intent スコア:   (Intent の指紋, Unit 本文のハッシュ) → score
+#   接続スコア:      (前の Unit のハッシュ, 後の Unit のハッシュ) → score
+# 本文が変わらなければキーも変わらないので、1つの Unit を編集したときに計算し直すのは
+# その Unit の Intent スコアと前後2本の接続スコアだけになる。
+
+# 各キャッシュの最大件数（超えたら古いものから捨てる）
+SCORE_CACHE_MAX_ENTRIES = 100_000
+# 照合器（IntentMatcher）を保持しておく Intent の数
+MATCHER_CACHE_MAX_ENTRIES = 256
+
+
+class _LRU:
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_matchers = _LRU(MATCHER_CACHE_MAX_ENTRIES)
+_tokens = _LRU(SCORE_CACHE_MAX_ENTRIES)
+_intent_scores = _LRU(SCORE_CACHE_MAX_ENTRIES)
+_connection_scores = _LRU(SCORE_CACHE_MAX_ENTRIES)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+
+
+def intent_fingerprint(intent: Intent) -> str:
+    """スコアに効く Intent の中身だけから作る指紋"""
+    payload = json.dumps(dataclasses.asdict(intent), ensure_ascii=False, sort_keys=True)
+    return content_hash(payload)
+
+
+def _matcher(fingerprint: str, intent: Intent) -> IntentMatcher:
+    matcher = _matchers.get(fingerprint)
+    if matcher is None:
+        matcher = IntentMatcher(intent)
+        _matchers.put(fingerprint, matcher)
+    return matcher
+
+
+def _unit_tokens(unit_hash: str, text: str) -> UnitTokens:
+    tokens = _tokens.get(unit_hash)
+    if tokens is None:
+        tokens = tokenize_unit(text)
+        _tokens.put(unit_hash, tokens)
+    return tokens
+
+
+def _intent_score(fingerprint: str, intent: Intent, unit_hash: str, text: str) -> float:
+    key = (fingerprint, unit_hash)
+    score = _intent_scores.get(key)
+    if score is None:
+        score = _matcher(fingerprint, intent).score(text)
+        _intent_scores.put(key, score)
+    return score
+
+
+def _connection_score(hash_a: str, text_a: str, hash_b: str, text_b: str) -> float:
+    key = (hash_a, hash_b)
+    score = _connection_scores.get(key)
+    if score is None:
+        score = score_tokens_connection(_unit_tokens(hash_a, text_a), _unit_tokens(hash_b, text_b))
+        _connection_scores.put(key, score)
+    return score
+
+
+def score_units(intent_json: dict | None, units: List[dict]) -> List[dict]:
+    """
+    各 Unit の {"intent", "prev", "next"}（attach_unit_scores の要素と同じ形）。
+    キャッシュに無い Unit・隣接ペアだけを計算する
+    """
+    intent = json_to_intent(intent_json)
+    fingerprint = intent_fingerprint(intent)
+    texts = [unit.get("content", "") for unit in units]
+    hashes = [content_hash(text) for text in texts]
+
+    connections = [
+        _connection_score(hashes[i], texts[i], hashes[i + 1], texts[i + 1])
+        for i in range(len(units) - 1)
+    ]
+    return [
+        {
+            "intent": _intent_score(fingerprint, intent, hashes[i], texts[i]),
+            "prev": connections[i - 1] if i > 0 else None,
+            "next": connections[i] if i < len(units) - 1 else None
+        }
+        for i in range(len(units))
+    ]
+
+
+def score_unit(intent_json: dict | None, units: List[dict], index: int, content: str | None = None) -> dict:
+    """
+    1つの Unit のスコア。content を渡すと、その Unit の本文を content に置き換えたものとして計算する
+    （編集中の下書きのスコアを前後の Unit を含めずに素早く返すため）
+    """
+    intent = json_to_intent(intent_json)
+    fingerprint = intent_fingerprint(intent)
+    text = units[index].get("content", "") if content is None else content
+    unit_hash = content_hash(text)
+
+    prev_score = next_score = None
+    if index > 0:
+        prev_text = units[index - 1].get("content", "")
+        prev_score = _connection_score(content_hash(prev_text), prev_text, unit_hash, text)
+    if index < len(units) - 1:
+        next_text = units[index + 1].get("content", "")
+        next_score = _connection_score(unit_hash, text, content_hash(next_text), next_text)
+
+    return {
+        "intent": _intent_score(fingerprint, intent, unit_hash, text),
+        "prev": prev_score,
+        "next": next_score
+    }
+
+
+def clear_score_cache() -> None:
+    for cache in (_matchers, _tokens, _intent_scores, _connection_scores):
+        cache.clear()
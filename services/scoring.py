@@ -1,7 +1,13 @@
 # scoring.py
-from typing import List
+from typing import List, Set
 from models import Intent
 
+# 重み・ペナルティ（score_intent_unit_alignment と IntentMatcher で共通）
+GENRE_WEIGHT = 0.25
+THEME_WEIGHT = 0.35
+VALUES_WEIGHT = 0.40
+CONSTRAINT_PENALTY = 0.2  # 1違反あたりのペナルティ
+
 
 def _keyword_overlap_score(text: str, keywords: List[str]) -> float:
     """
@@ -57,15 +63,69 @@ def score_intent_unit_alignment(
     penalty = 0.0
     for constraint in intent.constraints:
         if constraint and constraint.lower() in unit_text.lower():
-            penalty += 0.2  # 1違反あたりのペナルティ
+            penalty += CONSTRAINT_PENALTY
 
     # --- 重み付き合成 ---
     raw_score = (
-        0.25 * genre_score +
-        0.35 * theme_score +
-        0.40 * values_score
+        GENRE_WEIGHT * genre_score +
+        THEME_WEIGHT * theme_score +
+        VALUES_WEIGHT * values_score
     )
 
     final_score = max(0.0, raw_score - penalty)
 
     return round(min(final_score, 1.0), 3)
+
+
+# =========================
+# Compiled Intent Matcher
+# =========================
+
+class IntentMatcher:
+    """
+    Intent ごとに一度だけ組み立てる照合器。
+    score(unit_text) は score_intent_unit_alignment(intent, unit_text) と同じ値を返すが、
+    キーワード分割・小文字化を毎回やり直さず、本文の小文字化も1回で済む。
+    重複を除いたパターンごとに C 実装の `in` で探す（Intent のパターン数は多くても数十で、
+    150 件程度までは Python で書いた1パスの照合器より速い）
+    """
+
+    def __init__(self, intent: Intent):
+        self._genre = [k.lower() for k in _split_keywords(intent.genre)]
+        self._theme = [k.lower() for k in _split_keywords(intent.theme_or_claim)]
+        self._values = [k.lower() for k in _split_keywords(intent.core_values)]
+        self._constraints = [c.lower() for c in intent.constraints if c]
+
+        self._patterns = list(dict.fromkeys(
+            self._genre + self._theme + self._values + self._constraints
+        ))
+
+    def _find(self, text_lower: str) -> Set[str]:
+        return {p for p in self._patterns if p in text_lower}
+
+    @staticmethod
+    def _overlap(keywords: List[str], found: Set[str]) -> float:
+        if not keywords:
+            return 0.0
+        return sum(1 for k in keywords if k in found) / len(keywords)
+
+    def score(self, unit_text: str) -> float:
+        if not unit_text:
+            return 0.0
+
+        found = self._find(unit_text.lower()) if self._patterns else set()
+
+        penalty = 0.0
+        for constraint in self._constraints:
+            if constraint in found:
+                penalty += CONSTRAINT_PENALTY
+
+        raw_score = (
+            GENRE_WEIGHT * self._overlap(self._genre, found) +
+            THEME_WEIGHT * self._overlap(self._theme, found) +
+            VALUES_WEIGHT * self._overlap(self._values, found)
+        )
+
+        final_score = max(0.0, raw_score - penalty)
+
+        return round(min(final_score, 1.0), 3)
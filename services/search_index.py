@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# search_index.py
+import html
+from typing import Dict, List, Tuple
+
+from db import get_conn
+from domain_mapper import json_to_intent
+from request_timing import timed
+from services.repository import story_id_for
+from user_files import list_documents, load_document
+
+# ユーザーの全ドキュメントの全文検索（writing.db の search_entry + FTS5 trigram の search_fts）。
+# 保存フックで変わった行だけを書き換えるので、検索時に JSON ファイルは読まない。
+# search_entry の1行 = (kind, ref) で識別される検索対象の1つ:
+#   title       : ドキュメントのタイトル（ref は空）
+#   unit        : Unit（ref は並び順の添字、label は Unit のタイトル）
+#   intent      : Intent の項目（ref は項目のキー）
+#   composition : 構成要素の値（ref は "カテゴリID/要素ID"）
+
+KIND_TITLE = "title"
+KIND_UNIT = "unit"
+KIND_INTENT = "intent"
+KIND_COMPOSITION = "composition"
+
+# 1ページの件数の既定値と上限
+SEARCH_PER_PAGE = 20
+SEARCH_MAX_PER_PAGE = 100
+# 検索語の数の上限（空白区切り。超えた分は無視する）
+SEARCH_MAX_TERMS = 8
+# trigram で引ける最短の語の長さ（これより短い語は search_entry の LIKE で絞り込む）
+TRIGRAM_MIN_CHARS = 3
+# 抜粋の長さと、最初に一致した位置より前に含める文字数
+SNIPPET_CHARS = 120
+SNIPPET_LEAD_CHARS = 30
+
+# Intent の固定項目の表示名（fields 形式の項目は各自の label を使う）
+_INTENT_LABELS = {
+    "genre": "ジャンル",
+    "theme_or_claim": "テーマ・主張",
+    "core_values": "価値観",
+    "constraints": "制約"
+}
+
+
+def _entries(document: dict) -> Dict[Tuple[str, str], Tuple[str, str]]:
+    """ドキュメントの検索対象 {(kind, ref): (label, body)}。本文が空のものは含めない"""
+    entries = {}
+    title = document.get("title", "")
+    if title:
+        entries[(KIND_TITLE, "")] = ("タイトル", title)
+
+    for i, unit in enumerate(document.get("units", [])):
+        if isinstance(unit, dict) and unit.get("content"):
+            entries[(KIND_UNIT, str(i))] = (unit.get("title") or f"#{i + 1}", str(unit["content"]))
+
+    intent_json = document.get("intent") or {}
+    intent = json_to_intent(intent_json)
+    for key, label in _INTENT_LABELS.items():
+        value = getattr(intent, key)
+        value = "\n".join(str(v) for v in value) if isinstance(value, list) else str(value or "")
+        if value:
+            entries[(KIND_INTENT, key)] = (label, value)
+    fields = intent_json.get("fields")
+    if isinstance(fields, dict):
+        for key, field in fields.items():
+            if isinstance(field, dict) and field.get("value"):
+                entries[(KIND_INTENT, str(key))] = (field.get("label") or str(key), str(field["value"]))
+
+    elements = document.get("composition_elements") or {}
+    for section in ("common", "doc_type_specific"):
+        for category in (elements.get(section) or {}).get("categories", []):
+            for element in category.get("elements", []):
+                if element.get("value"):
+                    entries[(KIND_COMPOSITION, f"{category.get('id')}/{element.get('id')}")] = (
+                        f"{category.get('label', '')} / {element.get('label', '')}",
+                        str(element["value"])
+                    )
+    return entries
+
+
+def sync_document(user_id: str, document: dict) -> None:
+    """保存フック。前回から変わった検索対象の行だけを書き換える"""
+    story_id = story_id_for(user_id, document["id"])
+    entries = _entries(document)
+
+    with get_conn() as conn:
+        existing = {
+            (row["kind"], row["ref"]): row
+            for row in conn.execute(
+                "SELECT id, kind, ref, label, body FROM search_entry WHERE story_id=?",
+                (story_id,)
+            )
+        }
+
+        conn.executemany(
+            "DELETE FROM search_entry WHERE id=?",
+            [(row["id"],) for key, row in existing.items() if key not in entries]
+        )
+        conn.executemany(
+            "UPDATE search_entry SET label=?, body=? WHERE id=?",
+            [
+                (label, body, existing[key]["id"])
+                for key, (label, body) in entries.items()
+                if key in existing and (existing[key]["label"], existing[key]["body"]) != (label, body)
+            ]
+        )
+        conn.executemany(
+            "INSERT INTO search_entry (user_id, story_id, kind, ref, label, body) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (user_id, story_id, kind, ref, label, body)
+                for (kind, ref), (label, body) in entries.items()
+                if (kind, ref) not in existing
+            ]
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO search_document (story_id, user_id) VALUES (?, ?)",
+            (story_id, user_id)
+        )
+
+
+def delete_document(user_id: str, doc_id: str) -> None:
+    story_id = story_id_for(user_id, doc_id)
+    with get_conn() as conn:
+        conn.execute("DELETE FROM search_entry WHERE story_id=?", (story_id,))
+        conn.execute("DELETE FROM search_document WHERE story_id=?", (story_id,))
+
+
+def _ensure_indexed(user_id: str) -> None:
+    """検索インデックス導入前から存在するドキュメントを一度だけ取り込む"""
+    with get_conn() as conn:
+        indexed = {
+            row["story_id"]
+            for row in conn.execute("SELECT story_id FROM search_document WHERE user_id=?", (user_id,))
+        }
+    for entry in list_documents(user_id):
+        if story_id_for(user_id, entry["id"]) not in indexed:
+            document = load_document(user_id, entry["id"])
+            if document is not None:
+                sync_document(user_id, document)
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _highlight(text: str, terms: List[str]) -> str:
+    """最初に一致した位置の周辺を切り出し、一致部分を <mark> で囲んだ HTML"""
+    lowered = text.lower()
+    needles = [t.lower() for t in terms]
+    positions = [p for p in (lowered.find(n) for n in needles) if p >= 0]
+    start = max(0, min(positions) - SNIPPET_LEAD_CHARS) if positions else 0
+    end = min(len(text), start + SNIPPET_CHARS)
+
+    parts = []
+    i = start
+    while i < end:
+        match = max((n for n in needles if lowered.startswith(n, i)), key=len, default=None)
+        if match:
+            stop = min(i + len(match), end)
+            parts.append(f"<mark>{html.escape(text[i:stop])}</mark>")
+            i = stop
+            continue
+        # 次にどれかの語が始まる位置までをまとめてエスケープする
+        nexts = [p for p in (lowered.find(n, i + 1) for n in needles) if 0 <= p < end]
+        stop = min(nexts) if nexts else end
+        parts.append(html.escape(text[i:stop]))
+        i = stop
+
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    return prefix + "".join(parts) + suffix
+
+
+@timed("search")
+def search(user_id: str, query: str, page: int = 1, per_page: int = SEARCH_PER_PAGE) -> dict:
+    """
+    空白区切りの語をすべて含む検索対象を、一致度の高い順に1ページ分返す。
+    3文字以上の語は FTS5 の trigram インデックスで、それより短い語は LIKE で絞り込む。
+    snippet は HTML エスケープ済みで、一致部分だけが <mark> で囲まれている
+    """
+    terms = (query or "").split()[:SEARCH_MAX_TERMS]
+    page = max(1, page)
+    per_page = max(1, min(per_page, SEARCH_MAX_PER_PAGE))
+    result = {"query": query, "page": page, "per_page": per_page, "total": 0, "results": []}
+    if not terms:
+        return result
+
+    _ensure_indexed(user_id)
+
+    long_terms = [t for t in terms if len(t) >= TRIGRAM_MIN_CHARS]
+    short_terms = [t for t in terms if len(t) < TRIGRAM_MIN_CHARS]
+
+    where = ["e.user_id = ?"]
+    params: list = [user_id]
+    for term in short_terms:
+        where.append("(e.body LIKE ? ESCAPE '\\' OR e.label LIKE ? ESCAPE '\\')")
+        params.extend([_like_pattern(term)] * 2)
+
+    if long_terms:
+        source = "search_fts JOIN search_entry e ON e.id = search_fts.rowid"
+        where.insert(0, "search_fts MATCH ?")
+        params.insert(0, " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+        order = "search_fts.rank"
+    else:
+        source = "search_entry e"
+        order = "e.story_id, e.kind, e.id"
+    where_sql = " AND ".join(where)
+
+    with get_conn() as conn:
+        result["total"] = conn.execute(
+            f"SELECT COUNT(*) FROM {source} WHERE {where_sql}", params
+        ).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT e.story_id, e.kind, e.ref, e.label, e.body, t.body AS doc_title "
+            f"FROM {source} LEFT JOIN search_entry t "
+            f"ON t.story_id = e.story_id AND t.kind = '{KIND_TITLE}' AND t.ref = '' "
+            f"WHERE {where_sql} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]
+        ).fetchall()
+
+    result["results"] = [
+        {
+            "doc_id": row["story_id"].rsplit("/", 1)[1],
+            "doc_title": row["doc_title"] or "",
+            "kind": row["kind"],
+            "ref": row["ref"],
+            "label": row["label"] or "",
+            "snippet": _highlight(row["body"] or "", terms)
+        }
+        for row in rows
+    ]
+    return result
@@ -5,8 +5,13 @@ from typing import Dict, List
 import copy # copyモジュールを追加
 import uuid
 import json
+import threading
+from collections import OrderedDict
 
 from structure_templates import STRUCTURE_TEMPLATES
+from request_timing import timed
+from user_files import get_document_etag
+from intent_service import normalize_intent as _generate_intent_if_missing
 
 # =========================
 # Load Default Composition Meta from JSON
@@ -171,6 +176,56 @@ document["composition_elements"] を初期化・正規化する
             )
 
 
+@timed("normalize")
+def normalize_document(document: dict) -> None:
+    """
+    表示・編集の前提となる正規化（Intent の自動生成 + 構成要素の正規化）
+    """
+    _generate_intent_if_missing(document)
+    normalize_composition_elements(document)
+    # 以前は表示用のスコア（_score）が Unit ごと保存されていた。既存のデータから取り除くためだけに残す
+    for unit in document.get("units", []):
+        if isinstance(unit, dict):
+            unit.pop("_score", None)
+
+
+# 正規化済みであることが分かっている (user_id, doc_id) → (version, ETag)。
+# 正規化の結果は保存されるので、同じバージョンを表示するたびに正規化し直す必要はない。
+# バージョン（ジャーナルの seq）は削除して同じ id で作り直すと 0 からやり直すため、
+# ファイルの stat から作る ETag も合わせて照合する（他のプロセスでの削除・作り直しも見分けられる）
+_NORMALIZED_VERSIONS_MAX = 4096
+_normalized_versions = OrderedDict()
+_normalized_versions_lock = threading.Lock()
+
+
+def is_normalized(user_id: str, doc_id: str, version: int | None) -> bool:
+    if version is None:
+        return False
+    with _normalized_versions_lock:
+        known = _normalized_versions.get((user_id, doc_id))
+    return known is not None and known == (version, get_document_etag(user_id, doc_id)[0])
+
+
+def mark_normalized(user_id: str, doc_id: str, version: int | None) -> None:
+    """保存の直後に呼ぶ（その時点のファイルの ETag と合わせて記録する）"""
+    if version is None:
+        return
+    etag = get_document_etag(user_id, doc_id)[0]
+    if etag is None:
+        return
+    with _normalized_versions_lock:
+        _normalized_versions[(user_id, doc_id)] = (version, etag)
+        _normalized_versions.move_to_end((user_id, doc_id))
+        while len(_normalized_versions) > _NORMALIZED_VERSIONS_MAX:
+            _normalized_versions.popitem(last=False)
+
+
+def forget_normalized(user_id: str, doc_id: str) -> None:
+    """削除フック"""
+    with _normalized_versions_lock:
+        _normalized_versions.pop((user_id, doc_id), None)
+
+
 def update_composition_elements(document: dict, form_data) -> None:
     """
     Composition Elements を更新・追加・削除する (v2)
@@ -404,63 +459,37 @@ def update_intent(document: dict, form_data) -> None:
 
 
 from domain_mapper import json_to_intent
-from optimizer import optimize_unit_order
+from optimizer import solve_unit_order, SOLVER_AUTO
 
 
-def optimize_document_units(document: dict) -> None:
+@timed("optimize")
+def optimize_document_units(document: dict, solver: str = SOLVER_AUTO, budget_ms: int | None = None) -> str | None:
     """
     Document 内の Unit 配列を Intent に基づいて最適化する
-    （破壊的に並び替える）
+    （破壊的に並び替える）。使った解法の名前を返す
     """
     intent = json_to_intent(document.get("intent"))
 
     units = document.get("units", [])
     if not units:
-        return
+        return None
 
-    optimized_units = optimize_unit_order(intent, units)
-    document["units"] = optimized_units
+    result = solve_unit_order(intent, units, solver=solver, budget_ms=budget_ms)
+    document["units"] = result.units
+    return result.solver
 
 
-from services.scoring import score_intent_unit_alignment
-from connection_scoring import score_unit_connection
+from services.score_cache import score_units
 
 
-def attach_unit_scores(document: dict) -> None:
+@timed("score_units")
+def attach_unit_scores(document: dict) -> list[dict]:
     """
-    各 Unit にスコア情報を付与する（UI表示用）
+    各 Unit のスコア情報（UI表示用）を Unit の並び順のリストで返す。
+    隣接ペアの接続スコアはキャッシュから引くので、i の next と i+1 の prev を二重に計算しない。
+    Unit の dict には書き込まないので、あとで document を保存しても _score は残らない
     """
-    intent = json_to_intent(document.get("intent"))
-    units = document.get("units", [])
-
-    for i, unit in enumerate(units):
-        # Intent × Unit
-        intent_score = score_intent_unit_alignment(
-            intent,
-            unit.get("content", "")
-        )
-
-        # Unit × Unit（前後）
-        prev_score = None
-        next_score = None
-
-        if i > 0:
-            prev_score = score_unit_connection(
-                units[i - 1].get("content", ""),
-                unit.get("content", "")
-            )
-
-        if i < len(units) - 1:
-            next_score = score_unit_connection(
-                unit.get("content", ""),
-                units[i + 1].get("content", "")
-            )
-
-        unit["_score"] = {
-            "intent": intent_score,
-            "prev": prev_score,
-            "next": next_score
-        }
+    return score_units(document.get("intent"), document.get("units", []))
 
 # =========================
 # ④ スコア関連
@@ -478,15 +507,16 @@ def score_to_color(score: float | None) -> str:
 # 赤 Unit 抽出
 # =========================
 
+@timed("red_units")
 def extract_red_units(document: dict) -> list[tuple[int, dict]]:
     """
     intent スコアが低い Unit を抽出
     戻り値: [(index, unit_dict), ...] 
     """
+    units = document.get("units", [])
     result = []
-    for i, unit in enumerate(document.get("units", [])):
-        score = unit.get("_score", {}).get("intent")
-        if score is not None and score < 0.3:
+    for i, (unit, score) in enumerate(zip(units, score_units(document.get("intent"), units))):
+        if score["intent"] < 0.3:
             result.append((i, unit))
     return result
 
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# unit_index.py
+import heapq
+import math
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import connection_scoring
+from db import get_conn
+from request_timing import timed
+from services.score_cache import content_hash
+from text_tokenizers import get_tokenizer
+from user_files import list_documents, load_document
+
+# ユーザーごとの Unit 本文の転置インデックス（n-gram → その n-gram を含む Unit と出現回数）。
+# 「いま書いている Unit と同じことを扱っている Unit」を、全 Unit を採点し直さずに探すためのもの。
+# プロセスのメモリ上にだけ持ち、初回の検索時に作る。以後は保存フックで変わった Unit だけを
+# 差し替える。保存フックは writing.db の unit_index_change にも変更を記録するので、
+# 検索のたびにまだ取り込んでいない変更だけを読み直せば、他のプロセスでの保存にも追いつく。
+
+# 返す件数の既定値と上限
+RELATED_TOP_K = 10
+RELATED_MAX_K = 50
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 全 Unit のこの割合より多くに現れる n-gram（「した」「ている」等）は候補集めに使わない。
+# どの Unit にもある n-gram は関連性をほとんど示さず、ポスティングが長いので検索が遅くなる
+COMMON_TERM_RATIO = 0.2
+# Unit がこれより少ないうちは上の除外をしない（小さなコーパスでは割合が当てにならない）
+COMMON_TERM_MIN_UNITS = 50
+# 問い合わせに使う n-gram の数の上限（出現する Unit が少ない＝珍しいものから順に使う）
+QUERY_MAX_TERMS = 64
+# インデックスをメモリに保持するユーザー数（超えたら最後に使ってから長いものから捨てる）
+MAX_INDEXED_USERS = 64
+# 結果に付ける本文の抜粋の長さ
+SNIPPET_CHARS = 80
+
+METHOD_BM25 = "bm25"
+METHOD_JACCARD = "jaccard"
+METHODS = (METHOD_BM25, METHOD_JACCARD)
+
+SCOPE_ALL = "all"
+SCOPE_DOCUMENT = "document"
+SCOPES = (SCOPE_ALL, SCOPE_DOCUMENT)
+
+
+def _terms(text: str) -> Counter:
+    return Counter(get_tokenizer(connection_scoring.TOKENIZER).split(text or ""))
+
+
+@dataclass
+class _IndexedUnit:
+    doc_id: str
+    position: int
+    title: str
+    content_hash: str
+    snippet: str
+    tf: Dict[str, int]
+    length: int
+
+
+class UserUnitIndex:
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._units: Dict[int, _IndexedUnit] = {}
+        self._doc_units: Dict[str, List[int]] = {}
+        self._doc_titles: Dict[str, str] = {}
+        self._doc_seqs: Dict[str, int | None] = {}   # 取り込んだ時点の unit_index_change.seq
+        self._seen_seq = 0   # これ以下の unit_index_change.seq は取り込み済み
+        self._built = False
+        self._total_length = 0
+        self._next_uid = 0
+        self._lock = threading.Lock()
+
+    @property
+    def unit_count(self) -> int:
+        return len(self._units)
+
+    def _add_unit(self, unit: _IndexedUnit) -> int:
+        uid = self._next_uid
+        self._next_uid += 1
+        self._units[uid] = unit
+        for term, count in unit.tf.items():
+            self._postings.setdefault(term, {})[uid] = count
+        self._total_length += unit.length
+        return uid
+
+    def _remove_unit(self, uid: int) -> None:
+        unit = self._units.pop(uid)
+        for term in unit.tf:
+            postings = self._postings[term]
+            del postings[uid]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= unit.length
+
+    def index_document(self, document: dict, seq: int | None) -> None:
+        """
+        ドキュメントの Unit を登録し直す。本文が変わっていない Unit はトークン化し直さず、
+        位置とタイトルだけを更新する
+        """
+        doc_id = document["id"]
+        with self._lock:
+            reusable: Dict[str, List[int]] = {}
+            for uid in self._doc_units.get(doc_id, []):
+                reusable.setdefault(self._units[uid].content_hash, []).append(uid)
+
+            uids = []
+            for position, unit in enumerate(document.get("units", [])):
+                text = unit.get("content", "") or ""
+                unit_hash = content_hash(text)
+                title = unit.get("title") or f"#{position + 1}"
+                if reusable.get(unit_hash):
+                    uid = reusable[unit_hash].pop(0)
+                    self._units[uid].position = position
+                    self._units[uid].title = title
+                else:
+                    tf = _terms(text)
+                    uid = self._add_unit(_IndexedUnit(
+                        doc_id=doc_id,
+                        position=position,
+                        title=title,
+                        content_hash=unit_hash,
+                        snippet=text[:SNIPPET_CHARS],
+                        tf=dict(tf),
+                        length=sum(tf.values())
+                    ))
+                uids.append(uid)
+
+            for stale in reusable.values():
+                for uid in stale:
+                    self._remove_unit(uid)
+
+            self._doc_units[doc_id] = uids
+            self._doc_titles[doc_id] = document.get("title", "")
+            self._doc_seqs[doc_id] = seq
+
+    def remove_document(self, doc_id: str) -> None:
+        with self._lock:
+            for uid in self._doc_units.pop(doc_id, []):
+                self._remove_unit(uid)
+            self._doc_titles.pop(doc_id, None)
+            self._doc_seqs.pop(doc_id, None)
+
+    def refresh(self, user_id: str) -> None:
+        """
+        初回は全ドキュメントから作る。以後は unit_index_change のうちまだ取り込んでいない変更の
+        ドキュメントだけを読み直す（ドキュメントのファイルは stat しない）
+        """
+        with self._lock:
+            built, seen = self._built, self._seen_seq
+        if not built:
+            # 読み込み中の保存を取りこぼさないよう、先に変更の番号を見ておく
+            latest = _latest_change(user_id)
+            for entry in list_documents(user_id):
+                document = load_document(user_id, entry["id"])
+                if document is not None:
+                    self.index_document(document, None)
+            with self._lock:
+                self._built = True
+                self._seen_seq = max(self._seen_seq, latest)
+            return
+
+        changes = _changes_since(user_id, seen)
+        for doc_id, seq in changes:
+            # 保存フックが（このプロセスで）取り込み済みなら読み直さない
+            with self._lock:
+                known = self._doc_seqs.get(doc_id)
+            if known is not None and known >= seq:
+                continue
+            document = load_document(user_id, doc_id)
+            if document is None:
+                self.remove_document(doc_id)
+            else:
+                self.index_document(document, seq)
+        if changes:
+            with self._lock:
+                self._seen_seq = max(self._seen_seq, max(seq for _, seq in changes))
+
+    def _candidate_terms(self, terms) -> List[Dict[int, int]]:
+        """
+        候補集めに使うポスティング。ありふれた n-gram は除き、珍しいものから QUERY_MAX_TERMS 個だけ
+        """
+        unit_count = len(self._units)
+        limit = unit_count * COMMON_TERM_RATIO if unit_count >= COMMON_TERM_MIN_UNITS else unit_count
+        postings = [self._postings[term] for term in terms if term in self._postings]
+        return sorted((p for p in postings if len(p) <= limit), key=len)[:QUERY_MAX_TERMS]
+
+    def _bm25(self, query: Counter) -> Dict[int, float]:
+        n = len(self._units)
+        if n == 0:
+            return {}
+        avg_length = self._total_length / n or 1.0
+        scores: Dict[int, float] = {}
+        norms: Dict[int, float] = {}
+        for postings in self._candidate_terms(query):
+            df = len(postings)
+            weight = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (BM25_K1 + 1)
+            for uid, tf in postings.items():
+                norm = norms.get(uid)
+                if norm is None:
+                    norm = norms[uid] = BM25_K1 * (1 - BM25_B + BM25_B * self._units[uid].length / avg_length)
+                scores[uid] = scores.get(uid, 0.0) + weight * tf / (tf + norm)
+        return scores
+
+    def _jaccard(self, query: Counter) -> Dict[int, float]:
+        query_terms = query.keys()
+        candidates = set()
+        for postings in self._candidate_terms(query_terms):
+            candidates.update(postings)
+
+        scores = {}
+        for uid in candidates:
+            unit_terms = self._units[uid].tf.keys()
+            common = len(query_terms & unit_terms)
+            scores[uid] = common / (len(query_terms) + len(unit_terms) - common)
+        return scores
+
+    def related(self, text: str, k: int, method: str = METHOD_BM25,
+                doc_id: str | None = None, exclude: tuple | None = None) -> List[dict]:
+        """
+        text に近い Unit の上位 k 件。doc_id を渡すとそのドキュメントの中だけを探す。
+        exclude=(doc_id, position) の Unit（問い合わせ元）は結果に含めない
+        """
+        query = _terms(text)
+        if not query:
+            return []
+
+        with self._lock:
+            scores = self._bm25(query) if method == METHOD_BM25 else self._jaccard(query)
+            hits = (
+                (score, uid) for uid, score in scores.items()
+                if score > 0
+                and (doc_id is None or self._units[uid].doc_id == doc_id)
+                and (self._units[uid].doc_id, self._units[uid].position) != exclude
+            )
+            top = heapq.nlargest(k, hits, key=lambda hit: (hit[0], -hit[1]))
+            return [
+                {
+                    "doc_id": self._units[uid].doc_id,
+                    "doc_title": self._doc_titles.get(self._units[uid].doc_id, ""),
+                    "unit_index": self._units[uid].position,
+                    "title": self._units[uid].title,
+                    "snippet": self._units[uid].snippet,
+                    "score": round(score, 3)
+                }
+                for score, uid in top
+            ]
+
+
+_indexes: "OrderedDict[str, UserUnitIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _get_index(user_id: str) -> UserUnitIndex:
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            index = _indexes[user_id] = UserUnitIndex()
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > MAX_INDEXED_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _record_change(user_id: str, doc_id: str) -> int:
+    """doc_id の変更を unit_index_change に記録し、振った番号を返す"""
+    with get_conn() as conn:
+        # 番号を読んでから書くまでを、他のプロセスと排他にする
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO unit_index_change (user_id, doc_id, seq) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM unit_index_change WHERE user_id=?)) "
+            "ON CONFLICT (user_id, doc_id) DO UPDATE SET seq=excluded.seq",
+            (user_id, doc_id, user_id)
+        )
+        row = conn.execute(
+            "SELECT seq FROM unit_index_change WHERE user_id=? AND doc_id=?", (user_id, doc_id)
+        ).fetchone()
+    return row["seq"]
+
+
+def _latest_change(user_id: str) -> int:
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) AS seq FROM unit_index_change WHERE user_id=?", (user_id,)
+        ).fetchone()
+    return row["seq"]
+
+
+def _changes_since(user_id: str, seq: int) -> List[Tuple[str, int]]:
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT doc_id, seq FROM unit_index_change WHERE user_id=? AND seq>? ORDER BY seq",
+            (user_id, seq)
+        ).fetchall()
+    return [(row["doc_id"], row["seq"]) for row in rows]
+
+
+def on_save(user_id: str, document: dict) -> None:
+    """
+    保存フック。変更を記録し（他のプロセスのインデックスは次の検索で拾う）、このプロセスの
+    インデックスがあればそのドキュメントだけ差し替える（まだ作っていなければ初回の検索で作る）
+    """
+    seq = _record_change(user_id, document["id"])
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+    if index is not None:
+        index.index_document(document, seq)
+
+
+def on_delete(user_id: str, doc_id: str) -> None:
+    _record_change(user_id, doc_id)
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+    if index is not None:
+        index.remove_document(doc_id)
+
+
+@timed("related_units")
+def related_units(user_id: str, doc_id: str, unit_index: int, text: str,
+                  k: int = RELATED_TOP_K, method: str = METHOD_BM25, scope: str = SCOPE_ALL) -> List[dict]:
+    """
+    Unit（doc_id の unit_index 番目。本文は text）と同じことを扱っている Unit の上位 k 件。
+    scope="document" なら同じドキュメントの中だけ、"all" ならユーザーの全ドキュメントから探す
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}")
+    if scope not in SCOPES:
+        raise ValueError(f"scope must be one of {SCOPES}")
+
+    index = _get_index(user_id)
+    index.refresh(user_id)
+    return index.related(
+        text,
+        max(1, min(k, RELATED_MAX_K)),
+        method=method,
+        doc_id=doc_id if scope == SCOPE_DOCUMENT else None,
+        exclude=(doc_id, unit_index)
+    )
+
+
+def clear_unit_index() -> None:
+    with _indexes_lock:
+        _indexes.clear()
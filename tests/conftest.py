@@ -0,0 +1,27 @@
+# conftest.py
+import os
+import sys
+
+# アプリのモジュールはリポジトリ直下にあり、パッケージになっていない
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    一時ディレクトリの JSON ストアと writing.db。保存フックは空にする（テストで必要なものだけ足す）
+    """
+    import db
+    import user_files
+
+    monkeypatch.setattr(user_files, "BASE_DIR", str(tmp_path / "user_data"))
+    monkeypatch.setattr(user_files, "_save_hooks", [])
+    monkeypatch.setattr(user_files, "_delete_hooks", [])
+    user_files._cache.clear()
+    monkeypatch.setattr(db, "WRITING_DB_PATH", str(tmp_path / "writing.db"))
+    db.init_db()
+    yield user_files
+    user_files._cache.clear()
+    db.close_all_connections()
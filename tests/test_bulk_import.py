@@ -0,0 +1,112 @@
+# test_bulk_import.py
+import io
+import json
+import zipfile
+
+import pytest
+
+from services import bulk_import
+from services.bulk_import import import_documents, ImportFormatError
+
+
+class _Store:
+    def __init__(self):
+        self.documents = []
+
+    def add(self, document):
+        self.documents.append(document)
+        return {"id": str(len(self.documents))}
+
+
+class _TrackedStream(io.BytesIO):
+    """1回の read / readline で返した最大バイト数を記録する"""
+
+    largest = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.largest = max(self.largest, len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = super().readline(size)
+        self.largest = max(self.largest, len(data))
+        return data
+
+
+def _doc(title, body=""):
+    return {"title": title, "units": [{"content": body}]}
+
+
+def _ndjson(*documents) -> bytes:
+    return "".join(json.dumps(d, ensure_ascii=False) + "\n" for d in documents).encode("utf-8")
+
+
+def _zip(members) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def small_limits(monkeypatch):
+    monkeypatch.setattr(bulk_import, "MAX_DOCUMENT_BYTES", 1000)
+    monkeypatch.setattr(bulk_import, "_CHUNK_BYTES", 256)
+
+
+def test_ndjson_overlong_line_is_rejected_without_reading_it_whole(small_limits):
+    stream = _TrackedStream(_ndjson(_doc("a"), _doc("big", "x" * 50_000), _doc("c")))
+    store = _Store()
+    result = import_documents(stream, "docs.ndjson", store.add)
+
+    assert [d["title"] for d in store.documents] == ["a", "c"]
+    assert result.errors == [("docs.ndjson:2", "ドキュメントが大きすぎます")]
+    assert stream.largest <= bulk_import.MAX_DOCUMENT_BYTES + 1
+
+
+def test_single_json_over_document_limit_is_rejected(small_limits):
+    stream = io.BytesIO(json.dumps(_doc("big", "x" * 50_000)).encode("utf-8"))
+    with pytest.raises(ImportFormatError):
+        import_documents(stream, "doc.json", _Store().add)
+
+
+def test_single_json_array_is_imported_per_document(small_limits):
+    stream = io.BytesIO(json.dumps([_doc("a"), _doc("big", "x" * 50_000), _doc("c")]).encode("utf-8"))
+    store = _Store()
+    result = import_documents(stream, "docs.json", store.add)
+
+    # 大きすぎる要素で読むのをやめる（それまでのドキュメントは取り込む）
+    assert [d["title"] for d in store.documents] == ["a"]
+    assert result.errors == [("docs.json[1]", "ドキュメントが大きすぎます")]
+
+
+def test_zip_member_is_limited_by_expanded_bytes(small_limits, monkeypatch):
+    monkeypatch.setattr(bulk_import, "MAX_MEMBER_BYTES", 5000)
+    # 1行は小さいが、展開すると上限を超える NDJSON メンバー（圧縮後は小さい）
+    bomb = _ndjson(*[_doc(f"bomb{i}", "y" * 200) for i in range(200)])
+    archive = _zip([("bomb.ndjson", bomb), ("ok.json", json.dumps(_doc("ok")))])
+    store = _Store()
+    result = import_documents(archive, "export.zip", store.add)
+
+    assert ("bomb.ndjson", "zipの展開後のサイズが大きすぎます") in result.errors
+    assert [d["title"] for d in store.documents] == ["ok"]
+
+
+def test_counted_reader_stops_at_limit(small_limits):
+    member = bulk_import._CountedReader(io.BytesIO(_ndjson(*[_doc(str(i), "y" * 200) for i in range(50)])), 3000)
+    with pytest.raises(ImportFormatError):
+        list(bulk_import._iter_ndjson(member, "member.ndjson"))
+    assert member.read_bytes <= 3000 + bulk_import.MAX_DOCUMENT_BYTES + 1
+
+
+def test_zip_stops_at_archive_limit(small_limits, monkeypatch):
+    monkeypatch.setattr(bulk_import, "MAX_ARCHIVE_BYTES", 2000)
+    members = [(f"{i}.json", json.dumps(_doc(str(i), "z" * 500))) for i in range(10)]
+    store = _Store()
+    result = import_documents(_zip(members), "export.zip", store.add)
+
+    assert len(store.documents) < 10
+    assert result.errors[-1][1] == "zipの展開後のサイズが大きすぎます"
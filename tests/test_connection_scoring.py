@@ -0,0 +1,77 @@
+# test_connection_scoring.py
+import random
+import statistics
+
+import pytest
+
+import connection_scoring
+import minhash
+from connection_scoring import connection_matrix, score_unit_connection, tokenize_unit, exact_jaccard
+
+TEXTS = [
+    "夜明け前、少年は駅で手紙を静かに見つけた。雨の日、彼女は森で鍵をそっと隠した。",
+    "雨の日、彼女は森で鍵をそっと隠した。冬の朝、老人は海辺で地図を迷わず手放した。",
+    "Before dawn, the boy quietly found a letter at the station.",
+    "",
+    "冬の朝、老人は海辺で地図を迷わず手放した。その夏、探偵は図書館で秘密を思い出した。",
+]
+
+
+def _random_pair(rng: random.Random, size: int, jaccard: float):
+    """Jaccard 係数がおよそ jaccard になる、大きさ size の集合の組"""
+    shared = round(2 * size * jaccard / (1 + jaccard))
+    common = [f"c{rng.getrandbits(48)}" for _ in range(shared)]
+    a = set(common + [f"a{rng.getrandbits(48)}" for _ in range(size - shared)])
+    b = set(common + [f"b{rng.getrandbits(48)}" for _ in range(size - shared)])
+    return a, b
+
+
+def test_minhash_estimation_error_is_bounded():
+    rng = random.Random(0)
+    errors = []
+    for step in range(11):
+        for _ in range(40):
+            a, b = _random_pair(rng, 200, step / 10)
+            exact = len(a & b) / len(a | b)
+            errors.append(minhash.estimate_jaccard(minhash.signature(a), minhash.signature(b)) - exact)
+
+    # 標準偏差はおよそ sqrt(J(1-J)/K) ≤ 0.0625（K=64）
+    assert abs(statistics.mean(errors)) < 0.01
+    assert statistics.mean(abs(e) for e in errors) < 0.05
+    assert max(abs(e) for e in errors) < 0.25
+
+
+def test_minhash_signature_is_the_same_without_numpy(monkeypatch):
+    tokens = tokenize_unit(TEXTS[0]).tokens
+    with_numpy = minhash.signature(tokens)
+    monkeypatch.setattr(minhash, "np", None)
+    assert minhash.signature(tokens) == with_numpy
+
+
+def test_pair_score_is_exact():
+    a, b = tokenize_unit(TEXTS[0]), tokenize_unit(TEXTS[1])
+    expected = connection_scoring._combine(exact_jaccard(a, b), a, b)
+    assert score_unit_connection(TEXTS[0], TEXTS[1]) == expected
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_small_matrix_is_exact_by_default(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(connection_scoring, "np", None)
+    matrix = connection_matrix(TEXTS)
+    for i, a in enumerate(TEXTS):
+        for j, b in enumerate(TEXTS):
+            assert matrix[i][j] == pytest.approx(score_unit_connection(a, b), abs=1e-9)
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_minhash_matrix_stays_close_to_exact(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(connection_scoring, "np", None)
+    monkeypatch.setattr(connection_scoring, "LEXICAL_SIMILARITY", "minhash")
+    estimated = connection_matrix(TEXTS)
+    exact = connection_matrix(TEXTS, exact=True)
+    for row_estimated, row_exact in zip(estimated, exact):
+        for x, y in zip(row_estimated, row_exact):
+            # 語彙の重なりの重みは 0.4
+            assert abs(x - y) <= 0.4 * 0.25
@@ -0,0 +1,53 @@
+# test_optimize_jobs.py
+from concurrent.futures import Future
+
+import pytest
+
+from services import optimize_jobs
+
+
+@pytest.fixture
+def submitted(store, monkeypatch):
+    """プロセスプールには投げず、投入されたジョブ ID を記録する"""
+    jobs = []
+
+    def submit(job_id, document):
+        jobs.append(job_id)
+        return Future()
+    monkeypatch.setattr(optimize_jobs, "_submit", submit)
+    return jobs
+
+
+def _document(n=3):
+    return {"units": [{"title": f"#{i}", "content": f"本文{i}"} for i in range(n)]}
+
+
+def test_same_version_returns_the_running_job(submitted):
+    first = optimize_jobs.start_job("u", "d", 1, _document())
+    again = optimize_jobs.start_job("u", "d", 1, _document())
+    assert again.id == first.id
+    assert submitted == [first.id]
+
+
+def test_new_version_cancels_the_old_job_and_starts_again(submitted):
+    old = optimize_jobs.start_job("u", "d", 1, _document())
+    new = optimize_jobs.start_job("u", "d", 2, _document(4))
+    assert new.id != old.id and new.version == 2
+    assert submitted == [old.id, new.id]
+
+    old_now = optimize_jobs.get_job("u", "d", old.id)
+    assert old_now.state == optimize_jobs.JOB_CANCELLED
+    assert old_now.error == optimize_jobs.SUPERSEDED_JOB_ERROR
+
+    # 古いジョブのプロセスが後から結果を書いても、閉じた行は書き換わらない
+    optimize_jobs._finish(old.id, optimize_jobs.JOB_DONE, best_order=[2, 1, 0], best_score=1.0)
+    assert optimize_jobs.get_job("u", "d", old.id).state == optimize_jobs.JOB_CANCELLED
+    assert optimize_jobs.get_job("u", "d", new.id).state == optimize_jobs.JOB_RUNNING
+
+
+def test_superseded_job_frees_its_slot(submitted, monkeypatch):
+    monkeypatch.setattr(optimize_jobs, "MAX_RUNNING_JOBS", 1)
+    optimize_jobs.start_job("u", "d", 1, _document())
+    optimize_jobs.start_job("u", "d", 2, _document())
+    with pytest.raises(optimize_jobs.TooManyJobsError):
+        optimize_jobs.start_job("u", "other", 1, _document())
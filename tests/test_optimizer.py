@@ -0,0 +1,99 @@
+# test_optimizer.py
+import itertools
+import random
+import time
+
+import pytest
+
+import connection_scoring
+import optimizer
+import order_solvers
+from connection_scoring import connection_matrix, score_unit_connection
+from domain_mapper import json_to_intent
+from optimizer import OrderEvaluator, solve_unit_order
+from order_solvers import held_karp, path_score
+
+_WORDS = ["森", "海", "少年", "少女", "手紙", "約束", "夜明け", "王国", "記憶", "扉", "星", "雨"]
+
+
+def _units(n: int, seed: int = 0, sentences: int = 6):
+    rng = random.Random(seed)
+    return [
+        {"title": f"#{i}", "content": "".join(
+            f"{rng.choice(_WORDS)}の{rng.choice(_WORDS)}は{rng.choice(_WORDS)}を見つけた。" for _ in range(sentences)
+        )}
+        for i in range(n)
+    ]
+
+
+def _intent():
+    return json_to_intent({"genre": "ファンタジー", "theme_or_claim": "約束", "core_values": "記憶", "constraints": ["森"]})
+
+
+def test_connection_matrix_stops_at_deadline():
+    texts = [u["content"] for u in _units(20)]
+    with pytest.raises(TimeoutError):
+        connection_matrix(texts, deadline=time.perf_counter())
+
+
+def test_evaluator_scores_pairs_lazily_when_matrix_does_not_fit_deadline():
+    units = _units(300)
+    evaluator = OrderEvaluator(_intent(), units, deadline=time.perf_counter() + 0.001)
+
+    assert evaluator.matrix is None
+    assert evaluator.connection(3, 7) == score_unit_connection(units[3]["content"], units[7]["content"])
+
+
+def test_budget_covers_score_preparation_without_numpy(monkeypatch):
+    # 純 Python で 500 件の行列を作ると数秒かかる
+    monkeypatch.setattr(connection_scoring, "np", None)
+    started = time.perf_counter()
+    result = solve_unit_order(_intent(), _units(500), budget_ms=50, seed=0)
+
+    assert result.solver == optimizer.SOLVER_ANYTIME
+    assert time.perf_counter() - started < 1.0
+
+
+def _random_matrix(n: int, seed: int):
+    rng = random.Random(seed)
+    return [[0.0 if a == b else rng.random() for b in range(n)] for a in range(n)]
+
+
+@pytest.mark.parametrize("n", [2, 3, 5, 7])
+@pytest.mark.parametrize("numpy_available", [True, False])
+def test_held_karp_matches_brute_force(n, numpy_available, monkeypatch):
+    if not numpy_available:
+        monkeypatch.setattr(order_solvers, "np", None)
+    for seed in range(3):
+        matrix = _random_matrix(n, seed)
+        best = max(path_score(matrix, list(order)) for order in itertools.permutations(range(n)))
+        order = held_karp(matrix)
+        assert sorted(order) == list(range(n))
+        assert path_score(matrix, order) == pytest.approx(best)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_deltas_match_full_reevaluation(lazy):
+    n = 9
+    units = _units(n, seed=3, sentences=2)
+    if lazy:
+        evaluator = OrderEvaluator(_intent(), units, deadline=time.perf_counter())
+        assert evaluator.matrix is None
+    else:
+        evaluator = OrderEvaluator(_intent(), units, matrix=_random_matrix(n, 4))
+
+    rng = random.Random(5)
+    order = list(range(n))
+    rng.shuffle(order)
+    before = evaluator.score(order)
+    for i in range(n):
+        for j in range(n):
+            swapped = order[:]
+            swapped[i], swapped[j] = swapped[j], swapped[i]
+            assert evaluator.swap_delta(order, i, j) == pytest.approx(evaluator.score(swapped) - before)
+
+            moved = order[:]
+            moved.insert(j, moved.pop(i))
+            assert evaluator.move_delta(order, i, j) == pytest.approx(evaluator.score(moved) - before)
+    # delta は order を元に戻している
+    assert evaluator.score(order) == before
@@ -0,0 +1,61 @@
+# test_unit_index.py
+import pytest
+
+from services import unit_index
+from services.unit_index import UserUnitIndex, related_units
+
+
+@pytest.fixture
+def index_store(store, monkeypatch):
+    monkeypatch.setattr(unit_index, "_indexes", type(unit_index._indexes)())
+    store.add_save_hook(on_save=unit_index.on_save, on_delete=unit_index.on_delete)
+    return store
+
+
+def _doc(doc_id, *contents):
+    return {"id": doc_id, "title": doc_id, "units": [{"title": f"#{i}", "content": c} for i, c in enumerate(contents)]}
+
+
+def test_empty_index_returns_nothing():
+    assert UserUnitIndex().related("森で少年が手紙を見つけた", 5) == []
+
+
+def test_saves_in_this_process_are_indexed_by_the_hook(index_store):
+    index_store.add_document("u", _doc("a", "森で少年が古い手紙を見つけた。", "海辺で少女が歌った。"))
+    assert related_units("u", "x", 0, "少年が森で手紙を読んだ")[0]["doc_id"] == "a"
+
+    index_store.add_document("u", _doc("b", "少年は森の奥で手紙をもう一通見つけた。"))
+    hits = related_units("u", "x", 0, "少年は森の奥で手紙をもう一通見つけた")
+    assert hits[0]["doc_id"] == "b"
+
+
+def test_changes_from_other_processes_are_picked_up_without_stat(index_store, monkeypatch):
+    index_store.add_document("u", _doc("a", "森で少年が古い手紙を見つけた。"))
+    related_units("u", "x", 0, "手紙")
+
+    # 他のプロセスでの保存: ファイルと unit_index_change だけが変わり、このプロセスのインデックスには届かない
+    monkeypatch.setattr(index_store, "_save_hooks", [])
+    index_store.save_document("u", _doc("a", "雪原で探偵が星の地図を広げた。"))
+    unit_index._record_change("u", "a")
+
+    hits = related_units("u", "x", 0, "探偵が雪原で地図を広げた")
+    assert hits and hits[0]["doc_id"] == "a"
+    assert related_units("u", "x", 0, "少年が古い手紙を見つけた") == []
+
+
+def test_refresh_without_changes_reads_nothing(index_store, monkeypatch):
+    index_store.add_document("u", _doc("a", "森で少年が古い手紙を見つけた。"))
+    related_units("u", "x", 0, "手紙")
+
+    def fail(*args):
+        raise AssertionError("refresh read a document without a recorded change")
+    monkeypatch.setattr(unit_index, "load_document", fail)
+    monkeypatch.setattr(unit_index, "list_documents", fail)
+    assert related_units("u", "x", 0, "少年が森で手紙を読んだ")[0]["doc_id"] == "a"
+
+
+def test_deleted_documents_drop_out(index_store):
+    index_store.add_document("u", _doc("a", "森で少年が古い手紙を見つけた。"))
+    related_units("u", "x", 0, "手紙")
+    index_store.delete_document("u", "a")
+    assert related_units("u", "x", 0, "少年が森で手紙を読んだ") == []
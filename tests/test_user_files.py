@@ -0,0 +1,60 @@
+# test_user_files.py
+import os
+
+import pytest
+
+
+def _doc(doc_id="d1", *contents):
+    return {"id": doc_id, "title": doc_id, "units": [{"title": f"#{i}", "content": c} for i, c in enumerate(contents)]}
+
+
+def _reload(store, doc_id):
+    """キャッシュを捨ててディスク（スナップショット + ジャーナル）から読み直す"""
+    store._cache.clear()
+    return store.load_document_with_version("u", doc_id)
+
+
+def test_journal_round_trip(store):
+    store.add_document("u", _doc("d1", "一", "二"))
+    assert _reload(store, "d1") == (_doc("d1", "一", "二"), 0)
+
+    document = _doc("d1", "一", "二（改）", "三")
+    assert store.save_document("u", document, expected_version=0) == 1
+    document["units"].pop(0)
+    document["title"] = "改題"
+    assert store.save_document("u", document) == 2
+    assert os.path.exists(store._journal_path("u", "d1"))
+    assert _reload(store, "d1") == (document, 2)
+
+    # 変更の無い保存は何も書かない
+    assert store.save_document("u", document) == 2
+
+    # 畳み込んでもバージョンと内容は変わらず、その後の追記も再生される
+    store.compact_document("u", "d1")
+    assert not os.path.exists(store._journal_path("u", "d1"))
+    assert _reload(store, "d1") == (document, 2)
+
+    document["units"][0]["content"] = "四"
+    assert store.save_document("u", document) == 3
+    assert _reload(store, "d1") == (document, 3)
+
+
+def test_update_document_rejects_a_stale_version(store):
+    store.add_document("u", _doc("d1", "一"))
+    store.save_document("u", _doc("d1", "一", "二"))
+
+    def append(document):
+        document["units"].append({"title": "#x", "content": "x"})
+
+    with pytest.raises(store.VersionConflictError) as raised:
+        store.update_document("u", "d1", append, expected_version=0)
+    assert (raised.value.expected_version, raised.value.current_version) == (0, 1)
+    assert _reload(store, "d1") == (_doc("d1", "一", "二"), 1)
+
+    document, version = store.update_document("u", "d1", append, expected_version=1)
+    assert version == 2 and len(document["units"]) == 3
+    assert _reload(store, "d1") == (document, 2)
+
+
+def test_update_document_of_a_missing_document(store):
+    assert store.update_document("u", "nope", lambda d: None) == (None, None)
@@ -0,0 +1,69 @@
+# text_tokenizers.py
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+# 接続スコアなどで使うトークナイザの差し替え口。
+# 日本語の文は空白で区切られないので、語分割（words）だと1文がまるごと1トークンになる。
+# 文字 n-gram（char_ngram）なら形態素解析なしで文どうしの重なりを測れる。
+
+_SEPARATORS = ["、", "。", ",", ".", "・", "\n"]
+# 文字 n-gram の区切りとして扱う文字（記号・空白）
+_NGRAM_BREAKS = frozenset(" \t\r\n　、。，．,.・！？!?「」『』（）()[]【】〈〉《》…―ー-‐:：;；\"'“”‘’")
+
+
+@dataclass(frozen=True)
+class Tokenizer:
+    name: str
+    split: Callable[[str], List[str]]
+    edge_tokens: int   # Unit の先頭・末尾として見るトークン数（話題のつながりの判定に使う）
+
+
+def word_tokens(text: str) -> List[str]:
+    """
+    句読点と空白で区切る（非依存・軽量。英文向け）
+    """
+    if not text:
+        return []
+
+    for sep in _SEPARATORS:
+        text = text.replace(sep, " ")
+
+    return [t.strip().lower() for t in text.split(" ") if t.strip()]
+
+
+def char_ngrams(text: str) -> List[str]:
+    """
+    記号・空白で区切った各区間の文字 bi-gram と tri-gram（出現順）。
+    1文字だけの区間はその1文字をトークンにする
+    """
+    if not text:
+        return []
+
+    tokens = []
+    segment = []
+    for ch in text.lower() + " ":
+        if ch not in _NGRAM_BREAKS:
+            segment.append(ch)
+            continue
+        if len(segment) == 1:
+            tokens.append(segment[0])
+        for i in range(len(segment) - 1):
+            tokens.append(segment[i] + segment[i + 1])
+            if i + 2 < len(segment):
+                tokens.append(segment[i] + segment[i + 1] + segment[i + 2])
+        segment = []
+    return tokens
+
+
+TOKENIZERS: Dict[str, Tokenizer] = {
+    "words": Tokenizer("words", word_tokens, edge_tokens=10),
+    # bi-gram と tri-gram で1文字あたり約2トークンなので、先頭・末尾はおよそ15文字分
+    "char_ngram": Tokenizer("char_ngram", char_ngrams, edge_tokens=30),
+}
+
+
+def get_tokenizer(name: str) -> Tokenizer:
+    try:
+        return TOKENIZERS[name]
+    except KeyError:
+        raise ValueError(f"unknown tokenizer: {name!r} (choose from {sorted(TOKENIZERS)})")
@@ -1,22 +1,650 @@
-import json, os
+import hashlib, json, os, re, pickle, queue, shutil, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import doc_journal
+import metrics
+from request_timing import span, timed
 
 BASE_DIR = "user_data"
 
+# ユーザーごとのレイアウト:
+#   user_data/<user_id>/manifest.json          … ドキュメント一覧（id / title / doc_type）
+#   user_data/<user_id>/documents/<doc_id>.json … スナップショット {"seq": n, "document": {...}}
+#   user_data/<user_id>/documents/<doc_id>.log  … スナップショット以降の操作ジャーナル（追記のみ）
+#   *.lock                                      … プロセス間ロック用（中身は空）
+# ドキュメントのバージョンはジャーナルの seq（保存ごとに +1）。
+# 旧形式の working.json は初回アクセス時にこのレイアウトへ移行する。
+MANIFEST_FILE = "manifest.json"
+DOCUMENTS_DIR = "documents"
+JOURNAL_SUFFIX = ".log"
+LOCK_SUFFIX = ".lock"
+LEGACY_FILE = "working.json"
+
+_DOC_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# 解析済み JSON のプロセス内キャッシュ（LRU・メモリ上限付き）
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# ジャーナルがこのサイズを超えたらバックグラウンドでスナップショットに畳み込む
+JOURNAL_COMPACT_BYTES = 256 * 1024
+
+# ディスクとのやりとり（kind: snapshot / journal / manifest）とプロセス内キャッシュの当たり外れ
+_read_bytes = metrics.counter(
+    "storyforge_user_files_read_bytes_total", "Bytes read from the JSON document store", ["kind"]
+)
+_written_bytes = metrics.counter(
+    "storyforge_user_files_written_bytes_total", "Bytes written to the JSON document store", ["kind"]
+)
+_cache_lookups = metrics.counter(
+    "storyforge_user_files_cache_lookups_total", "Parsed-document cache lookups", ["result"]
+)
+
+
 def get_user_data_path(user_id):
     """ユーザーのデータディレクトリのパスを返す"""
     return os.path.join(BASE_DIR, str(user_id))
 
+
+def _manifest_path(user_id):
+    return os.path.join(get_user_data_path(user_id), MANIFEST_FILE)
+
+
+def _document_path(user_id, doc_id):
+    if not is_valid_document_id(doc_id):
+        raise ValueError(f"invalid document id: {doc_id!r}")
+    return os.path.join(get_user_data_path(user_id), DOCUMENTS_DIR, f"{doc_id}.json")
+
+
+def _journal_path(user_id, doc_id):
+    return _document_path(user_id, doc_id)[:-len(".json")] + JOURNAL_SUFFIX
+
+
+def _document_lock_path(user_id, doc_id):
+    return _document_path(user_id, doc_id)[:-len(".json")] + LOCK_SUFFIX
+
+
+def _manifest_lock_path(user_id):
+    return _manifest_path(user_id) + LOCK_SUFFIX
+
+
+class VersionConflictError(Exception):
+    """期待したバージョンと保存先の現在のバージョンが違う（他のリクエストが先に保存した）"""
+
+    def __init__(self, doc_id, expected_version, current_version):
+        super().__init__(
+            f"document {doc_id} is at version {current_version}, expected {expected_version}"
+        )
+        self.doc_id = doc_id
+        self.expected_version = expected_version
+        self.current_version = current_version
+
+
+# =========================
+# Cross-process Lock
+# =========================
+
+@contextmanager
+def _file_lock(path, shared=False):
+    """
+    ロックファイルによるプロセス間ロック。
+    open のたびに別のファイル記述子になるので、同一プロセスのスレッド間でも排他になる。
+    Windows（msvcrt）では共有ロックが無いので常に排他
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK は約10秒で諦めるので取れるまで繰り返す
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def is_valid_document_id(doc_id) -> bool:
+    """ファイル名として安全なドキュメントIDかどうか"""
+    return isinstance(doc_id, str) and bool(_DOC_ID_PATTERN.match(doc_id))
+
+
+# =========================
+# Parsed JSON Cache
+# =========================
+
+class _ParsedCache:
+    """
+    path → (stat の指紋, pickle 済みの解析結果) の LRU キャッシュ。
+    指紋（inode / mtime / size）が一致するときだけヒットするので、
+    他プロセスの書き込みも検出できる。
+    値は pickle で保持し、取り出すたびに独立したコピーを返す
+    （呼び出し側が dict を書き換えてもキャッシュは汚れない）。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, stamp):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != stamp:
+                return None
+            self._entries.move_to_end(path)
+            payload = entry[1]
+        return pickle.loads(payload)
+
+    def put(self, path, stamp, obj):
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            self.discard(path)
+            return
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[path] = (stamp, payload)
+            self._size += len(payload)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def discard(self, path):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._size -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+_cache = _ParsedCache(CACHE_MAX_BYTES)
+
+
+def _stat_stamp(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _stat_stamp_or_none(path):
+    try:
+        return _stat_stamp(path)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(path, obj, cache=True):
+    """一時ファイルに書いてから置き換える（途中で落ちても壊れたファイルを残さない）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+        size = os.fstat(f.fileno()).st_size
+    os.replace(tmp_path, path)
+    _written_bytes.inc(size, kind="manifest" if os.path.basename(path) == MANIFEST_FILE else "snapshot")
+    if cache:
+        _cache.put(path, _stat_stamp(path), obj)
+
+
+def _read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        # 開いたファイル自身の stat を使う（stat と open の間の置き換えで取り違えない）
+        st = os.fstat(f.fileno())
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = _cache.get(path, stamp)
+        if cached is not None:
+            _cache_lookups.inc(result="hit")
+            return cached
+        _cache_lookups.inc(result="miss")
+        obj = json.load(f)
+    _read_bytes.inc(st.st_size, kind="manifest" if os.path.basename(path) == MANIFEST_FILE else "snapshot")
+    _cache.put(path, stamp, obj)
+    return obj
+
+
+def _remove_file(path):
+    _cache.discard(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _manifest_entry(document):
+    return {
+        "id": document["id"],
+        "title": document.get("title", ""),
+        "doc_type": document.get("doc_type", "")
+    }
+
+
+# =========================
+# Manifest
+# =========================
+
+def _load_manifest(user_id):
+    path = _manifest_path(user_id)
+    if not os.path.exists(path):
+        _migrate_legacy(user_id)
+        if not os.path.exists(path):
+            return {"documents": []}
+    return _read_json(path)
+
+
+def _save_manifest(user_id, manifest):
+    _write_json(_manifest_path(user_id), manifest)
+
+
+@contextmanager
+def _manifest_transaction(user_id):
+    """manifest の read-modify-write をプロセス間で排他する。変更したら保存する"""
+    with _file_lock(_manifest_lock_path(user_id)):
+        manifest = _load_manifest(user_id)
+        before = json.dumps(manifest, sort_keys=True)
+        yield manifest
+        if json.dumps(manifest, sort_keys=True) != before:
+            _save_manifest(user_id, manifest)
+
+
+def _migrate_legacy(user_id):
+    """旧形式 working.json をドキュメント単位のファイルに分割する"""
+    legacy_path = os.path.join(get_user_data_path(user_id), LEGACY_FILE)
+    if not os.path.exists(legacy_path):
+        return
+    data = _read_json(legacy_path)
+    seen = set()
+    for document in data.get("documents", []):
+        while not is_valid_document_id(document.get("id")) or document["id"] in seen:
+            document["id"] = os.urandom(4).hex()
+        seen.add(document["id"])
+        _write_snapshot(user_id, document["id"], 0, document)
+    _save_manifest(user_id, {"documents": [_manifest_entry(d) for d in data.get("documents", [])]})
+    _remove_file(legacy_path)
+
+
+@timed("list_documents")
+def list_documents(user_id):
+    """ドキュメント一覧（id / title / doc_type）を返す。本体は読み込まない"""
+    return _load_manifest(user_id).get("documents", [])
+
+
+# =========================
+# Snapshot + Journal
+# =========================
+
+def _document_lock(user_id, doc_id, shared=False):
+    """ドキュメント単位のプロセス間ロック（スナップショット書き換えとジャーナル追記の排他）"""
+    return _file_lock(_document_lock_path(user_id, doc_id), shared=shared)
+
+
+def _unwrap_snapshot(obj):
+    # 旧形式（ドキュメントそのもの）のスナップショットは seq=0 とみなす
+    if isinstance(obj, dict) and set(obj) == {"seq", "document"}:
+        return obj["seq"], obj["document"]
+    return 0, obj
+
+
+def _document_stamp(user_id, doc_id):
+    return (
+        _stat_stamp_or_none(_document_path(user_id, doc_id)),
+        _stat_stamp_or_none(_journal_path(user_id, doc_id))
+    )
+
+
+def _read_document_state(user_id, doc_id, locked=False):
+    """
+    スナップショットにジャーナルを再生した (seq, document) を返す。無ければ None。
+    ディスクから読むときは共有ロックを取る（畳み込みの途中を読まない）。
+    locked=True は呼び出し側がすでに排他ロックを持っている場合
+    """
+    snapshot_path = _document_path(user_id, doc_id)
+    stamp = _document_stamp(user_id, doc_id)
+    if stamp[0] is None:
+        return None
+
+    cached = _cache.get(snapshot_path, stamp)
+    if cached is not None:
+        _cache_lookups.inc(result="hit")
+        return cached
+
+    if not locked:
+        with _document_lock(user_id, doc_id, shared=True):
+            return _read_document_state(user_id, doc_id, locked=True)
+
+    _cache_lookups.inc(result="miss")
+    with open(snapshot_path, "r", encoding="utf-8") as f:
+        seq, document = _unwrap_snapshot(json.load(f))
+        _read_bytes.inc(os.fstat(f.fileno()).st_size, kind="snapshot")
+    if stamp[1] is not None:
+        _read_bytes.inc(stamp[1][2], kind="journal")
+
+    for record in doc_journal.read_records(_journal_path(user_id, doc_id)):
+        if record.get("seq", 0) <= seq:
+            continue  # スナップショットに畳み込み済み
+        document = doc_journal.apply_ops(document, record["ops"])
+        seq = record["seq"]
+
+    state = (seq, document)
+    _cache.put(snapshot_path, stamp, state)
+    return state
+
+
+def _write_snapshot(user_id, doc_id, seq, document):
+    """スナップショットを書き、畳み込み済みのジャーナルを消す"""
+    snapshot_path = _document_path(user_id, doc_id)
+    _write_json(snapshot_path, {"seq": seq, "document": document}, cache=False)
+    # ここで落ちても、ジャーナルの seq はすべてスナップショット以下なので再生されない
+    _remove_file(_journal_path(user_id, doc_id))
+    _cache.put(snapshot_path, _document_stamp(user_id, doc_id), (seq, document))
+
+
+def compact_document(user_id, doc_id):
+    """ジャーナルをスナップショットに畳み込む"""
+    with _document_lock(user_id, doc_id):
+        if not os.path.exists(_journal_path(user_id, doc_id)):
+            return
+        state = _read_document_state(user_id, doc_id, locked=True)
+        if state is not None:
+            _write_snapshot(user_id, doc_id, *state)
+
+
+_compaction_queue = queue.Queue()
+_compaction_pending = set()
+_compaction_guard = threading.Lock()
+_compaction_thread = None
+
+
+def _compaction_worker():
+    while True:
+        key = _compaction_queue.get()
+        with _compaction_guard:
+            _compaction_pending.discard(key)
+        try:
+            compact_document(*key)
+        except Exception as e:
+            # 畳み込みに失敗してもジャーナルから読めるのでデータは失われない
+            print(f"journal compaction failed for {key}: {e}")
+
+
+def _schedule_compaction(user_id, doc_id):
+    global _compaction_thread
+    key = (user_id, doc_id)
+    with _compaction_guard:
+        if key in _compaction_pending:
+            return
+        _compaction_pending.add(key)
+        if _compaction_thread is None:
+            _compaction_thread = threading.Thread(
+                target=_compaction_worker, name="journal-compactor", daemon=True
+            )
+            _compaction_thread.start()
+    _compaction_queue.put(key)
+
+
+# =========================
+# Save Hooks
+# =========================
+
+# 保存・削除のたびに呼ばれるフック（writing.db のミラー等）。
+# on_save(user_id, document) / on_delete(user_id, doc_id)
+_save_hooks = []
+_delete_hooks = []
+
+
+def add_save_hook(on_save=None, on_delete=None):
+    if on_save is not None:
+        _save_hooks.append(on_save)
+    if on_delete is not None:
+        _delete_hooks.append(on_delete)
+
+
+def _run_hooks(hooks, *args):
+    for hook in hooks:
+        try:
+            with span("save_hooks"):
+                hook(*args)
+        except Exception as e:
+            # フックの失敗で保存自体を失敗させない（ミラーは次回の保存で追いつく）
+            print(f"user_files hook {getattr(hook, '__name__', hook)} failed: {e}")
+
+
+# =========================
+# Document 単位の読み書き
+# =========================
+
+@timed("load_document")
+def load_document_with_version(user_id, doc_id):
+    """ドキュメントとそのバージョンを返す。存在しなければ (None, None)"""
+    if not is_valid_document_id(doc_id):
+        return None, None
+    state = _read_document_state(user_id, doc_id)
+    if state is None:
+        _load_manifest(user_id)  # 旧形式のまま残っている場合はここで移行される
+        state = _read_document_state(user_id, doc_id)
+        if state is None:
+            return None, None
+    seq, document = state
+    return document, seq
+
+
+def load_document(user_id, doc_id):
+    """ドキュメントを1件だけ読み込む。存在しなければ None"""
+    return load_document_with_version(user_id, doc_id)[0]
+
+
+def _etag_and_mtime(stamps):
+    present = [st for st in stamps if st is not None]
+    etag = hashlib.blake2b(repr(stamps).encode(), digest_size=12).hexdigest()
+    last_modified = max(st[1] for st in present) / 1e9 if present else None
+    return etag, last_modified
+
+
+def get_document_etag(user_id, doc_id):
+    """
+    ファイルの stat だけから (ETag, 最終更新の UNIX 時刻) を返す（本体は読まない）。
+    ファイルが無ければ (None, None)
+    """
+    if not is_valid_document_id(doc_id):
+        return None, None
+    stamp = _document_stamp(user_id, doc_id)
+    if stamp[0] is None:
+        return None, None
+    return _etag_and_mtime(stamp)
+
+
+def get_documents_etag(user_id):
+    """全ドキュメント（と一覧）の stat から (ETag, 最終更新の UNIX 時刻) を返す"""
+    stamps = [_stat_stamp_or_none(_manifest_path(user_id))]
+    for entry in list_documents(user_id):
+        stamps.extend(_document_stamp(user_id, entry["id"]))
+    return _etag_and_mtime(tuple(stamps))
+
+
+def _save_document_locked(user_id, document, expected_version):
+    """ドキュメントの排他ロックを持った状態で保存する。保存後のバージョンを返す"""
+    doc_id = document["id"]
+    state = _read_document_state(user_id, doc_id, locked=True)
+    if state is None:
+        if expected_version not in (None, 0):
+            raise VersionConflictError(doc_id, expected_version, None)
+        _write_snapshot(user_id, doc_id, 0, document)
+        _run_hooks(_save_hooks, user_id, document)
+        return 0
+
+    seq, current = state
+    if expected_version is not None and expected_version != seq:
+        raise VersionConflictError(doc_id, expected_version, seq)
+
+    ops = doc_journal.diff_document(current, document)
+    if not ops:
+        return seq
+
+    seq += 1
+    journal_before = _stat_stamp_or_none(_journal_path(user_id, doc_id))
+    journal_size = doc_journal.append_record(
+        _journal_path(user_id, doc_id), {"seq": seq, "ops": ops}
+    )
+    _written_bytes.inc(journal_size - (journal_before[2] if journal_before else 0), kind="journal")
+    _cache.put(
+        _document_path(user_id, doc_id),
+        _document_stamp(user_id, doc_id),
+        (seq, document)
+    )
+    if journal_size > JOURNAL_COMPACT_BYTES:
+        _schedule_compaction(user_id, doc_id)
+    _run_hooks(_save_hooks, user_id, document)
+    return seq
+
+
+def _update_manifest_entry(user_id, document):
+    entry = _manifest_entry(document)
+    existing = next((d for d in list_documents(user_id) if d["id"] == entry["id"]), None)
+    if existing == entry:
+        return  # 大半の保存はタイトル等が変わらないのでロックも取らない
+
+    with _manifest_transaction(user_id) as manifest:
+        entries = manifest.setdefault("documents", [])
+        for i, existing in enumerate(entries):
+            if existing["id"] == entry["id"]:
+                entries[i] = entry
+                return
+        entries.append(entry)
+
+
+@timed("save_document")
+def save_document(user_id, document, expected_version=None):
+    """
+    ドキュメントを1件だけ保存し、保存後のバージョンを返す。
+    既存ドキュメントは前回との差分だけをジャーナルに追記する（変更が無ければ何も書かない）。
+    expected_version を渡すと、保存先がそのバージョンでなければ VersionConflictError
+    （compare-and-swap）。一覧の情報が変わったときだけ manifest も書き直す
+    """
+    with _document_lock(user_id, document["id"]):
+        version = _save_document_locked(user_id, document, expected_version)
+    _update_manifest_entry(user_id, document)
+    return version
+
+
+@timed("update_document")
+def update_document(user_id, doc_id, mutate, expected_version=None):
+    """
+    排他ロックを持ったまま 読み込み → mutate(document) → 保存 を行い、
+    (document, 保存後のバージョン) を返す。並行するリクエストの変更を上書きで失わない。
+    mutate が何も変えなければ書き込みは発生しない。ドキュメントが無ければ (None, None)
+    """
+    if load_document(user_id, doc_id) is None:  # 旧形式の移行と存在確認
+        return None, None
+
+    with _document_lock(user_id, doc_id):
+        state = _read_document_state(user_id, doc_id, locked=True)
+        if state is None:
+            return None, None
+        seq, document = state
+        if expected_version is not None and expected_version != seq:
+            raise VersionConflictError(doc_id, expected_version, seq)
+        mutate(document)
+        version = _save_document_locked(user_id, document, seq)
+
+    _update_manifest_entry(user_id, document)
+    return document, version
+
+
+def add_document(user_id, document):
+    """
+    新しいドキュメントを追加する（アップロード等）。
+    id が無い・不正・既存と重複する場合は新しい id を振り直す。
+    """
+    # id の決定と一覧への登録を同じロックの中で行い、同時アップロードでの衝突を防ぐ
+    with _manifest_transaction(user_id) as manifest:
+        entries = manifest.setdefault("documents", [])
+        existing_ids = {d["id"] for d in entries}
+        doc_id = document.get("id")
+        while not is_valid_document_id(doc_id) or doc_id in existing_ids:
+            doc_id = os.urandom(4).hex()
+        document["id"] = doc_id
+        entries.append(_manifest_entry(document))
+
+    save_document(user_id, document)
+    return document
+
+
+def delete_document(user_id, doc_id):
+    """ドキュメントを削除する"""
+    with _manifest_transaction(user_id) as manifest:
+        manifest["documents"] = [d for d in manifest.get("documents", []) if d["id"] != doc_id]
+    with _document_lock(user_id, doc_id):
+        _remove_file(_document_path(user_id, doc_id))
+        _remove_file(_journal_path(user_id, doc_id))
+    _run_hooks(_delete_hooks, user_id, doc_id)
+
+
+# =========================
+# ユーザーデータ全体（互換API）
+# =========================
+
+@timed("save_user_data")
 def save_user_data(user_id, data):
-    """ユーザーデータを保存する。ディレクトリがなければ作成する"""
+    """ユーザーデータ全体を保存する。ディレクトリがなければ作成する"""
+    documents = data.get("documents", [])
+    for document in documents:
+        save_document(user_id, document)
+
+    with _manifest_transaction(user_id) as manifest:
+        manifest["documents"] = [_manifest_entry(d) for d in documents]
+
+    # data から消えたドキュメントのファイルを掃除する
+    docs_dir = os.path.join(get_user_data_path(user_id), DOCUMENTS_DIR)
+    keep = {d["id"] for d in documents}
+    for name in os.listdir(docs_dir) if os.path.isdir(docs_dir) else []:
+        stem, ext = os.path.splitext(name)
+        if ext in (".json", JOURNAL_SUFFIX) and stem not in keep:
+            _remove_file(os.path.join(docs_dir, name))
+            if ext == ".json":
+                _run_hooks(_delete_hooks, user_id, stem)
+
+
+def reset_user_data(user_id):
+    """
+    ユーザーのドキュメントをすべて削除して空の状態にする（エフェメラル運用のログイン時）。
+    削除フックを通すので writing.db のミラーも消える
+    """
+    for entry in list_documents(user_id):
+        delete_document(user_id, entry["id"])
     user_path = get_user_data_path(user_id)
-    os.makedirs(user_path, exist_ok=True)
-    with open(os.path.join(user_path, "working.json"), "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if os.path.exists(user_path):
+        shutil.rmtree(user_path)
+    _save_manifest(user_id, {"documents": []})
+
 
+@timed("load_user_data")
 def load_user_data(user_id):
-    """ユーザーデータを読み込む"""
-    path = os.path.join(get_user_data_path(user_id), "working.json")
-    if not os.path.exists(path):
-        return {"documents": []}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    """ユーザーデータ全体を読み込む"""
+    documents = []
+    for entry in list_documents(user_id):
+        document = load_document(user_id, entry["id"])
+        if document is not None:
+            documents.append(document)
+    return {"documents": documents}